@@ -16,6 +16,7 @@ import pyvisa
 from Phidget22.Devices.VoltageOutput import *
 import PySimpleGUI as sg
 from pymodbus.client.sync import ModbusSerialClient as ModbusClient
+from pymodbus.client.sync import ModbusTcpClient
 # import relay_ft245r
 import sys
 import os
@@ -24,6 +25,29 @@ import datetime
 import pytz
 import statistics
 import openpyxl
+from s11_store import S11Store, fetch_trace, fetch_frequencies
+from dual_port import DualPortAcquisition
+from sweep_planner import SweepPlan, parse_bands, noise_from_traces
+from live_plot import LivePlotPanel
+from sim_e5080a import SimulatedResourceManager
+from sim_kms200 import SimulatedKMS200, SimulatedModbusClient
+from tracing import TRACER
+from pipeline import MeasurementPipeline
+from dielectric_check import lookup_table
+from trend import TrendEstimator, next_on_delay
+from interval_scheduler import IntervalScheduler
+from protocol import Protocol, ProtocolError, load_protocol
+from isocratic_pump import PumpController, open_backend, COMMAND_TIMEOUT
+from scan_monitor import ScanMonitor
+from scan_results import read_scan_record, apply_frequency
+from list_sweep import ListSweep, frequency_plan
+from interlock import Interlock
+from ablation_cycle import Measurement, run_cycle, STOP_INTERLOCK, TARGET_REACHED
+from modbus_scheduler import ModbusScheduler
+from kms200 import KMS200
+from keepalive import WatchdogKeepAlive
+from permittivity import RunPermittivity
+from calibration_cache import CalibrationCache, write_calibration, calibrate, RUN_CALIBRATION_FILE
 
 """
 ************************************************
@@ -41,8 +65,19 @@ SWITCH
 """
 NETWORK ANALYZER
 """
+# ANALYZER BACKEND: 'USB' = real E5080A, 'SIM' = simulated E5080A (sim_e5080a.py) for offline runs and benchmarks
+# Can be chosen without editing the file with the ABLATION_ANALYZER environment variable
+ANALYZER_BACKEND = os.environ.get("ABLATION_ANALYZER", "USB")
+
+# SIMULATED ANALYZER: local folder standing for D:/ and delay scale (1 = real sweep times, 0 = instantaneous)
+SIM_DISK_ROOT = os.environ.get("ABLATION_SIM_DISK", "ENA_Disk")
+SIM_TIME_SCALE = float(os.environ.get("ABLATION_SIM_TIME_SCALE", "1.0"))
+
 # Create a ressource manager
-rm = pyvisa.ResourceManager()
+if ANALYZER_BACKEND == "SIM":
+    rm = SimulatedResourceManager(disk_root=SIM_DISK_ROOT, time_scale=SIM_TIME_SCALE)
+else:
+    rm = pyvisa.ResourceManager()
 rm.list_resources()
 
 # Open the Network analyzer by name
@@ -53,8 +88,110 @@ GENERATOR
 """
 UNIT = 0x01  # Set the generator slave address
 
+# GENERATOR BACKEND: 'COM' = real KMS200, 'SIM' = simulated KMS200 in this process (sim_kms200.py),
+# 'TCP' = simulated KMS200 served by "python sim_kms200.py" (whole pymodbus stack)
+GENERATOR_BACKEND = os.environ.get("ABLATION_GENERATOR", "COM")
+
 # COM varies from generator to generator
-client = ModbusClient(method='rtu', port='COM7', timeout=4, baudrate=115200, strict=False)
+if GENERATOR_BACKEND == "SIM":
+    client = SimulatedModbusClient(SimulatedKMS200())
+elif GENERATOR_BACKEND == "TCP":
+    client = ModbusTcpClient('localhost', port=5020, timeout=4)
+else:
+    client = ModbusClient(method='rtu', port='COM7', timeout=4, baudrate=115200, strict=False)
+
+# MODBUS SCHEDULER: one thread owns the line, microwaves OFF commands go before the other writes and the reads
+# (modbus_scheduler.py). ABLATION_MODBUS_SCHEDULER=0 goes back to the calls on the client from each thread.
+MODBUS_SCHEDULER = os.environ.get("ABLATION_MODBUS_SCHEDULER", "1") == "1"
+if MODBUS_SCHEDULER:
+    client = ModbusScheduler(client)
+
+# SETPOINTS: shadow of regs 0-17 and 98, a setpoint equal to the generator value is not written again, the changed
+# ones are written together and read back in one block (kms200.KMS200). Each procedure reads the shadow back first.
+generator = KMS200(client, UNIT)
+
+"""
+ISOCRATIC PUMP
+"""
+# PUMP BACKEND: 'LICOP' = LicopDemo executables (pre-built flows only), 'MOCK' = pump model in memory,
+# 'COMx' = command session on the RS-232 port of the pump, 'LAN:host[:port]' = command session on its LAN port
+# Can be chosen without editing the file with the ABLATION_PUMP environment variable
+PUMP_BACKEND = os.environ.get("ABLATION_PUMP", "LICOP")
+
+# One controller for the whole session, commands are queued and the status is polled in the background
+isocratic = PumpController(open_backend(PUMP_BACKEND))
+
+"""
+SAFETY INTERLOCK
+"""
+# Thread reading the generator telemetry (regs 102-105) every INTERLOCK_PERIOD s during the five iteration test,
+# microwaves OFF as soon as a limit is exceeded (interlock.py). Every Modbus call of client goes through its lock.
+INTERLOCK_PERIOD = 0.02     # s
+INTERLOCK_LIMITS = [
+    {'kind': 'reflected_ratio', 'max': 0.5, 'min_forward': 5, 'samples': 2},
+    {'kind': 'forward_off', 'max': 0, 'settle': 0.05, 'samples': 2},
+    {'kind': 'comms_loss', 'max': 1.0},
+    {'kind': 'pump_stall', 'min_fraction': 0.5, 'max_pressure': 350, 'settle': 10},
+]
+
+interlock = Interlock(client, INTERLOCK_LIMITS, INTERLOCK_PERIOD, UNIT, pump=isocratic)
+
+"""
+WATCHDOG KEEP-ALIVE
+"""
+# During the five iteration test, reg 98 holds WATCHDOG_TIMEOUT instead of 300 s and a request reaches the generator at
+# least every WATCHDOG_TIMEOUT / 4 (keepalive.py): the interlock reads are enough, otherwise one read of reg 98 is sent.
+# If the program stops, the generator faults and turns OFF after WATCHDOG_TIMEOUT.
+WATCHDOG_TIMEOUT = 30.0     # s
+keepalive = WatchdogKeepAlive(client, WATCHDOG_TIMEOUT, unit=UNIT)
+
+"""
+MEASUREMENT PIPELINE
+"""
+# ABLATION_PIPELINE=1 (default): the OFF window of the five iteration test only holds the sweep and one trace transfer,
+# the .s1p files and the run store are written in the background while microwaves are ON (pipeline.py).
+# ABLATION_PIPELINE=0 goes back to the ENA saving each .s1p file during the OFF window.
+PIPELINED_MEASUREMENT = os.environ.get("ABLATION_PIPELINE", "1") == "1"
+PIPELINE_DEPTH = 8
+
+"""
+PREDICTIVE EARLY STOP
+"""
+# With the dielectric verification ON, the stop margin of each trace feeds an exponentially weighted trend (trend.py).
+# When the target is forecast before the end of the next ON delay, that ON delay is shortened to the forecast.
+# Steps without a dielectric stop keep their ON delay. The trend restarts at each step with another target.
+PREDICTIVE_STOP = True
+TREND_HALFLIFE = 10.0   # s
+MIN_ON_DELAY = 0.2      # s
+
+"""
+PERMITTIVITY
+"""
+# Each trace of the five iteration test is converted to the permittivity of the tissue (permittivity.py) with the
+# calibration of the probe found in the cache (calibration_cache.py) for the frequency axis and IF bandwidth of the run.
+# The mean eps' and eps'' of each trace go to the log and to the Excel file. Without a calibration, nothing is converted.
+CALIBRATION_ROOT = os.environ.get("ABLATION_CALIBRATION", "D:/Ablation_Automatisation/Programmation/Automatisation_Andre/Calibrations")
+PROBE_ID = os.environ.get("ABLATION_PROBE", "Probe1")
+CALIBRATION_TEMPERATURE = 25.0  # degC
+PERMITTIVITY_BAND = None        # (start, stop) Hz of the means, None = whole sweep
+
+calibrations = CalibrationCache(CALIBRATION_ROOT)
+
+"""
+TRACING
+"""
+# ABLATION_TRACE=1 records every instrument call of the five iteration test (device, command, duration, bytes)
+# under its step / cycle / OFF-ON phase. The Chrome trace is saved beside the log file (tracing.py).
+# Only the last ABLATION_TRACE_EVENTS calls are kept.
+TRACING = os.environ.get("ABLATION_TRACE", "0") == "1"
+TRACE_EVENTS = int(os.environ.get("ABLATION_TRACE_EVENTS", "1000000"))
+
+if TRACING:
+    TRACER.enable(TRACE_EVENTS)
+    TRACER.instrument_analyzer(analyzer)
+    TRACER.instrument_modbus(client)
+    TRACER.instrument_lucidio()
+    TRACER.instrument_phidget()
 
 
 """
@@ -207,40 +344,28 @@ def Normal_Test(startFreq, stopFreq, datapoints, BW, num_its, ONdelay, OFFdelay,
     """
     2. GENERATOR SET
     """
+    # GENERATOR SETPOINTS AS THEY ARE NOW (only the ones that change are written below)
+    generator.refresh()
+
     # RESET COMMUNICATION TIMEOUT ( Must be greater than Power_ON_time !!!)
     # Function : register 98 set to X time before generator is faulted (red light on generator)
-    client.write_register(98, 3000, unit=UNIT)
-
     # SET FREQUENCY
     # See page 31 of microwave generator user manual for more information (Cabinet 18, room 455, IARC)
+    # REFLECTED POWER SET
+    # Value = 15% of transmitted power OR Manual selected value (See generator user manual for more details, cabinet 18, room 455, IARC)
+    # TRANSMITTED POWER SET
     freqKHz = freq * 10
-    client.write_register(9, freqKHz, unit=UNIT)
-    rr = client.read_holding_registers(112, 1, unit=UNIT)
-    rr1 = rr.registers
-    print("Generator frequency is set to :" + str(rr1) + " Hz \n")
+    auto_rpower = 0.15 * power
+    Setpoints = generator.setpoints(timeout=3000, frequency=freqKHz,
+                                    rpower=int(rpower) if int(rpower) != 0 else int(auto_rpower), power=power)
+    print("Generator frequency is set to :" + str(Setpoints['frequency'] / 10) + " MHz \n")
+    print("Reflected power set to " + str(Setpoints['rpower']) + " W \n")
+    print("Transmitted power value set \n")
 
     # REFLECTED POWER LIMITATION MODE - ON
     client.write_register(2, 0x10, unit=UNIT)
     print("Reflected power limitation mode activated \n")
 
-    # REFLECTED POWER SET
-    # Value = 15% of transmitted power OR Manual selected value (See generator user manual for more details, cabinet 18, room 455, IARC)
-    auto_rpower = 0.15 * power
-    if int(rpower) != 0:
-        client.write_register(1, int(rpower), unit=UNIT)
-        rr = client.read_holding_registers(1, 1, unit=UNIT)
-        rr1 = rr.registers
-        print("Reflected power set to " + str(rr1) + " W \n")
-    else:
-        client.write_register(1, int(auto_rpower), unit=UNIT)
-        rr = client.read_holding_registers(1, 1, unit=UNIT)
-        rr1 = rr.registers
-        print("Reflected power set to " + str(rr1) + " W \n")
-
-    # TRANSMITTED POWER SET
-    client.write_register(0, power, unit=UNIT)
-    print("Transmitted power value set \n")
-
     # TURN GENERATOR OFF (default state)
     client.write_register(2, 0x00, unit=UNIT)
     print("Microwave is turned off for its initial state \n")
@@ -270,7 +395,7 @@ def Normal_Test(startFreq, stopFreq, datapoints, BW, num_its, ONdelay, OFFdelay,
     if Iso_ON == 1:
         sg.popup(
             "Please wait 40 seconds for isocratic pump to initialise. Once done, enter desired flow speed in command prompt. Press Okay to continue.")
-        os.system("C:/Windows\Licop\LicopDemo\PumpSTANDBY.exe")
+        isocratic.standby()
         # window.findElement('_TEST_FRAME_').update(Visible=True)
 
     """
@@ -321,7 +446,7 @@ def Normal_Test(startFreq, stopFreq, datapoints, BW, num_its, ONdelay, OFFdelay,
             # Turn isocratic pump ON for remainder of test (if Iso_ON = 1)
             if Iso_ON == 1:
                 window.find_element('_NORMAL8_').update(text_color='red')
-                os.system("C:/Windows\Licop\LicopDemo\PumpON.exe")
+                isocratic.on()
 
 
         else:
@@ -339,12 +464,9 @@ def Normal_Test(startFreq, stopFreq, datapoints, BW, num_its, ONdelay, OFFdelay,
             CHECK IF REFLECTED POWER VALUE READ IS GREATER THEN 15% OF TRANSMITTED POWER.            
             """
             rr = client.read_holding_registers(103, 1, unit=UNIT)
-            rr_rpower = str(rr.registers)
-
-            # For debugging purposes
-            # print(rr_rpower[1:2])
+            rr_rpower = rr.registers[0]
 
-            if (int(rr_rpower[1]) > auto_rpower and rpower == 0) or (int(rr_rpower[1:2]) > auto_rpower and rpower == 0):
+            if rr_rpower > auto_rpower and rpower == 0:
                 sg.popup(
                     "The reflected power is too high.\n The code will shutdown automatically.\n Rerun the code if you desire retrying the test.")
                 # TURN MICROWAVES OFF
@@ -364,7 +486,7 @@ def Normal_Test(startFreq, stopFreq, datapoints, BW, num_its, ONdelay, OFFdelay,
 
                 # TURN ISOCRATIC PUMP OFF
                 if Iso_ON == 1:
-                    os.system("C:/Windows\Licop\LicopDemo\PumpOFF.exe")
+                    isocratic.off().result()
 
                 sys.exit()
 
@@ -466,7 +588,7 @@ def Normal_Test(startFreq, stopFreq, datapoints, BW, num_its, ONdelay, OFFdelay,
 
     # TURN ISOCRATIC PUMP OFF FOR ITS DEFAULT END STATE
     if Iso_ON == 1:
-        os.system("C:/Windows\Licop\LicopDemo\PumpOFF.exe")
+        isocratic.off().result()
 
     # Print end of test message
     print(
@@ -487,7 +609,7 @@ FREQUENCY SCAN SWEEP FUNCTION
 # TODO Fix problem with EndOfScan bit for automatic mode
 def Freq_sweep(datapoints, BW, directory, powersweep, rpower, ONdelay, OFFdelay, startfreq, stopfreq,
                stepfreq, IsManu, Peris_ON, RPM, Iso_ON, IsLog):
-    # MANUAL MODE
+    # MANUAL MODE (IsManu = 1) AND LIST MODE (IsManu = 2)
     if IsManu:
         print("------------------MANUAL SWEEP TEST------------------\n")
         time.sleep(2)
@@ -628,7 +750,7 @@ def Freq_sweep(datapoints, BW, directory, powersweep, rpower, ONdelay, OFFdelay,
         if Iso_ON == 1:
             sg.popup(
                 "Please wait 40 seconds for isocratic pump to initialise. Once done, enter desired flow speed in command prompt. Press Okay to continue")
-            os.system("C:/Windows\Licop\LicopDemo\PumpSTANDBY.exe")
+            isocratic.standby()
             # window.findElement('_SWEEP_FRAME_').update(Visible=True)
 
         currentfreqKHz = startfreqKHz
@@ -675,9 +797,30 @@ def Freq_sweep(datapoints, BW, directory, powersweep, rpower, ONdelay, OFFdelay,
         # Turn isocratic pump ON (if Iso_ON = 1)
         if Iso_ON == 1:
             window.find_element('_SWEEP8_').update(text_color='red')
-            os.system("C:/Windows\Licop\LicopDemo\PumpON.exe")
+            isocratic.on()
+
+        # ------------- LIST MODE: WHOLE FREQUENCY PLAN, ALL TRACES IN ONE RUN STORE -------------#
+        if IsManu == 2:
+            window.find_element('_SWEEP3_').update(text_color='black')
+            window.find_element('_SWEEP5_').update(text_color='red')
+
+            Plan = frequency_plan(startfreq, stopfreq, stepfreq)
+            SweepTime = str(datetime.datetime.now(pytz.timezone('America/Moncton'))).replace(":", ".")
+            SweepStore = S11Store("D:\Ablation_Automatisation\Programmation\Automatisation_Andre\DonneesBrutes/" + directory + " " + SweepTime,
+                                  datapoints, len(Plan))
+            SweepStore.set_frequencies(fetch_frequencies(analyzer))
+            Sweep = ListSweep(Plan, SweepStore)
+
+            # Same reflected power check as the manual mode (only with the automatic limit)
+            Sweep.run(analyzer, client, ONdelay, OFFdelay, auto_rpower if rpower == 0 else None,
+                      progress=lambda step, steps: sg.OneLineProgressMeter('Test progress...', 2 * step + 2, 2 * num_its + 4,
+                                                                           key='METER1', grab_anywhere=True))
+            print(str(Sweep.completed) + " of " + str(len(Plan)) + " frequencies swept\n")
 
-        while currentfreqKHz <= stopfreqKHz:
+            if Sweep.aborted is not None:
+                sg.popup("The reflected power is too high.\n" + Sweep.aborted + "\nThe sweep was stopped.")
+
+        while IsManu == 1 and currentfreqKHz <= stopfreqKHz:
 
             # ------------- STATE II - MICROWAVE EMISSION -------------#
             # Update next step text color on GUI window
@@ -725,8 +868,8 @@ def Freq_sweep(datapoints, BW, directory, powersweep, rpower, ONdelay, OFFdelay,
 
             # CHECK IF REFLECTED POWER VALUE READ IS GREATER THEN 30% OF TRANSMITTED POWER.
             rr = client.read_holding_registers(103, 1, unit=UNIT)
-            rr_rpower = str(rr.registers)
-            if (int(rr_rpower[1]) > auto_rpower and rpower == 0) or (int(rr_rpower[1:2]) > auto_rpower and rpower == 0):
+            rr_rpower = rr.registers[0]
+            if rr_rpower > auto_rpower and rpower == 0:
                 sg.popup(
                     "The reflected power is too high.\n The code will shutdown automatically.\n Rerun the code if you desire retrying the test.")
                 # TURN MICROWAVES OFF
@@ -745,7 +888,7 @@ def Freq_sweep(datapoints, BW, directory, powersweep, rpower, ONdelay, OFFdelay,
 
                 # TURN ISOCRATIC PUMP OFF
                 if Iso_ON == 1:
-                    os.system("C:/Windows\Licop\LicopDemo\PumpOFF.exe")
+                    isocratic.off().result()
                 sys.exit()
 
             # TURN MICROWAVE OFF
@@ -820,7 +963,7 @@ def Freq_sweep(datapoints, BW, directory, powersweep, rpower, ONdelay, OFFdelay,
 
         # TURN ISOCRATIC PUMP OFF FOR ITS DEFAULT END STATE
         if Iso_ON == 1:
-            os.system("C:/Windows\Licop\LicopDemo\PumpOFF.exe")
+            isocratic.off().result()
 
         # Update next step text color on GUI window
         time.sleep(2)
@@ -887,44 +1030,35 @@ def Freq_sweep(datapoints, BW, directory, powersweep, rpower, ONdelay, OFFdelay,
         """
         """
 
-        while True:
-            rr = client.read_holding_registers(105, 1, unit=UNIT)
-            rq = rr.registers
-            print("End of scan response is: " + str(rq))
-            time.sleep(2)
-
-            """
-            rr = client.read_holding_registers(113, 1, unit=UNIT)
-            rq = rr.registers
-            print("Currrent scan frequency is:" + str(rq))         
-            """
-
-            if rq[0] == 160 or rq[0] == 32 or rq[0] == 224:
-                print("The scan is complete! Processing data\n")
-                break
-
-        # ACTIVATE SCAN DATA MODE - SET SCAN DATA BIT TO 1
-        client.write_register(17, 0x04, unit=UNIT)
-
-        while True:
-            rr = client.read_holding_registers(109, 1, unit=UNIT)
-            rq = rr.registers
-            print(rq)
-            time.sleep(5)
-            if rq[0] == 0:
-                rr = client.read_holding_registers(114, 1, unit=UNIT)
-                rq = rr.registers
-                print("Scanned frequency minimum 1 data:\n " + str(rq) + "\n")
-
-                rr = client.read_holding_registers(115, 1, unit=UNIT)
-                rq = rr.registers
-                print("Scanned frequency minimum 1 data:\n " + str(rq) + "\n")
-
-                rr = client.read_holding_registers(113, 1, unit=UNIT)
-                rq = rr.registers
-                print("Scanned frequency register:\n " + str(rq) + "\n")
-                time.sleep(0.1)
-                break
+        # WAIT FOR THE END OF SCAN AND ITS DATA (REG 105 SCAN COMPLETE BIT, THEN REG 109 = 0)
+        # Polling adapts to the expected scan duration, the profile is read during the scan
+        monitor = ScanMonitor(client)
+        Chosen = None
+        try:
+            Scan = monitor.watch(monitor.expected_duration(startfreqKHz, stopfreqKHz, stepfreqKHz)).result()
+
+            print("The scan is complete! (" + str(round(Scan.duration, 2)) + " s, " + str(Scan.polls) + " reads)\n")
+            print("Scanned frequency minimum:\n " + str(Scan.min_frequency) + " MHz\n")
+            print("Reflected power at the minimum:\n " + str(Scan.min_reflected) + " W\n")
+            print("Transmitted power at the minimum:\n " + str(Scan.min_forward) + " W\n")
+
+            # FULL SCAN RECORD (REGS 110, 200...): REFLECTED POWER VS FREQUENCY AND RESONANCES
+            Record = read_scan_record(client, powersweep)
+            Record.save("D:\Ablation_Automatisation\Programmation\Automatisation_Andre\DonneesBrutes/" + directory + " scan.csv")
+            Resonances = Record.resonances()
+            print(str(len(Record)) + " scanned frequencies, " + str(len(Resonances)) + " resonance(s)\n")
+            for Res in Resonances:
+                print("     " + str(round(Res.frequency, 2)) + " MHz: " + str(Res.reflected) + " W reflected, bandwidth " +
+                      str(round(Res.bandwidth, 2)) + " MHz, Q = " + str(round(Res.q, 1)) + "\n")
+
+            # WORKING FREQUENCY OF THE NEXT ABLATION = DEEPEST RESONANCE (REG 9)
+            if len(Resonances) > 0:
+                Chosen = apply_frequency(client, Resonances[0].frequency)
+                print("Generator frequency set to the resonance:\n " + str(Chosen) + " MHz\n")
+
+        # ScanError (scan not complete) or Modbus / file error on the result: the generator is still turned OFF below
+        except IOError as e:
+            print("The scan did not complete: " + str(e) + "\n")
 
         # Turn generator OFF for its default end state
         # Place switch in position I (A-B) for its default end state
@@ -935,6 +1069,8 @@ def Freq_sweep(datapoints, BW, directory, powersweep, rpower, ONdelay, OFFdelay,
         client.close()
         print("The Sairem automatic frequency sweep test is complete!\n\n")
 
+        return Chosen
+
 
 """
 MANUAL GENERATOR ON FUNCTION
@@ -945,32 +1081,21 @@ def Manual_Gen_ON(power_man, rpower):
     # rb.switchon(switch2)
     # rb.switchoff(switch1)
 
-    # TIMEOUT (30 seconds)
-    client.write_register(98, 3000, unit=UNIT)
+    generator.refresh()
 
+    # TIMEOUT (300 seconds)
     # SET FREQUENCY
-    freq = 24500
-    client.write_register(9, freq, unit=UNIT)
-
-    # REFLECTED POWER LIMITATION MODE - ON
-    client.write_register(2, 0x10, unit=UNIT)
-
     # REFLECTED POWER SET
     # Value = 30% of transmitted power OR Manual selected value (See generator user manual for more details, cabinet 18, room 455, IARC)
+    # TRANSMITTED POWER SET
+    freq = 24500
     auto_rpower = 0.25 * power_man
-    if int(rpower) != 0:
-        client.write_register(1, int(rpower), unit=UNIT)
-        rr = client.read_holding_registers(1, 1, unit=UNIT)
-        rr1 = rr.registers
-        print("Reflected power set to " + str(rr1) + " W \n")
-    else:
-        client.write_register(1, int(auto_rpower), unit=UNIT)
-        rr = client.read_holding_registers(1, 1, unit=UNIT)
-        rr1 = rr.registers
-        print("Reflected power set to " + str(rr1) + " W \n")
+    Setpoints = generator.setpoints(timeout=3000, frequency=freq,
+                                    rpower=int(rpower) if int(rpower) != 0 else int(auto_rpower), power=power_man)
+    print("Reflected power set to " + str(Setpoints['rpower']) + " W \n")
 
-    # TRANSMITTED POWER SET
-    client.write_register(0, power_man, unit=UNIT)
+    # REFLECTED POWER LIMITATION MODE - ON
+    client.write_register(2, 0x10, unit=UNIT)
 
     # GENERATOR ON
     client.write_register(2, 0x50, unit=UNIT)
@@ -1087,7 +1212,7 @@ def Manual_Pumps(Manu_Pumps_State, RPM, Manu_Iso_ON, Manu_Peris_ON, voltageOutpu
     if Manu_Pumps_State == 1:
         # sg.popup("Please wait 40 seconds for isocratic pump to initialise. Once done, enter desired flow speed in command prompt. Press Okay to continue")
         # os.system("C:/Windows\Licop\LicopDemo\PumpSTANDBY.exe")
-        os.system("C:/Windows\Licop\LicopDemo\PumpON.exe")
+        isocratic.on()
         if Manu_Peris_ON == 1:
             window.find_element('_ALCOHOLON_').update(text_color='red')
             window.find_element('_ALCOHOLOFF_').update(text_color='black')
@@ -1127,7 +1252,7 @@ def Manual_Pumps(Manu_Pumps_State, RPM, Manu_Iso_ON, Manu_Peris_ON, voltageOutpu
 
     # ISOCRATIC PUMP OFF
     if Manu_Pumps_State == 2:
-        os.system("C:/Windows\Licop\LicopDemo\PumpSTANDBY.exe")
+        isocratic.standby()
         if Manu_Peris_ON == 1:
             window.find_element('_ALCOHOLON_').update(text_color='black')
             window.find_element('_ALCOHOLOFF_').update(text_color='red')
@@ -1185,19 +1310,102 @@ def Reset_Faults():
     sg.popup("Fault reseted")
 
 
+"""
+REFERENCE NOISE MEASUREMENT FUNCTION
+"""
+# rms |S11| noise of the probe at the IF bandwidth ifbw, from repeated sweeps of the channel 1 setup (probe on a stable
+# load, microwaves OFF). Reference of the segmented sweep planner (sweep_planner.py)
+def Measure_Reference_Noise(ifbw, repetitions=10):
+    analyzer.write("SENS1:BAND " + str(ifbw))
+    analyzer.write("TRIGger:SCOPe CURRent")
+
+    traces = []
+    for n in range(repetitions):
+        analyzer.write("SENS1:SWE:MODE SINGLE")
+        analyzer.write("INITiate1:IMMediate")
+        analyzer.query("*OPC?")
+        traces.append(fetch_trace(analyzer))
+
+    analyzer.write("SENS1:SWE:MODE HOLD")
+    return noise_from_traces(traces, ifbw)
+
+
+"""
+PROBE CALIBRATION FUNCTION
+"""
+# Air / short / water references of PROBE_ID measured on the frequency plan of the five iteration test (span and points,
+# or the segments of the sweep plan) and saved in the calibration cache under CALIBRATION_TEMPERATURE and the IF bandwidth
+def Probe_Calibration(startFreq, stopFreq, datapoints, BW, IsLog, SweepPlan):
+    analyzer.write("SENS1:SWE:POIN " + str(datapoints))
+    analyzer.write("SENS1:FREQ:START " + str(startFreq * 1000000))
+    analyzer.write("SENS1:FREQ:STOP " + str(stopFreq * 1000000))
+    analyzer.write("SENS1:BAND " + str(BW))
+    analyzer.write("SENS1:SWEep:TYPE " + ("LOG" if IsLog == 1 else "LIN"))
+    if SweepPlan is not None:
+        SweepPlan.apply(analyzer, 1)
+
+    def Reference_Prompt(reference):
+        return sg.popup_ok_cancel("Probe " + PROBE_ID + ": place the probe in " + reference +
+                                  " (microwaves OFF) and press OK") == 'OK'
+
+    return calibrate(calibrations, analyzer, PROBE_ID, float(BW), CALIBRATION_TEMPERATURE, Reference_Prompt)
+
+
+"""
+NUMBER OF POINTS OF THE FIVE ITERATION TEST
+"""
+# Segment table of the sweep plan when one is loaded, otherwise the points of the full span (shared with the other tests)
+def Test_Datapoints(value_dict):
+    if value_dict["sweepplan"] is not None:
+        return value_dict["sweepplan"].points
+    return value_dict["datapoints"][0]
+
+
+"""
+SAFETY INTERLOCK STOP FUNCTION
+"""
+# Microwaves already turned OFF by the interlock thread, and kept OFF until interlock.reset()
+def Interlock_Stop(TextFile, Iso_ON):
+    Trip = interlock.last_trip()
+    TextFile.write("\nSafety interlock: " + Trip.message + "\n")
+
+    # PUT ISOCRATIC PUMP IN STANDBY
+    PumpMessage = Pump_Standby(TextFile) if Iso_ON == 1 else ""
+    TextFile.close()
+
+    sg.popup("Safety interlock:\n" + Trip.message + "\nThe generator has shutdown automatically.\nData can still be retrieved" + PumpMessage)
+    return 1
+
+
+"""
+ISOCRATIC PUMP STANDBY FUNCTION
+"""
+# Standby when the five iteration test stops, waited for: a failed command is written in the log and returned as a
+# line of the stop popup (the pump may still be flowing)
+def Pump_Standby(TextFile):
+    try:
+        isocratic.standby().result(COMMAND_TIMEOUT)
+    except Exception as e:
+        print("Isocratic pump standby failed: " + repr(e) + "\n")
+        TextFile.write("\nIsocratic pump standby failed: " + repr(e) + "\n")
+        return "\nThe isocratic pump could not be put in standby (" + str(e) + "): stop it manually."
+    return ""
+
+
 """
 FIVE ITERATION TEST FUNCTION
 """
 def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimicro, delaimesure, voltageOutput0, voltageOutput1, power, ONdelay, Flow,
                         freq, rpower, i, Peris_ON, RPM, Iso_ON, IsLog, LogFileName, DonneesTemps, rpowergraph, powergraph, Dielec_Verif, min_dielec_value,
-                        Timer_ON):
+                        Timer_ON, RunStore, DualPort, RunStore2, SweepPlan, Pipeline, Trend, Scheduler, Permittivity, num_its=5):
 
     filename = directory
 
-    num_its = 5
-
     auto_rpower = 0.5 * power
 
+    # SWEEP OF THE PROBE(S), TRACES IN THE RUN STORES AND .S1P FILES (ablation_cycle.Measurement)
+    Measure = Measurement(analyzer, filename, RunStore, DualPort, RunStore2, Pipeline, Permittivity)
+
     if i == 1:
 
         """
@@ -1309,18 +1517,55 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
         print("D: drive folder created \n")
         TextFile.write("D: drive folder created under the name " + str(filename) + "\n\n")
 
+        # SECOND PROBE ON PORT 2 (S22), SWEPT BY THE SAME TRIGGER AS PORT 1
+        if DualPort is not None:
+            DualPort.configure(startFreqHz, stopFreqHz, datapoints, BW, IsLog, delaimesure)
+            print("Channel 2 (S22) configured. Both probes are measured in the same trigger, one after the other: the sweep takes " + str(2 * delaimesure) + " seconds\n")
+            TextFile.write("Channel 2 (S22) configured. Both probes are measured in the same trigger, one after the other: the sweep takes " + str(2 * delaimesure) + " seconds\n\n")
+
+        # SEGMENTED SWEEP: ONLY THE BANDS OF INTEREST, IF BANDWIDTH PICKED PER BAND FOR THE TARGET NOISE
+        if SweepPlan is not None:
+            SweepPlan.apply(analyzer, 1)
+            if DualPort is not None:
+                SweepPlan.apply(analyzer, 2)
+            print("Segmented sweep loaded:\n" + SweepPlan.summary() + "\n")
+            TextFile.write("Segmented sweep loaded:\n" + SweepPlan.summary() + "\n")
+            SweepTime = SweepPlan.measured_sweep_time(analyzer)
+            TextFile.write("Sweep time computed by the ENA: " + str(SweepTime) + " seconds\n\n")
+            if not SweepPlan.fits(delaimesure, SweepTime):
+                print("Warning: the sweep takes " + str(SweepTime) + " seconds, longer than the " + str(delaimesure) + " seconds OFF delay\n")
+                TextFile.write("Warning: the sweep takes " + str(SweepTime) + " seconds, longer than the " + str(delaimesure) + " seconds OFF delay\n\n")
+
+        # SAVE THE FREQUENCY AXIS OF THE RUN STORE (iteration x frequency S11 memory map)
+        RunStore.set_frequencies(fetch_frequencies(analyzer))
+        TextFile.write("S11 run store created in " + str(RunStore.path) + "\n\n")
+
+        if DualPort is not None:
+            RunStore2.set_frequencies(fetch_frequencies(analyzer, 2))
+
+        # CALIBRATION OF THE PROBE ON THE FREQUENCY AXIS OF THE RUN, SAVED WITH THE TRACES
+        Permittivity.calibration = calibrations.lookup(PROBE_ID, RunStore.frequencies, CALIBRATION_TEMPERATURE, float(BW))
+        if Permittivity.calibration is not None:
+            write_calibration(os.path.join(RunStore.path, RUN_CALIBRATION_FILE), Permittivity.calibration)
+            TextFile.write("Calibration of probe " + PROBE_ID + " loaded, permittivity computed at every measure\n\n")
+        else:
+            print("No calibration of probe " + PROBE_ID + " for this frequency plan: permittivity not computed\n")
+            TextFile.write("No calibration of probe " + PROBE_ID + " for this frequency plan: permittivity not computed\n\n")
+
         """
         2. GENERATOR SET
         """
-        # TIMEOUT
-        client.write_register(98, 3000, unit=UNIT)
-        print("Generator Timeout set to 300 seconds\n")
-        TextFile.write("\n\n----------GENERATOR INIT------------\n\n")
-        TextFile.write("\nGenerator Timeout set to 300 seconds\n\n")
+        # GENERATOR SETPOINTS AS THEY ARE NOW (the steps only write the ones that change)
+        generator.refresh()
 
+        # TIMEOUT: SET AND KEPT ALIVE BY keepalive FOR THE WHOLE TEST
         # FREQUENCY SET
         freq_KHz = freq * 10
-        client.write_register(9, freq_KHz, unit=UNIT)
+        generator.setpoints(frequency=freq_KHz)
+        print("Generator Timeout set to " + str(keepalive.timeout) + " seconds (kept alive)\n")
+        TextFile.write("\n\n----------GENERATOR INIT------------\n\n")
+        TextFile.write("\nGenerator Timeout set to " + str(keepalive.timeout) + " seconds (kept alive)\n\n")
+
         print("Generator frequency is set to :\n" + str(freq) + " MHz\n")
         TextFile.write("Generator frequency is set to :\n" + str(freq) + " MHz\n\n")
 
@@ -1367,10 +1612,14 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
         # IMPORTANT: WAIT 40 ms for switch to stabilise electrical signal received from ENA (see switch datasheet for more details)
         # time.sleep(0.04)
 
-        analyzer.write("SENS1:SWE:MODE SINGLE")
-        analyzer.write("TRIGger:SCOPe CURRent")
-        analyzer.write("INITiate1:IMMediate")
-        time.sleep(delaimesure)
+        if DualPort is not None:
+            DualPort.acquire()
+
+        else:
+            analyzer.write("SENS1:SWE:MODE SINGLE")
+            analyzer.write("TRIGger:SCOPe CURRent")
+            analyzer.write("INITiate1:IMMediate")
+            time.sleep(delaimesure)
 
         # PLACE SWITCH IN POSITION II (50 Ohm terminator)
         # rb.switchon(switch2)
@@ -1395,83 +1644,87 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
             print("\nITERATION " + str(i - 1) + "\n")
             TextFile.write("\n\nITERATION " + str(i - 1) + "\n\n")
 
-            # Turn isocratic pump ON with flow at 1 ml/min
-            if Iso_ON == 1 and Flow == 0:
-                window.find_element('_FIVEIT8_').update(text_color='black')
-                os.system("C:/Windows\Licop\LicopDemo\PumpON_Flow0.exe")
-
-            # Turn isocratic pump ON with flow at 1 ml/min
-            if Iso_ON == 1 and Flow == 1:
-                window.find_element('_FIVEIT8_').update(text_color='red')
-                os.system("C:/Windows\Licop\LicopDemo\PumpON_Flow1.exe")
-                TextFile.write("\n Pump Turned ON with flow of 1 ml/min\n\n")
-
-            # Turn isocratic pump ON with flow at 2 ml/min
-            elif Iso_ON == 1 and Flow == 2:
-                window.find_element('_FIVEIT8_').update(text_color='red')
-                os.system("C:/Windows\Licop\LicopDemo\PumpON_Flow2.exe")
-                TextFile.write("\n Pump Turned ON with flow of 2 ml/min\n\n")
-
-            # Turn isocratic pump ON with flow at 1 ml/min
-            if Iso_ON == 1 and Flow == 2.5:
-                window.find_element('_FIVEIT8_').update(text_color='red')
-                os.system("C:/Windows\Licop\LicopDemo\PumpON_Flow2.5.exe")
-                TextFile.write("\n Pump Turned ON with flow of 2.5 ml/min\n\n")
-
-            # Turn isocratic pump ON with flow at 3 ml/min
-            elif Iso_ON == 1 and Flow == 3:
-                window.find_element('_FIVEIT8_').update(text_color='red')
-                os.system("C:/Windows\Licop\LicopDemo\PumpON_Flow3.exe")
-                TextFile.write("\n Pump Turned ON with flow of 3 ml/min\n\n")
-
-
-            # Turn isocratic pump ON with flow at 4 ml/min
-            elif Iso_ON == 1 and Flow == 4:
-                window.find_element('_FIVEIT8_').update(text_color='red')
-                os.system("C:/Windows\Licop\LicopDemo\PumpON_Flow4.exe")
-                TextFile.write("\n Pump Turned ON with flow of 4 ml/min\n\n")
-
-
-            # Turn isocratic pump ON with flow at 5 ml/min
-            elif Iso_ON == 1 and Flow == 5:
-                window.find_element('_FIVEIT8_').update(text_color='red')
-                os.system("C:/Windows\Licop\LicopDemo\PumpON_Flow5.exe")
-                TextFile.write("\n Pump Turned ON with flow of 5 ml/min\n\n")
-
-
-            # Turn isocratic pump ON with flow at 10 ml/min
-            elif Iso_ON == 1 and Flow == 10:
-                window.find_element('_FIVEIT8_').update(text_color='red')
-                os.system("C:/Windows\Licop\LicopDemo\PumpON_Flow10.exe")
-                TextFile.write("\n Pump Turned ON with flow of 10 ml/min\n\n")
+            # Turn isocratic pump ON with the flow of the step (None = pump left as it is)
+            # No microwaves until the pump has taken the flow: a failed command stops the test
+            if Iso_ON == 1 and Flow is not None:
+                try:
+                    isocratic.run(Flow).result(COMMAND_TIMEOUT)
+                except Exception as e:
+                    client.write_register(2, 0x00, unit=UNIT)
+                    print("Isocratic pump did not start with a flow of " + str(Flow) + " ml/min: " + repr(e) + "\n")
+                    TextFile.write("\nIsocratic pump did not start with a flow of " + str(Flow) + " ml/min: " + repr(e) + "\n")
+                    PumpMessage = Pump_Standby(TextFile)
+                    TextFile.close()
+                    sg.popup("The isocratic pump did not start with a flow of " + str(Flow) + " ml/min:\n" + str(e) +
+                             "\nThe microwaves stay OFF.\nData can still be retrieved" + PumpMessage)
+                    return 1
+                if Flow == 0:
+                    window.find_element('_FIVEIT8_').update(text_color='black')
+                else:
+                    window.find_element('_FIVEIT8_').update(text_color='red')
+                    TextFile.write("\n Pump Turned ON with flow of " + str(Flow) + " ml/min\n\n")
 
 
             # REFLECTED POWER SET
             # Value = 50% of transmitted power OR Manual selected value (See generator user manual for more details, cabinet 18, room 455, IARC)
+            # TRANSMITTED POWER SET
+            # Same values as the previous step: nothing is written
+            Setpoints = generator.setpoints(rpower=int(rpower) if int(rpower) != 0 else int(auto_rpower), power=int(power))
             if int(rpower) != 0:
-                client.write_register(1, int(rpower), unit=UNIT)
-                rr = client.read_holding_registers(1, 1, unit=UNIT)
-                rr1 = rr.registers
-                print("     Reflected power set to " + str(rr1) + " W \n")
-                TextFile.write("    Reflected power set to " + str(rr1) + " W \n")
+                print("     Reflected power set to " + str(Setpoints['rpower']) + " W \n")
+                TextFile.write("    Reflected power set to " + str(Setpoints['rpower']) + " W \n")
 
             else:
-                client.write_register(1, int(auto_rpower), unit=UNIT)
-                rr = client.read_holding_registers(1, 1, unit=UNIT)
-                rr1 = rr.registers
-                print("      Max reflected power set to " + str(rr1) + " W \n")
-                TextFile.write("     Max reflected power set to " + str(rr1) + " W \n")
+                print("      Max reflected power set to " + str(Setpoints['rpower']) + " W \n")
+                TextFile.write("     Max reflected power set to " + str(Setpoints['rpower']) + " W \n")
 
-            # TRANSMITTED POWER SET
-            client.write_register(0, int(power), unit=UNIT)
             print("      Microwave output power set to: \n     " + str(power) + " Watts\n")
             TextFile.write("     Microwave output power set to: \n     " + str(power) + " Watts\n")
 
             TempsTot = 0
-            break_ON = 0
+
+            # GUI OF THE CYCLE (ablation_cycle.run_cycle)
+            def Cycle_Phase(name):
+                # Update next step text color on GUI window
+                if name == "OFF":
+                    window.find_element('_FIVEIT3_').update(text_color='black')
+                    window.find_element('_FIVEIT5_').update(text_color='black')
+                    window.find_element('_FIVEIT6_').update(text_color='red')
+                else:
+                    window.find_element('_FIVEIT5_').update(text_color='red')
+                    window.find_element('_FIVEIT6_').update(text_color='black')
+                sg.OneLineProgressMeter('Test progress...', i + 1, num_its + 4, key='METER1', grab_anywhere=True)
+
+            def Cycle_Log(line):
+                print("     " + line)
+                TextFile.write("      " + line + "\n")
+
+            # PREDICTIVE EARLY STOP: ONLY IN A STEP WITH A DIELECTRIC STOP. The trend keeps the samples of the
+            # previous steps with the same target, it restarts when the target changes.
+            Predictive = Trend is not None and Dielec_Verif == 1
+            if Predictive:
+                Trend.start(min_dielec_value)
+
+            # ON DELAY OF THE CYCLE: ADAPTIVE (longer while S11 is stable), CAPPED BY THE DIELECTRIC TARGET FORECAST
+            # AND BY THE TIME LEFT IN THE STEP
+            def Cycle_On_Delay(trace, acquired):
+                # TREND OF THE STOP MARGIN, EACH SAMPLE AT THE END OF THE SWEEP OF ITS TRACE
+                if Predictive:
+                    Trend.update(acquired, lookup_table(len(trace)).margin(trace, min_dielec_value))
+
+                OnDelay = delaimicro
+                if Scheduler is not None:
+                    OnDelay = Scheduler.update(trace)
+                if Predictive:
+                    OnDelay = next_on_delay(Trend.time_to(0.0, now=time.monotonic()), OnDelay, MIN_ON_DELAY)
+                if Scheduler is not None or Predictive:
+                    OnDelay = min(OnDelay, max(ONdelay - TempsTot - delaimesure, MIN_ON_DELAY))
+                return OnDelay
 
             while TempsTot < float(ONdelay - (delaimesure + delaimicro)):
 
+                TRACER.begin("Cycle " + str(len(DonneesTemps) + 1))
+
                 # Ouvrir fichier text pour sauvegarder le log des opérations entre chaque mesure
                 TextFile = open("D:\Ablation_Automatisation\Programmation\Automatisation_Andre\Logs/" + str(LogFileName) + ".txt","a")
 
@@ -1483,168 +1736,45 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
                 DonneesTemps.append(timenow1)
 
 
-                # ------------- STATE I - DIELECTRIC MEASUREMENT -------------#
+                # ------------- OFF / MEASURE / ON CYCLE (ablation_cycle.py) -------------#
+                CycleResult = run_cycle(client, Measure, len(DonneesTemps), delaimesure, Cycle_On_Delay, UNIT, interlock,
+                                        auto_rpower if rpower == 0 else None, min_dielec_value if Dielec_Verif == 1 else None,
+                                        Cycle_Phase, Cycle_Log)
 
-                # Update next step text color on GUI window
-                window.find_element('_FIVEIT3_').update(text_color='black')
-                window.find_element('_FIVEIT5_').update(text_color='black')
-                window.find_element('_FIVEIT6_').update(text_color='red')
-                sg.OneLineProgressMeter('Test progress...', i + 1, num_its + 4, key='METER1', grab_anywhere=True)
-
-                # CHECK IF REFLECTED POWER VALUE READ IS GREATER THEN 50% OF TRANSMITTED POWER WHEN RPOWER IS AUTOMATICALLY CONFIGURED
-                rr = client.read_holding_registers(103, 1, unit=UNIT)
-                rr_rpower = rr.registers
-                if int(rr_rpower[0]) > auto_rpower and rpower == 0 :
-                    # TURN MICROWAVES OFF
-                    client.write_register(2, 0x00, unit=UNIT)
-
-                    # PLACE SWITCH IN POSITION I
-                    # rb.switchon(switch1)
-                    # rb.switchoff(switch2)
-
-                    # TURN PERISTALTIC MOTOR OFF
-                    # if Peris_ON == 1:
-
-                        # voltageOutput0.setDeviceSerialNumber(589734)
-                        # voltageOutput0.setChannel(0)
-                        # voltageOutput1.setDeviceSerialNumber(589734)
-                        # voltageOutput1.setChannel(1)
-
-                        # voltageOutput0.openWaitForAttachment(1000)
-                        # voltageOutput1.openWaitForAttachment(1000)
-
-            
-                        # SET RPM SPEED AND TURN ON PUMP
-                        # CH1 = SPEED CONTROL CONFIG
-                        # CH0 = TURN PERISTALTIC PUMP OFF
-                        # voltageOutput0.setVoltage(5)
-                        # voltageOutput1.setVoltage(0)
-
-                        # print("Peristaltic pump turned OFF\n")
+                # SAFETY INTERLOCK: MICROWAVES TURNED OFF BY THE INTERLOCK THREAD
+                if CycleResult.status == STOP_INTERLOCK:
+                    return Interlock_Stop(TextFile, Iso_ON)
 
+                # REFLECTED POWER TOO HIGH, TRANSMITTED POWER NOT AT 0 AFTER OFF OR TRACE NOT SAVED: MICROWAVES OFF
+                if CycleResult.stopped:
                     # TURN ISOCRATIC PUMP OFF
-                    if Iso_ON == 1:
-                        os.system("C:/Windows\Licop\LicopDemo\PumpSTANDBY.exe")
-                    
-                    sg.popup("The reflected power is too high.\nThe generator has shutdown automatically.\nCooling pump will continue to flow.\nData can still be retrieved")
-                    return 1
-
-                # MICROWAVES OFF
-                # Place switch in position I (AB , Dielectric measurement)
-                client.write_register(2, 0x00, unit=UNIT)
-                # rb.switchon(switch1)
-                # rb.switchoff(switch2)
-
-                # Delai rise and fall 
-                time.sleep(0.001)
-
-                rr = client.read_holding_registers(102, 1, unit=UNIT)
-                rr2 = rr.registers
-
-                # Sortir de la boucle si la puissance transmise actuelle n'est pas mesurer a une valeur de 0 Watts
-                if rr2[0] != 0:
-                    # TURN MICROWAVES OFF
-                    client.write_register(2, 0x00, unit=UNIT)
-                    # PLACE SWITCH IN POSITION I
-                    # rb.switchon(switch1)
-                    # rb.switchoff(switch2)
-
-                    # TURN PERISTALTIC MOTOR OFF
-                    # if Peris_ON == 1:
-
-                        # voltageOutput0.setDeviceSerialNumber(589734)
-                        # voltageOutput0.setChannel(0)
-                        # voltageOutput1.setDeviceSerialNumber(589734)
-                        # voltageOutput1.setChannel(1)
-
-                        # voltageOutput0.openWaitForAttachment(1000)
-                        # voltageOutput1.openWaitForAttachment(1000)
-
-            
-                        # SET RPM SPEED AND TURN ON PUMP
-                        # CH1 = SPEED CONTROL CONFIG
-                        # CH0 = TURN PERISTALTIC PUMP OFF
-                        # voltageOutput0.setVoltage(5)
-                        # voltageOutput1.setVoltage(0)
-
-                        # print("Peristaltic pump turned OFF\n")
-
-                    # TURN ISOCRATIC PUMP OFF
-                    if Iso_ON == 1:
-                        os.system("C:/Windows\Licop\LicopDemo\PumpSTANDBY.exe")
-
-                    sg.popup("Power is not at 0 when it should be.\nThe generator has shutdown automatically.\nCooling pump will continue to flow.\nData can still be retrieved")
+                    PumpMessage = Pump_Standby(TextFile) if Iso_ON == 1 else ""
 
+                    sg.popup(CycleResult.message + ".\nThe generator has shutdown automatically.\nCooling pump will continue to flow.\nData can still be retrieved" + PumpMessage)
                     return 1
 
-                # IMPORTANT: WAIT 40 ms for switch to stabilise electrical signal received from ENA (see switch datasheet for more details)
-                # time.sleep(0.04)
-
-                print("     Microwaves OFF for " + str(delaimesure) + " seconds")
-                TextFile.write("\n      Microwaves OFF for " + str(delaimesure) + " seconds")
-                # print("     Switch in position I (Dielectric measurement)\n")
-                # TextFile.write("\n      Switch in position I (Dielectric measurement)\n")
-
-                # TAKE MEASUREMENT AND SAVE FILE OF PORT 1 AS A .CSV (REAL IMAGINARY DATA FORMAT)
-                analyzer.write("SENS1:SWE:MODE SINGLE")
-                analyzer.write("TRIGger:SCOPe CURRent")
-                analyzer.write("INITiate1:IMMediate")
-                # analyzer.write("MMEMory:STORe:DATA '" + filename + "/Iteration" + str(i - 1) + "_" + str(j) + ".csv', 'CSV formatted Data','Trace','RI', 1")
-
-                # DELAY OF INPUT GUI VALUE SECONDS
-                time.sleep(delaimesure)
+                # VERIFIER SI LA VALEUR DIELECTRIQUE DESIREE EST ATTEINTE. Si oui, arreter test (microwaves restent OFF).
+                if CycleResult.status == TARGET_REACHED:
+                    sg.popup("Minimum dielectric value achieved.\nThe code will stop by itself and the GUI will keep running.")
+                    return 2
 
-                # TAKE MEASUREMENT AND SAVE FILE OF PORT 1 AS A .S1P (REAL IMAGINARY DATA FORMAT)
-                analyzer.write("CALC:MEAS:DATA:SNP:PORTs:Save '1,,', '" + filename + "/Iteration_" + str(len(DonneesTemps)) + ".s1p'")
-                analyzer.write("*OPC?")
-                print("     Measure triggered and saved\n")
-                TextFile.write("\n      Measure triggered and saved\n")
-
-
-
-                # ------------- STATE II - MICROWAVE ABLATION -------------#
-
-                # Update next step text color on GUI window
-                window.find_element('_FIVEIT5_').update(text_color='red')
-                window.find_element('_FIVEIT6_').update(text_color='black')
-                sg.OneLineProgressMeter('Test progress...', i + 1, num_its + 4, key='METER1', grab_anywhere=True)
-
-                # MICROWAVES ON
-                # Place switch in position II (AD , Microwave ablation)
-                # rb.switchon(switch2)
-                # rb.switchoff(switch1)
-
-                # IMPORTANT: WAIT 40 ms for switch to stabilise electrical signal received from ENA (see switch datasheet for more details)
-                # time.sleep(0.04)
-
-                client.write_register(2, 0x50, unit=UNIT)
-                # print("     Switch in position II (Microwave ablation)")
-                # TextFile.write("\n      Switch in position II (Microwave ablation)\n")
-                print("        Microwaves ON for " + str(delaimicro) + " seconds\n")
-                TextFile.write("      Microwaves ON for " + str(delaimicro) + " seconds\n")
-
-                # DELAY OF GUI INPUT VALUE SECONDS
-                time.sleep(delaimicro)
+                if len(Permittivity) > 0:
+                    TextFile.write("      Permittivity: eps' " + str(round(Permittivity.eps_prime[-1], 2)) + ", eps'' " + str(round(Permittivity.eps_second[-1], 2)) + "\n")
 
                 # Ajoutée valeurs de puissance réfléchie et transmise en temps réel à leurs listes respectivess
-                rr = client.read_holding_registers(103, 1, unit=UNIT)
-                rr1 = rr.registers
-                rpowergraph.append(rr1)
-                TextFile.write("      Reflected power measurement: " + str(rr1[0]) + " Watts\n")
+                rpowergraph.append([CycleResult.reflected])
+                powergraph.append([CycleResult.forward])
+                TextFile.write("\n")
 
-                rr = client.read_holding_registers(102, 1, unit=UNIT)
-                rr2 = rr.registers
-                powergraph.append(rr2)
-                TextFile.write("      Transmitted power measurement: " + str(rr2[0]) + " Watts\n\n")
+                # LIVE S11 AND POWER PLOT (only the new samples are drawn)
+                live_plot.update(RunStore, powergraph, rpowergraph)
+                window.refresh()
 
-                # VERIFIER SI LA VALEUR DIELECTRIQUE DESIREE EST ATTEINTE. Si oui, arreter test.
-                if Dielec_Verif == 1:
-                    break_ON = Dielec_Data_Verif(min_dielec_value, datapoints, directory)
-
-                    if break_ON == 1:
-                        return 2
-                    else:
-                        pass
+                # PREDICTIVE EARLY STOP: NEXT ON DELAY ENDS WHEN THE TARGET IS FORECAST (trend updated after the measure)
+                if Predictive:
+                    eta = Trend.time_to(0.0, now=time.monotonic())
+                    if eta is not None:
+                        TextFile.write("      Dielectric target forecast in " + str(round(eta, 2)) + " seconds\n")
 
                 # PRENDRE MESURE DE TEMPS ACTUELLE AFIN DE DÉTERMINER SI BESOIN DE SORTIR DE LA BOUCLE OU NON
                 TempsMtn = str(datetime.datetime.now(pytz.timezone('America/Moncton')))
@@ -1656,12 +1786,18 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
                 else:
                     TempsTot += (TempsMtnFloat - TempsMtnFloat1)
 
+                # END OF ON PHASE AND OF CYCLE
+                TRACER.end()
+                TRACER.end()
+
 
 
             # Si le temps une fois sortie de la boucle est plus petit que le temps de l'étape, attendre X secondes afin d'attendre que le délai de l'étape
             # soit complété.
             if TempsTot < ONdelay:
 
+                TRACER.begin("End of loop")
+
                 # Ouvrir fichier text pour sauvegarder le log des opérations entre chaque mesure
                 TextFile = open("D:\Ablation_Automatisation\Programmation\Automatisation_Andre\Logs/" + str(LogFileName) + ".txt","a")
 
@@ -1673,16 +1809,7 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
 
                 # Trigger final S11 value at the end of the loop
                 # TAKE MEASUREMENT AND SAVE FILE OF PORT 1 AS A .s1p (REAL IMAGINARY DATA FORMAT)
-                analyzer.write("SENS1:SWE:MODE SINGLE")
-                analyzer.write("TRIGger:SCOPe CURRent")
-                analyzer.write("INITiate1:IMMediate")
-
-                # DELAY OF INPUT GUI VALUE SECONDS
-                time.sleep(delaimesure)
-
-                # TAKE MEASUREMENT AND SAVE FILE OF PORT 1 AS A .S1P (REAL IMAGINARY DATA FORMAT)
-                analyzer.write("CALC:MEAS:DATA:SNP:PORTs:Save '1,,', '" + filename + "/Iteration_" + str(len(DonneesTemps)) + ".s1p'")
-                analyzer.write("*OPC?")
+                Measure.measure(len(DonneesTemps), delaimesure)
                 print("     End of loop measure triggered and saved\n")
                 TextFile.write("\n      End of loop measure triggered and saved\n\n")
 
@@ -1702,6 +1829,9 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
                     # sg.popup("At the end of the function, the generators power value could not be measured.\nPress Okay to continue. The code will continue without error. 0 will be appended to power list")
                     powergraph.append([0])
 
+                live_plot.update(RunStore, powergraph, rpowergraph)
+                window.refresh()
+
                 # Attendre pour le temps restant de l'iteration.
                 temps_restant = ONdelay - TempsTot - delaimesure
 
@@ -1711,8 +1841,12 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
                 else:
                     time.sleep(temps_restant)
 
+                TRACER.end()
+
         # ------------------------- END OF TEST, DEFAULT END STATES--------------------------------
-        if i == 6:
+        if i == num_its + 1:
+
+            TRACER.begin("End of code")
 
             TextFile = open("D:\Ablation_Automatisation\Programmation\Automatisation_Andre\Logs/" + str(LogFileName) + ".txt", "a")
 
@@ -1724,16 +1858,7 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
             DonneesTemps.append(timenow1)
 
             # TAKE MEASUREMENT AND SAVE FILE OF PORT 1 AS A .s1p (REAL IMAGINARY DATA FORMAT)
-            analyzer.write("SENS1:SWE:MODE SINGLE")
-            analyzer.write("TRIGger:SCOPe CURRent")
-            analyzer.write("INITiate1:IMMediate")
-
-            # DELAY OF INPUT GUI VALUE SECONDS
-            time.sleep(delaimesure)
-
-            # TAKE MEASUREMENT AND SAVE FILE OF PORT 1 AS A .S1P (REAL IMAGINARY DATA FORMAT)
-            analyzer.write("CALC:MEAS:DATA:SNP:PORTs:Save '1,,', '" + filename + "/Iteration_" + str(len(DonneesTemps)) + ".s1p'")
-            analyzer.write("*OPC?")
+            Measure.measure(len(DonneesTemps), delaimesure)
             print("     End of code measure triggered and saved\n")
             TextFile.write("\n      End of code measure triggered and saved\n")
 
@@ -1747,6 +1872,25 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
             powergraph.append(rr2)
             TextFile.write("      End of code transmitted power measurement: " + str(rr2[0]) + " Watts\n")
 
+            # MICROWAVES OFF, BEFORE WAITING FOR THE BACKGROUND WRITES
+            client.write_register(2, 0x00, unit=UNIT)
+
+            # Place switch in position I (AB)
+            # rb.switchon(switch1)
+            # rb.switchoff(switch2)
+
+            # EVERY TRACE ON DISK. A failed background write is reported, the end states below are still applied.
+            if Pipeline is not None:
+                try:
+                    Pipeline.drain()
+                except Exception as error:
+                    print("     A trace could not be saved: " + repr(error) + "\n")
+                    TextFile.write("\n      A trace could not be saved: " + repr(error) + "\n")
+                    sg.popup("A trace could not be saved:\n" + repr(error) + "\nThe generator is OFF, the end of the test continues.")
+            RunStore.flush()
+            if RunStore2 is not None:
+                RunStore2.flush()
+
             # Update next step text color on GUI window
             window.find_element('_FIVEIT5_').update(text_color='black')
             window.find_element('_FIVEIT6_').update(text_color='black')
@@ -1756,13 +1900,6 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
             sg.OneLineProgressMeter('Test progress...', num_its + 3, num_its + 4, key='METER1',
                                     grab_anywhere=True)
 
-            # MICROWAVES OFF
-            client.write_register(2, 0x00, unit=UNIT)
-
-            # Place switch in position I (AB)
-            # rb.switchon(switch1)
-            # rb.switchoff(switch2)
-
             # TURN PERISTALTIC PUMP OFF FOR ITS DEFAULT END STATE
             if Peris_ON == 1:
 
@@ -1785,13 +1922,15 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
 
             # PUT ISOCRATIC PUMP IN STANDBY STATE FOR ITS DEFAULT END STATE
             if Iso_ON == 1:
-                os.system("C:/Windows\Licop\LicopDemo\PumpSTANDBY1.exe")
+                isocratic.end().result()
 
             # Update next step text color on GUI window
             window.find_element('_FIVEIT7_').update(text_color='black')
             sg.OneLineProgressMeter('Test progress...', num_its + 4, num_its + 4, key='METER1',
                                     grab_anywhere=True)
 
+            TRACER.end()
+
 
             if Timer_ON == 1:
 
@@ -1810,6 +1949,8 @@ def Five_Iteration_Test(startFreq, stopFreq, datapoints, BW, directory, delaimic
             # Print end of test message
             print( "\n\n------- The test is complete! Select another test or press QUIT from the drop down menu to exit. ------- \n\n")
 
+            interlock.stop()
+            keepalive.stop()
             client.close()
             TextFile.close()
 
@@ -1892,7 +2033,7 @@ def S_Averages(directory, datapoints, DonneesTemps, ecart_type_reel, ecart_type_
 """
 EXCEL DATA FORMAT FUNCTION
 """
-def Excel_Data_Format(DonneesTemps, rpowergraph, powergraph, ecart_type_reel, ecart_type_im, directory):
+def Excel_Data_Format(DonneesTemps, rpowergraph, powergraph, ecart_type_reel, ecart_type_im, directory, Permittivity=None):
 
     # Déterminer les valeurs de temps à insérer dans le fichier Excel
     rpowergraphexcel = []
@@ -1960,9 +2101,15 @@ def Excel_Data_Format(DonneesTemps, rpowergraph, powergraph, ecart_type_reel, ec
     wb = openpyxl.load_workbook(filename='D:\Ablation_Automatisation\Programmation\Automatisation_Andre\DonneesMoyennes/' + directory + '.xlsx')
     sheet_ranges = wb[directory]
 
-    for j in range(len(DonneesTemps)):
-        reel.append(sheet_ranges['B' + str(14 + j)].value)
-        im.append(sheet_ranges['C' + str(14 + j)].value)
+    # Permittivity computed during the test (permittivity.py), otherwise the values entered in the sheet
+    if Permittivity is not None and len(Permittivity) >= len(DonneesTemps):
+        reel = Permittivity.eps_prime[:len(DonneesTemps)]
+        im = Permittivity.eps_second[:len(DonneesTemps)]
+
+    else:
+        for j in range(len(DonneesTemps)):
+            reel.append(sheet_ranges['B' + str(14 + j)].value)
+            im.append(sheet_ranges['C' + str(14 + j)].value)
 
     # Placer valeurs calculés sur le fichier excel
     sheet_ranges.cell(row=13, column=2).value = 'Temps (s)'
@@ -1990,61 +2137,6 @@ def Excel_Data_Format(DonneesTemps, rpowergraph, powergraph, ecart_type_reel, ec
     wb.save(filename='D:\Ablation_Automatisation\Programmation\Automatisation_Andre\DonneesMoyennes/' + directory + '.xlsx')
 
 
-"""
-DIELECTRIC DATA VERIFICATION FUNCTION
-"""
-# A CHANGER, VALEURS DE PARAMETRES S11 ASSOCIER AVEC PARAMETRES DIELECTRIQUES
-def Dielec_Data_Verif(dielec_value, datapoints, directory):
-
-    reel = [0] * int(datapoints)
-    count = 0
-
-    # Ouvrir fichier .s1p generer recemment et extraire valeurs dielectriques reels
-    # Open recent .s1p file and extract real dielectric values
-    S1PFile = open("D:/" + directory + "/Iteration_" + str(i) + ".s1p", "r")
-
-    
-    for __ in range(len(reel)):
-
-        if __ == 0:
-            for i in range(5):
-                DumpMeasurement = S1PFile.readline().split(' ')
-
-        Data = S1PFile.readline().split(' ')
-        reel[__] = float(Data[1])
-
-        if dielec_value == 20 and __ == 0:
-            #Valeur a changer
-            s11_value = 0.75
-
-        if dielec_value == 25 and __ == 0:
-            #Valeur a changer
-            s11_value = 0.7
-
-        if dielec_value == 30 and __ == 0:
-            #Valeur a changer
-            s11_value = 0.65
-
-        if dielec_value == 35 and __ == 0:
-            #Valeur a changer
-            s11_value = 0.6
-        
-        if reel[__] > s11_value:
-            count += 1
-    
-    count_percentage = count / datapoints
-
-    # Si au moins 25% des valeurs dielectriques sont en-dessous de la valeur desire, arrete code
-    if count_percentage >= 0.25:
-        break_code = 1
-        sg.popup("Minimum dielectric value achieved.\nThe code will stop by itself and the GUI will keep running.")
-        return break_code
-
-    else:
-        break_code = 0
-        return break_code
-    
-
 """
 MANUAL S1P AVERAGE FUNCTION
 """
@@ -2287,6 +2379,8 @@ sweep_layout = [
     [sg.Radio('Manual mode', "RADIO1", default=False, change_submits=True, key="_MANU_MODE_", font=("Helvetica", 18),
               size=(10, 1), pad=(100, 10)),
      sg.Radio('Auto mode', "RADIO1", default=False, change_submits=True, key="_AUTO_MODE_", font=("Helvetica", 18),
+              size=(10, 1), pad=(100, 10)),
+     sg.Radio('List mode', "RADIO1", default=False, change_submits=True, key="_LIST_MODE_", font=("Helvetica", 18),
               size=(10, 1), pad=(100, 10))],
     [sg.Submit(key='_CONFIG4_OK_', font=("Helvetica", 18), button_text='Configure', pad=(100, 10),
                auto_size_button=True),
@@ -2397,6 +2491,9 @@ manu_pumps_layout = [
     [sg.Cancel(key='_MANUPUMPS_CANCEL_', font=("Helvetica", 18), button_text='Return', pad=(0, 0),
                auto_size_button=True)]]
 
+# LIVE S11 AND POWER PLOT PANEL (fed by the run store of the five iteration test)
+live_plot = LivePlotPanel()
+
 # TEST - Five iteration test layout
 five_it_layout = [
     [sg.Text('Description: For this test, the power and delay durations can be changed at each iteration. An iteration can be skipped by inserting -1 in the drop down menu',
@@ -2450,6 +2547,33 @@ five_it_layout = [
               size=(15, 1)),
      sg.Radio('No', "RADIO7", default=False, change_submits=True, key="_TIMER_OFF_", font=("Helvetica", 18),
               size=(15, 1))],    
+    [sg.Text('Segment bands (MHz start:stop:points[:max IFBW]; ...)', font=("Helvetica", 18)),
+     sg.Input('', do_not_clear=True, key='_SEGMENTS_', size=(30, 10), font=("Helvetica", 18)),
+     sg.Text('Target noise (|S11| rms)', font=("Helvetica", 18)),
+     sg.Input('0.001', do_not_clear=True, key='_NOISE_', size=(10, 10), font=("Helvetica", 18))],
+    [sg.Text('Reference noise (|S11| rms, empty = measured)', font=("Helvetica", 18)),
+     sg.Input('', do_not_clear=True, key='_NOISEREF_', size=(10, 10), font=("Helvetica", 18)),
+     sg.Text('at IFBW (Hz)', font=("Helvetica", 18)),
+     sg.Input('1000', do_not_clear=True, key='_NOISEREFBW_', size=(10, 10), font=("Helvetica", 18))],
+    [sg.Text('Second probe on port 2 (S22)?', font=("Helvetica", 18)),
+     sg.Radio('Yes', "RADIO8", default=False, change_submits=True, key="_TWOPORTS_ON_", font=("Helvetica", 18),
+              size=(15, 1)),
+     sg.Radio('No', "RADIO8", default=True, change_submits=True, key="_TWOPORTS_OFF_", font=("Helvetica", 18),
+              size=(15, 1))],
+    [sg.Text('Adaptive ON delay?', font=("Helvetica", 18)),
+     sg.Radio('Yes', "RADIO9", default=False, change_submits=True, key="_ADAPTIVE_ON_", font=("Helvetica", 18),
+              size=(5, 1)),
+     sg.Radio('No', "RADIO9", default=True, change_submits=True, key="_ADAPTIVE_OFF_", font=("Helvetica", 18),
+              size=(5, 1)),
+     sg.Text('Min (s)', font=("Helvetica", 18)),
+     sg.Input('0.5', do_not_clear=True, key='_ONMIN_', size=(6, 10), font=("Helvetica", 18)),
+     sg.Text('Max (s)', font=("Helvetica", 18)),
+     sg.Input('10', do_not_clear=True, key='_ONMAX_', size=(6, 10), font=("Helvetica", 18)),
+     sg.Text('S11 change tolerance', font=("Helvetica", 18)),
+     sg.Input('0.01', do_not_clear=True, key='_ONTOL_', size=(6, 10), font=("Helvetica", 18))],
+    [sg.Text('Protocol file (replaces the 5 iterations)', font=("Helvetica", 18)),
+     sg.Input('', do_not_clear=True, key='_PROTOCOL_', size=(40, 10), font=("Helvetica", 18)),
+     sg.FileBrowse(file_types=(("Protocol", "*.json *.yaml *.yml"),), font=("Helvetica", 18))],
     [sg.Cancel(key='_FIVEIT_CANCEL_', font=("Helvetica", 18), button_text='Return', pad=(0, 0), auto_size_button=True),
      sg.Submit(key='_CONFIG5_OK_', font=("Helvetica", 18), button_text='Configure', pad=(100, 0),
                auto_size_button=True),
@@ -2459,6 +2583,8 @@ five_it_layout = [
      sg.Submit(key='_S1PAVERAGE_', font=("Helvetica", 13), button_text='S1P file average', pad=(20, 0),
                auto_size_button=True),
      sg.Submit(key='_EXCELDATA_', font=("Helvetica", 13), button_text='Excel Data', pad=(20, 0),
+               auto_size_button=True),
+     sg.Submit(key='_CALIBRATE_', font=("Helvetica", 13), button_text='Probe calibration', pad=(20, 0),
                auto_size_button=True)],
     [sg.Text("", font=("Helvetica", 10))],
     [sg.Text('TEST EXECUTIONS', font=("Helvetica", 18), text_color='green', key='_FIVEIT1_', pad=(10, 10))],
@@ -2470,7 +2596,8 @@ five_it_layout = [
     [sg.Text('Test complete', font=("Helvetica", 18), key='_FIVEIT7_', pad=(10, 0))],
     [sg.Text('PUMPS', font=("Helvetica", 14), text_color='green', pad=(0, 0))],
     [sg.Text('Alcohol/Isocratic pump ON', font=("Helvetica", 14), key='_FIVEIT8_', pad=(0, 0))],
-    [sg.Text('Cooling/Peristaltic pump ON', font=("Helvetica", 14), key='_FIVEIT9_', pad=(0, 0))]]
+    [sg.Text('Cooling/Peristaltic pump ON', font=("Helvetica", 14), key='_FIVEIT9_', pad=(0, 0))],
+    [sg.Frame('Live measurements', live_plot.layout(), font=("Helvetica", 12))]]
 
 # PROGRESS BAR LAYOUT
 progress_bar_layout = [[sg.Text('Test progress meter')],
@@ -2554,7 +2681,9 @@ def main():
                   "datapointsmanu": [], "bwmanu": [],
                   "delayENAmanu": [], "directorymanu": [], "RPM": [], "RPM1": [], "inputpower": [], "delaimicro": [],
                   "delaimesure": [], "donneestemps": [], "rpowergraph": [], "powergraph": [], "stdevreel": [], "stdevim": [],
-                  "Listbox2": [], "datapointsmanu1": [], "directorymanu1": [], "num_itsmanu": []}
+                  "Listbox2": [], "datapointsmanu1": [], "directorymanu1": [], "num_itsmanu": [], "s11store": None,
+                  "s22store": None, "dualport": None, "sweepplan": None, "pipeline": None, "trend": None,
+                  "scheduler": None, "timeline": None, "permittivity": None}
 
     # Initialise bit trigger values
     IsManu = 1
@@ -2568,6 +2697,8 @@ def main():
     Cool_Pump_ON = 0
     Dielec_Verif = 0
     Timer_ON = 0
+    Two_Ports = 0
+    Adaptive_ON = 0
 
     # Print introductory message
     print("\n\n------------------WELCOME TO THE AUTOMATION CIRCUIT V5 UI! Select OPTIONS -> CREATE to get started.------------------\n")
@@ -2679,7 +2810,7 @@ def main():
         if event == '_TEST2_OK_':
             try:
                 # sg.popup("Press OK to confirm launch. Press X to exit")
-                Freq_sweep(value_dict['datapoints'][0],
+                Chosen = Freq_sweep(value_dict['datapoints'][0],
                            value_dict['bw'][0], value_dict['directory'][0], value_dict['power1'][0],
                            value_dict['rpower1'][0],
                            value_dict['ondelay1'][0], value_dict['offdelay1'][0],
@@ -2687,6 +2818,12 @@ def main():
                            Peris_ON, value_dict['RPM'][0], Iso_ON,
                            IsLog)
 
+                # Fréquence de résonance du balayage automatique: fréquence de travail des tests suivants
+                if Chosen is not None:
+                    window.FindElement('_FREQ1_').Update(str(int(round(Chosen))))
+                    if len(value_dict['freq1']) > 0:
+                        value_dict['freq1'][0] = int(round(Chosen))
+
                 window.FindElement('_SWEEP_FRAME_').Update(visible=True)
                 sg.popup("Test is complete!")
 
@@ -2747,8 +2884,28 @@ def main():
             # window.disappear()
             # sg.popup("Press OK to confirm launch. Press X to exit")
 
+            # Procédure du test: protocole chargé à la configuration, sinon les cinq itérations de la fenêtre
+            if value_dict['timeline'] is not None:
+                Timeline = value_dict['timeline']
+            else:
+                try:
+                    Timeline = Protocol.from_five_steps(value_dict['itpower'], value_dict['ondelay3'], value_dict['Listbox1'],
+                                                        value_dict['delaimicro'][0], value_dict['delaimesure'][0],
+                                                        value_dict["Listbox2"][0] if Dielec_Verif == 1 else None).compile(isocratic if Iso_ON == 1 else None)
+                except ProtocolError as e:
+                    sg.popup("The test procedure is not valid:\n" + str(e))
+                    continue
+
+            # Vérification: le balayage segmenté doit finir dans la fenêtre OFF de chaque étape
+            if value_dict['sweepplan'] is not None:
+                Short = [Step for Step in Timeline if not value_dict['sweepplan'].fits(Step.off_delay)]
+                if Short:
+                    sg.popup("The OFF delay of step(s) " + ", ".join(str(Step.index) for Step in Short) +
+                             " is shorter than the %.3f s sweep of the segmented plan.\nTest not launched." % value_dict['sweepplan'].sweep_time())
+                    continue
+
             # Vérification: Si toutes les étapes ne requièrent pas l'utilisation de la pompe d'alcool, elle ne sera pas activée lors du test.
-            if value_dict['Listbox1'][0] == 0 and value_dict['Listbox1'][1] == 0 and value_dict['Listbox1'][2] == 0 and value_dict['Listbox1'][3] == 0 and value_dict['Listbox1'][4] == 0 and Iso_ON == 1:
+            if all(not step.flow for step in Timeline) and Iso_ON == 1:
                 Iso_ON = 0
 
             value_dict['donneestemps'] = []
@@ -2766,25 +2923,109 @@ def main():
                 voltageOutput0 = VoltageOutput()
                 voltageOutput1 = VoltageOutput()
                 Cool_Pump_ON = 1
+
+            """
+            S11 RUN STORE INIT
+            Toutes les traces de l'essai sont ajoutées dans un seul fichier (itérations x fréquences)
+            """
+            live_plot.reset()
+
+            # Les délais ON adaptatifs (interval_scheduler.py) et la prévision (trend.py) peuvent descendre jusqu'à
+            # MIN_ON_DELAY: les fichiers sont dimensionnés pour ce cas et ne grossissent jamais pendant l'essai
+            if value_dict['scheduler'] is not None:
+                MinOn = min(value_dict['scheduler'].min_on, MIN_ON_DELAY)
+            elif PREDICTIVE_STOP and any(step.dielectric is not None for step in Timeline):
+                MinOn = MIN_ON_DELAY
+            else:
+                MinOn = None
+            TraceCount = Timeline.trace_count(MinOn) + 2
+
+            value_dict['s11store'] = S11Store("D:\Ablation_Automatisation\Programmation\Automatisation_Andre\DonneesBrutes/" + value_dict['directory'][0] + " " + corrected_time,
+                                              Test_Datapoints(value_dict), TraceCount)
+
+            # Deuxième sonde sur le port 2 (S22) mesurée dans le même balayage que le port 1
+            if Two_Ports == 1:
+                value_dict['dualport'] = DualPortAcquisition(analyzer)
+                value_dict['s22store'] = S11Store("D:\Ablation_Automatisation\Programmation\Automatisation_Andre\DonneesBrutes/" + value_dict['directory'][0] + " " + corrected_time + " port 2",
+                                                  Test_Datapoints(value_dict), TraceCount)
+            else:
+                value_dict['dualport'] = None
+                value_dict['s22store'] = None
+
+            # Permittivity of each trace, calibration found by the initialisation of the test
+            value_dict['permittivity'] = RunPermittivity(band=PERMITTIVITY_BAND)
+
+            if PIPELINED_MEASUREMENT:
+                value_dict['pipeline'] = MeasurementPipeline(PIPELINE_DEPTH)
+            else:
+                value_dict['pipeline'] = None
+
+            if value_dict['scheduler'] is not None:
+                value_dict['scheduler'].reset()
+
+            # Tendance de la marge d'arret sur tout le test (toutes les etapes)
+            if PREDICTIVE_STOP and any(step.dielectric is not None for step in Timeline):
+                value_dict['trend'] = TrendEstimator(TREND_HALFLIFE)
+            else:
+                value_dict['trend'] = None
             
             # Exit = 0
 
-            for i in range(6):
+            TRACER.clear()
+
+            interlock.reset()
+            interlock.start()
+            keepalive.start()
+
+            for i in range(len(Timeline) + 1):
 
+                # i = 0: initialisation seulement, les valeurs de l'étape ne sont pas utilisées
+                Step = Timeline.steps[i - 1]
+                StepRPower = value_dict['rpower1'][0] if Step.rpower is None else Step.rpower
+
+                TRACER.begin("Step " + str(i + 1))
                 Exit = Five_Iteration_Test(value_dict['startfreq'][0], value_dict['stopfreq'][0],
-                                    value_dict['datapoints'][0],
-                                    value_dict['bw'][0], value_dict['directory'][0], value_dict['delaimicro'][0],
-                                    value_dict['delaimesure'][0], voltageOutput0, voltageOutput1, value_dict['itpower'][i - 1],
-                                    value_dict['ondelay3'][i - 1], value_dict['Listbox1'][i - 1],
-                                    value_dict['freq1'][0], value_dict['rpower1'][0], i + 1, Peris_ON,
+                                    Test_Datapoints(value_dict),
+                                    value_dict['bw'][0], value_dict['directory'][0], Step.on_delay,
+                                    Step.off_delay, voltageOutput0, voltageOutput1, Step.power,
+                                    Step.duration, Step.flow,
+                                    value_dict['freq1'][0], StepRPower, i + 1, Peris_ON,
                                     value_dict['RPM'][0], Iso_ON, IsLog, corrected_time, value_dict['donneestemps'],
-                                    value_dict['rpowergraph'], value_dict['powergraph'], Dielec_Verif, value_dict["Listbox2"][0], Timer_ON)
+                                    value_dict['rpowergraph'], value_dict['powergraph'], int(Step.dielectric is not None), Step.dielectric, Timer_ON,
+                                    value_dict['s11store'], value_dict['dualport'], value_dict['s22store'], value_dict['sweepplan'],
+                                    value_dict['pipeline'], value_dict['trend'], value_dict['scheduler'], value_dict['permittivity'], len(Timeline))
+
+                # Early returns (safety stop, dielectric target reached) leave their phases open
+                TRACER.end_all()
                 
                 if Exit == 1:
                     break
 
-                if Exit == 2 and i < 6:
+                if Exit == 2 and i < len(Timeline):
                     continue
+
+            interlock.stop()
+            keepalive.stop()
+            if interlock.tripped:
+                interlock.save("D:\Ablation_Automatisation\Programmation\Automatisation_Andre\Logs/" + corrected_time + "_interlock.json")
+                # Trip seen by the operator (popup of Interlock_Stop): the manual controls can turn the microwaves ON again
+                interlock.reset()
+
+            if MODBUS_SCHEDULER:
+                print(client.metrics_text())
+                client.reset_metrics()
+
+            # Every .s1p file must be on disk before the averages are computed (microwaves already OFF)
+            if value_dict['pipeline'] is not None:
+                try:
+                    value_dict['pipeline'].close()
+                except Exception as error:
+                    print("A trace could not be saved: " + repr(error))
+                    sg.popup("A trace could not be saved:\n" + repr(error) + "\nThe averages may miss some iterations.")
+
+            if TRACER.enabled:
+                TRACER.export_chrome("D:\Ablation_Automatisation\Programmation\Automatisation_Andre\Logs/" + corrected_time + "_trace.json")
+                print(TRACER.summary_text())
                 
             window.FindElement('_FIVEIT_FRAME_').Update(visible=True)
             sg.popup("Test is complete!")
@@ -2794,7 +3035,7 @@ def main():
                 value_dict['stdevreel'] = []
                 value_dict['stdevim'] = []
 
-                S_Averages(value_dict["directory"][0], value_dict["datapoints"][0], value_dict['donneestemps'], value_dict['stdevreel'], value_dict['stdevim'])
+                S_Averages(value_dict["directory"][0], Test_Datapoints(value_dict), value_dict['donneestemps'], value_dict['stdevreel'], value_dict['stdevim'])
 
             except:
                 sg.popup('Please check the average data fields')
@@ -3427,6 +3668,10 @@ def main():
         if event == '_AUTO_MODE_':
             IsManu = 0
 
+        # Manual sweep with the whole frequency plan and one S11 run (list_sweep.py)
+        if event == '_LIST_MODE_':
+            IsManu = 2
+
         # Five iteration test configuration
         if event == '_CONFIG5_OK_':
 
@@ -3478,6 +3723,55 @@ def main():
                 value_dict["delaimicro"].append(float(values['_DELAIMICRO_']))
                 value_dict["directory"].append(str(values['_DIRECTORY_']))
 
+                # Balayage segmenté: les bandes choisies remplacent le balayage complet startFreq - stopFreq
+                # Le délai de mesure devient la fenêtre OFF minimale estimée pour le bruit visé
+                # Bruit de référence: valeur entrée, sinon mesurée sur des balayages répétés de la sonde
+                value_dict["sweepplan"] = None
+                if str(values['_SEGMENTS_']).strip() != '':
+                    if str(values['_NOISEREF_']).strip() != '':
+                        NoiseRef = (float(values['_NOISEREF_']), float(values['_NOISEREFBW_']))
+                    else:
+                        NoiseRef = Measure_Reference_Noise(float(values['_NOISEREFBW_']))
+                    value_dict["sweepplan"] = SweepPlan(parse_bands(str(values['_SEGMENTS_'])), float(values['_NOISE_']), NoiseRef[0], NoiseRef[1])
+                    value_dict["delaimesure"][0] = value_dict["sweepplan"].off_window()
+                    sg.popup("Segmented sweep planned:\n" + value_dict["sweepplan"].summary() +
+                             "\nReference noise: %.2e at %g Hz" % NoiseRef +
+                             "\nNumber of data points of the five iteration test: " + str(value_dict["sweepplan"].points))
+                    if not value_dict["sweepplan"].noise_met:
+                        sg.popup("Warning: the target noise is not met in every band, even at the narrowest IF bandwidth.\n"
+                                 "Raise the target noise or lower the points of these bands.")
+
+                # Protocole chargé d'un fichier: remplace les cinq itérations, vérifié en entier avant le test
+                value_dict["timeline"] = None
+                if str(values['_PROTOCOL_']).strip() != '':
+                    try:
+                        LoadedProtocol = load_protocol(str(values['_PROTOCOL_']).strip())
+
+                        # Les étapes sans délai OFF prennent la fenêtre OFF du balayage segmenté
+                        if value_dict["sweepplan"] is not None:
+                            LoadedProtocol.set_default('off_delay', value_dict["delaimesure"][0])
+
+                        value_dict["timeline"] = LoadedProtocol.compile(isocratic if Iso_ON == 1 else None)
+                        sg.popup("Protocol loaded:\n" + value_dict["timeline"].summary())
+
+                        if value_dict["sweepplan"] is not None:
+                            Short = [step for step in value_dict["timeline"] if step.off_delay < value_dict["delaimesure"][0]]
+                            Other = [step for step in value_dict["timeline"] if step.off_delay > value_dict["delaimesure"][0]]
+                            if Short:
+                                sg.popup("Warning: the OFF delay of step(s) " + ", ".join(str(step.index) for step in Short) +
+                                         " is shorter than the " + str(value_dict["delaimesure"][0]) + " s the segmented sweep needs.")
+                            if Other:
+                                sg.popup("The protocol keeps its own OFF delay for step(s) " + ", ".join(str(step.index) for step in Other) +
+                                         " instead of the planned " + str(value_dict["delaimesure"][0]) + " s.")
+                    except (ProtocolError, OSError) as e:
+                        sg.popup("The protocol file is not valid:\n" + str(e))
+
+                # Délai ON adaptatif: plus long lorsque S11 est stable, plus court lorsque S11 change vite
+                value_dict["scheduler"] = None
+                if Adaptive_ON == 1:
+                    value_dict["scheduler"] = IntervalScheduler(float(values['_ONMIN_']), float(values['_ONMAX_']),
+                                                                float(values['_ONTOL_']), value_dict["delaimicro"][0])
+
                 window.FindElement('_FIVEIT_FRAME_').Update(visible=True)
 
                 sg.popup("Configured!")
@@ -3517,7 +3811,7 @@ def main():
             value_dict['stdevim'] = []
 
             try:
-                S_Averages(value_dict["directory"][0], value_dict["datapoints"][0], value_dict['donneestemps'], value_dict['stdevreel'], value_dict['stdevim'])
+                S_Averages(value_dict["directory"][0], Test_Datapoints(value_dict), value_dict['donneestemps'], value_dict['stdevreel'], value_dict['stdevim'])
 
                 print(value_dict['stdevreel'])
                 sg.popup("File has been created in the folder DonneesMoyennes !")
@@ -3529,7 +3823,7 @@ def main():
         # Format Excel data file
         if event == '_EXCELDATA_':
             try:
-                Excel_Data_Format(value_dict['donneestemps'], value_dict['rpowergraph'], value_dict['powergraph'], value_dict['stdevreel'],value_dict['stdevim'], value_dict["directory"][0])
+                Excel_Data_Format(value_dict['donneestemps'], value_dict['rpowergraph'], value_dict['powergraph'], value_dict['stdevreel'],value_dict['stdevim'], value_dict["directory"][0], value_dict['permittivity'])
 
                 sg.popup("Excel file has been formatted!")
 
@@ -3537,6 +3831,20 @@ def main():
                 sg.popup('Please check the fields')
                 window.FindElement('_FIVEIT_FRAME_').Update(visible=True)
 
+        # Measure the references of the probe on the frequency plan configured for the five iteration test
+        if event == '_CALIBRATE_':
+            try:
+                Calibration = Probe_Calibration(value_dict['startfreq'][0], value_dict['stopfreq'][0], Test_Datapoints(value_dict),
+                                                value_dict['bw'][0], IsLog, value_dict['sweepplan'])
+                if Calibration is None:
+                    sg.popup("Calibration cancelled, nothing saved")
+                else:
+                    sg.popup("Calibration of probe " + PROBE_ID + " saved:\n" + Calibration[0].filename())
+
+            except Exception as e:
+                sg.popup("Calibration failed:\n" + str(e) + "\nPlease configure the test first")
+                window.FindElement('_FIVEIT_FRAME_').Update(visible=True)
+
         # Create average S1P files manually
         if event == '_MANUS1P_OK_':
             try:
@@ -3584,6 +3892,20 @@ def main():
             Manu_Pumps_State = 4
             Manu_Peris_ON = 0
 
+        # Second probe selection (port 2, S22)
+        if event == '_TWOPORTS_ON_':
+            Two_Ports = 1
+
+        if event == '_TWOPORTS_OFF_':
+            Two_Ports = 0
+
+        # Adaptive ON delay selection
+        if event == '_ADAPTIVE_ON_':
+            Adaptive_ON = 1
+
+        if event == '_ADAPTIVE_OFF_':
+            Adaptive_ON = 0
+
         # Dielectric verification selection
         if event == '_DIELEC_VERIF_':
             Dielec_Verif = 1
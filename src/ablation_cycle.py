@@ -0,0 +1,395 @@
+"""
+
+OFF / MEASURE / ON CYCLE OF AN ABLATION STEP
+
+Atlantic Cancer Research Institute - ACRI
+
+The safety-critical cycle of the five iteration test, without the GUI. It is the only copy of the
+cycle: Five_Iteration_Test (CircuitAutomatisation_V5_2021.py), run_protocol() (station.py) and the
+timing benchmark (hil_benchmark.py) all call run_cycle():
+
+    1. safety interlock already tripped                               -> STOP_INTERLOCK
+    2. reflected power (reg 103) above max_rpower: microwaves OFF      -> STOP_REFLECTED
+    3. microwaves OFF (reg 2 = 0x00), RISE_FALL, transmitted power (reg 102) must be 0
+       (otherwise microwaves OFF again)                                -> STOP_POWER
+    4. measurement of the trace (Measurement.measure(), its permittivity is computed at step 8), then a trace of an earlier cycle that
+       the measurement pipeline could not save                         -> STOP_PIPELINE
+       (3 and 4 are measure_off(), also used for the traces at the end of a step or of the test)
+    5. dielectric target reached on the trace: microwaves stay OFF     -> TARGET_REACHED
+    6. ON delay of the cycle (fixed, or computed from the trace by the caller: interval_scheduler.py,
+       trend.py)
+    7. interlock tripped during the sweep, or ON write refused by its latch -> STOP_INTERLOCK
+    8. microwaves ON (reg 2 = 0x50, reflected power limitation mode), permittivity of the trace,
+       rest of the ON delay
+    9. reflected and transmitted power read back
+
+The GUI of the caller (progress meter, colours, popups, log file) is given as callbacks, and a
+timer (hil_benchmark.PhaseTimer) can time each phase. The Cycle returned says how it ended; on every
+STOP_* the microwaves are OFF and the caller ends the test (pump in standby, popup, ...).
+
+Measurement is the measurement of the OFF window: sweep of the probe (or of both probes, dual_port.py) and its
+trace in the run store, with the .s1p files saved by the ENA during the OFF window or written by
+the measurement pipeline (pipeline.py) while the microwaves are ON.
+"""
+
+import os
+import time
+import collections
+
+from tracing import TRACER
+from interlock import InterlockError
+from dielectric_check import lookup_table
+from s11_store import fetch_trace, write_s1p
+
+UNIT = 0x01
+
+# MICROWAVE CONTROL WORDS (reg 2)
+MICROWAVES_OFF = 0x00
+MICROWAVES_ON = 0x50
+
+# RISE AND FALL TIME OF THE TRANSMITTED POWER AFTER THE OFF WRITE (s)
+RISE_FALL = 0.001
+
+# HOW A CYCLE ENDED
+CYCLE_DONE = "done"
+TARGET_REACHED = "target_reached"
+STOP_INTERLOCK = "interlock"
+STOP_REFLECTED = "reflected_power"
+STOP_POWER = "power_not_off"
+STOP_PIPELINE = "pipeline_error"
+
+
+class Cycle(collections.namedtuple('Cycle', 'status trace acquired on_delay reflected forward message off_time')):
+    """
+    Result of run_cycle(): trace of port 1 (None when stopped before the measurement), its time.monotonic()
+    at the end of the sweep, ON delay applied (s), reflected and transmitted power read back (W), time the
+    microwaves were OFF (s, from the OFF write to the ON write, or to the end of the measurement).
+    """
+    __slots__ = ()
+
+    @property
+    def stopped(self):
+        return self.status not in (CYCLE_DONE, TARGET_REACHED)
+
+
+class NoTimer:
+    # Phase timer that does nothing (see hil_benchmark.PhaseTimer)
+    def begin(self, phase):
+        pass
+
+    def end(self):
+        pass
+
+    def microwaves_on(self):
+        pass
+
+    def microwaves_off(self):
+        pass
+
+
+NO_TIMER = NoTimer()
+
+
+"""
+MEASUREMENT
+"""
+class Measurement:
+    def __init__(self, analyzer, folder, store, dual_port=None, store2=None, pipeline=None, permittivity=None,
+                 disk_root="D:/", timer=NO_TIMER):
+        """
+        @param analyzer: pyvisa resource of the ENA
+        @param folder: folder of the .s1p files on the ENA disk (D:/)
+        @param store: S11Store of port 1
+        @param dual_port: DualPortAcquisition for a second probe on port 2 (None = one probe)
+        @param store2: S11Store of port 2
+        @param pipeline: MeasurementPipeline (None = the ENA saves the .s1p in the OFF window)
+        @param permittivity: permittivity.RunPermittivity converting the traces of port 1 (None = no conversion)
+        @param disk_root: folder standing for D:/ when the host writes the .s1p files
+        """
+        self.analyzer = analyzer
+        self.folder = folder
+        self.store = store
+        self.dual_port = dual_port
+        self.store2 = store2
+        self.pipeline = pipeline
+        self.permittivity = permittivity
+        self.disk_root = disk_root
+        self.timer = timer
+
+    def _trigger(self):
+        self.timer.begin('trigger')
+        self.analyzer.write("SENS1:SWE:MODE SINGLE")
+        self.analyzer.write("TRIGger:SCOPe CURRent")
+        self.analyzer.write("INITiate1:IMMediate")
+        self.timer.end()
+
+    def sweep_duration(self, sweep_time):
+        """
+        @param sweep_time: sweep time of each channel (s)
+        @return: sweep time of one trigger (s), both channels are swept one after the other with a second probe
+        """
+        if self.dual_port is not None:
+            return 2 * sweep_time
+        return sweep_time
+
+    def _s1p(self, prefix, index):
+        return os.path.join(self.disk_root, self.folder, prefix + "Iteration_" + str(index) + ".s1p")
+
+    def measure(self, index, sweep_time, convert=True):
+        """
+        Sweeps the probe(s), microwaves OFF.
+
+        @param index: number of the Iteration_ file
+        @param sweep_time: sweep time of channel 1 (s)
+        @param convert: permittivity of the trace computed here (False: the caller calls convert() later,
+                        e.g. run_cycle() once the microwaves are ON, to keep it out of the OFF window)
+        @return: (S11 trace of port 1 (complex64), time.monotonic() at the end of its sweep)
+        """
+        timer = self.timer
+
+        # PIPELINED: ONLY THE SWEEP AND ONE TRACE TRANSFER HAPPEN IN THE OFF WINDOW.
+        # The run store append and the .s1p files are done by the pipeline worker while microwaves are ON.
+        if self.pipeline is not None:
+            if self.dual_port is None:
+                self._trigger()
+
+                # INITiate is overlapped: *OPC? answers as soon as the sweep is done
+                timer.begin('sweep_wait')
+                self.analyzer.query("*OPC?")
+                acquired = time.monotonic()
+                timer.end()
+
+                timer.begin('fetch')
+                trace1 = fetch_trace(self.analyzer)
+                trace2 = None
+                timer.end()
+
+            else:
+                timer.begin('sweep_wait')
+                self.dual_port.trigger()
+                self.dual_port.wait()
+                acquired = time.monotonic()
+                timer.end()
+
+                timer.begin('fetch')
+                trace1, trace2 = self.dual_port.fetch()
+                timer.end()
+
+            self.pipeline.submit(self.save, index, time.time(), trace1, trace2)
+            if convert:
+                self.convert(trace1)
+            return trace1, acquired
+
+        # ONE PROBE: SWEEP CHANNEL 1 AND SAVE THE .S1P FROM THE ENA
+        if self.dual_port is None:
+            self._trigger()
+
+            timer.begin('sweep_wait')
+            time.sleep(sweep_time)
+            acquired = time.monotonic()
+            timer.end()
+
+            # TAKE MEASUREMENT AND SAVE FILE OF PORT 1 AS A .S1P (REAL IMAGINARY DATA FORMAT)
+            timer.begin('save')
+            self.analyzer.write("CALC:MEAS:DATA:SNP:PORTs:Save '1,,', '" + self.folder + "/Iteration_" + str(index) +
+                                ".s1p'")
+            self.analyzer.query("*OPC?")
+            timer.end()
+
+            # KEEP THE TRACE IN THE RUN STORE (same index as the Iteration_ file - 1)
+            timer.begin('fetch')
+            trace1 = fetch_trace(self.analyzer)
+            self.store.append(trace1)
+            timer.end()
+
+        # TWO PROBES: BOTH CHANNELS IN ONE TRIGGER (TRIG:SCOP ALL), SWEPT ONE AFTER THE OTHER (2 x sweep_time),
+        # THEN ONE SDATA TRANSFER PER CHANNEL. The .s1p files are written by the host from the transferred traces.
+        else:
+            timer.begin('sweep_wait')
+            self.dual_port.trigger()
+            self.dual_port.wait()
+            acquired = time.monotonic()
+            timer.end()
+
+            timer.begin('fetch')
+            trace1, trace2 = self.dual_port.fetch()
+            timer.end()
+
+            timer.begin('save')
+            self.save(index, None, trace1, trace2)
+            timer.end()
+
+        if convert:
+            self.convert(trace1)
+        return trace1, acquired
+
+    def convert(self, trace1):
+        # Permittivity of the trace of port 1 (nothing without calibration of the probe)
+        if self.permittivity is not None:
+            self.permittivity.convert(trace1)
+
+    def save(self, index, timestamp, trace1, trace2):
+        # Background part of a pipelined measurement (runs on the pipeline worker thread)
+        self.store.append(trace1, timestamp)
+        write_s1p(self._s1p("", index), self.store.frequencies, trace1, 1)
+
+        if trace2 is not None:
+            self.store2.append(trace2, timestamp)
+            write_s1p(self._s1p("Port2_", index), self.store2.frequencies, trace2, 2)
+
+
+"""
+CYCLE
+"""
+def _stop(status, message, trace=None, acquired=None, off_time=None):
+    return Cycle(status, trace, acquired, 0.0, None, None, message, off_time)
+
+
+def measure_off(client, measurement, index, sweep_time, unit=UNIT, log=None, timer=NO_TIMER, convert=True):
+    """
+    Microwaves OFF, transmitted power checked at 0, then the measurement (steps 3 and 4 of the cycle,
+    also the trace at the end of a step or of the test). Microwaves stay OFF.
+
+    @param convert: permittivity of the trace computed here (see Measurement.measure())
+    @return: Cycle (CYCLE_DONE, STOP_POWER or STOP_PIPELINE)
+    """
+    if log is None:
+        log = lambda line: None
+
+    # MICROWAVES OFF
+    timer.begin('mw_off')
+    client.write_register(2, MICROWAVES_OFF, unit=unit)
+    t_off = time.monotonic()
+    timer.end()
+    timer.microwaves_off()
+
+    # Delai rise and fall
+    timer.begin('rise_fall')
+    time.sleep(RISE_FALL)
+    timer.end()
+
+    # The transmitted power must be measured at 0 Watts
+    timer.begin('power_check')
+    forward = client.read_holding_registers(102, 1, unit=unit).registers[0]
+    timer.end()
+    if forward != 0:
+        client.write_register(2, MICROWAVES_OFF, unit=unit)
+        return _stop(STOP_POWER, "Power is not at 0 when it should be (" + str(forward) + " W)")
+
+    log("Microwaves OFF, sweep of " + str(measurement.sweep_duration(sweep_time)) + " seconds")
+
+    # TAKE MEASUREMENT AND SAVE FILE OF PORT 1 (AND PORT 2) AS A .S1P (REAL IMAGINARY DATA FORMAT)
+    trace, acquired = measurement.measure(index, sweep_time, convert)
+    log("Measure triggered and saved")
+
+    # A TRACE OF AN EARLIER CYCLE COULD NOT BE SAVED: NO MORE ON WINDOW
+    if measurement.pipeline is not None:
+        try:
+            measurement.pipeline.check()
+        except Exception as error:
+            return _stop(STOP_PIPELINE, "A trace could not be saved (" + repr(error) + ")", trace, acquired,
+                         time.monotonic() - t_off)
+
+    return Cycle(CYCLE_DONE, trace, acquired, 0.0, None, forward, None, time.monotonic() - t_off)
+
+
+def run_cycle(client, measurement, index, sweep_time, on_delay, unit=UNIT, interlock=None, max_rpower=None,
+              dielectric=None, phase=None, log=None, timer=NO_TIMER):
+    """
+    One OFF / measure / ON cycle. Microwaves are ON at the end of a CYCLE_DONE, OFF otherwise.
+
+    @param client: Modbus client of the generator
+    @param measurement: Measurement of the run
+    @param index: number of the Iteration_ file of the trace
+    @param sweep_time: sweep time of each channel (s)
+    @param on_delay: ON delay (s), or callable(trace, acquired) returning it
+    @param interlock: interlock.Interlock watching the generator (None = no interlock)
+    @param max_rpower: reflected power (W) above which the cycle stops before the OFF phase (None = no check)
+    @param dielectric: minimum dielectric value stopping the step (dielectric_check.py), None = no check
+    @param phase: called with "OFF" and "ON" at the start of each phase (GUI progress)
+    @param log: called with each log line of the cycle
+    @param timer: phase timer (hil_benchmark.PhaseTimer)
+    @return: Cycle
+    """
+    if log is None:
+        log = lambda line: None
+
+    # ------------- STATE I - DIELECTRIC MEASUREMENT -------------#
+    TRACER.begin("OFF")
+    if phase is not None:
+        phase("OFF")
+
+    # SAFETY INTERLOCK: MICROWAVES ALREADY TURNED OFF BY THE INTERLOCK THREAD
+    if interlock is not None and interlock.tripped:
+        return _stop(STOP_INTERLOCK, interlock.last_trip().message)
+
+    # REFLECTED POWER OF THE LAST ON WINDOW
+    timer.begin('rpower_check')
+    reflected = client.read_holding_registers(103, 1, unit=unit).registers[0]
+    timer.end()
+    if max_rpower is not None and int(reflected) > max_rpower:
+        client.write_register(2, MICROWAVES_OFF, unit=unit)
+        timer.microwaves_off()
+        return _stop(STOP_REFLECTED, "The reflected power is too high (" + str(reflected) + " W)")
+
+    # Permittivity of the trace converted once the microwaves are ON (or when the cycle ends before)
+    measured = measure_off(client, measurement, index, sweep_time, unit, log, timer, convert=False)
+    t_measured = time.monotonic()
+    trace, acquired = measured.trace, measured.acquired
+    if measured.stopped:
+        if trace is not None:
+            measurement.convert(trace)
+        return measured
+
+    # DIELECTRIC TARGET: NO MORE MICROWAVES IN THIS STEP
+    if dielectric is not None and lookup_table(len(trace)).reached(trace, dielectric):
+        measurement.convert(trace)
+        return _stop(TARGET_REACHED, "Minimum dielectric value achieved", trace, acquired,
+                     measured.off_time + time.monotonic() - t_measured)
+
+    if callable(on_delay):
+        on_delay = on_delay(trace, acquired)
+
+    # ------------- STATE II - MICROWAVE ABLATION -------------#
+    TRACER.end()
+    TRACER.begin("ON")
+    if phase is not None:
+        phase("ON")
+
+    # SAFETY INTERLOCK: A TRIP DURING THE MEASUREMENT KEEPS THE MICROWAVES OFF (the ON write is refused)
+    if interlock is not None and interlock.tripped:
+        measurement.convert(trace)
+        return _stop(STOP_INTERLOCK, interlock.last_trip().message, trace, acquired,
+                     measured.off_time + time.monotonic() - t_measured)
+    timer.begin('mw_on')
+    try:
+        client.write_register(2, MICROWAVES_ON, unit=unit)
+    except InterlockError:
+        measurement.convert(trace)
+        return _stop(STOP_INTERLOCK, interlock.last_trip().message, trace, acquired,
+                     measured.off_time + time.monotonic() - t_measured)
+    timer.end()
+    timer.microwaves_on()
+    t_on = time.monotonic()
+    off_time = measured.off_time + t_on - t_measured
+    log("Microwaves OFF for %.3f seconds" % off_time)
+    log("Microwaves ON for " + str(on_delay) + " seconds")
+
+    # Permittivity of the trace during the ON delay
+    timer.begin('convert')
+    measurement.convert(trace)
+    timer.end()
+
+    timer.begin('on_wait')
+    time.sleep(max(on_delay - (time.monotonic() - t_on), 0.0))
+    timer.end()
+
+    # Valeurs de puissance réfléchie et transmise en temps réel
+    timer.begin('power_readback')
+    reflected = client.read_holding_registers(103, 1, unit=unit).registers[0]
+    forward = client.read_holding_registers(102, 1, unit=unit).registers[0]
+    timer.end()
+    log("Reflected power measurement: " + str(reflected) + " Watts")
+    log("Transmitted power measurement: " + str(forward) + " Watts")
+
+    return Cycle(CYCLE_DONE, trace, acquired, on_delay, reflected, forward, None, off_time)
@@ -0,0 +1,327 @@
+"""
+
+PROBE CALIBRATION CACHE
+
+Atlantic Cancer Research Institute - ACRI
+
+Saves the calibration sets of the coaxial probe (see permittivity.py) so they are measured once
+(air / short / water) and reused by every run with the same probe and frequency plan.
+
+A set is keyed by: probe ID, start / stop frequency, number of points, IF bandwidth and reference
+temperature. On disk, each set is one .npz file (frequency axis + coefficients) and index.json lists
+the keys. The sets used recently are kept in memory (LRU), interpolated sets included.
+
+lookup() finds the best set for a run: same probe, same IF bandwidth when asked, a frequency range
+covering the run and the nearest reference temperature. The coefficients are then interpolated
+onto the frequency axis of the run, whatever its points (or segments).
+
+The set used by a run is also saved in its run folder (RUN_CALIBRATION_FILE, write_calibration()),
+so the archived traces can be converted later without the cache (postprocess.py).
+
+calibrate() measures the three references on the frequency plan loaded in the ENA and saves the set.
+The five iteration test calls it from its window, with the sweep of the run; from a terminal:
+
+    python calibration_cache.py <root> measure Probe1 --start 2000 --stop 3000 --points 201 --ifbw 1000 --temperature 25
+    python calibration_cache.py <root> list
+"""
+
+import os
+import sys
+import json
+import argparse
+import collections
+import numpy as np
+
+from permittivity import ProbeCalibration
+from s11_store import fetch_trace, fetch_frequencies
+
+INDEX_FILE = "index.json"
+
+# REFERENCES OF THE PROBE, IN THE ORDER THEY ARE MEASURED
+REFERENCES = ('air', 'short', 'water')
+REPETITIONS = 5
+
+# CALIBRATION OF A RUN, IN ITS RUN FOLDER (coefficients on the frequency axis of the run)
+RUN_CALIBRATION_FILE = "calibration.npz"
+
+
+class CalibrationKey(collections.namedtuple('CalibrationKey', 'probe start stop points ifbw temperature')):
+    """
+    probe: probe ID / start, stop: Hz / points / ifbw: Hz / temperature: degC of the references
+    """
+    __slots__ = ()
+
+    def filename(self):
+        name = "%s_%d-%d_%dpts_%gHz_%gC.npz" % (self.probe, self.start, self.stop, self.points, self.ifbw,
+                                               self.temperature)
+        return "".join(c if c.isalnum() or c in "._-" else "_" for c in name)
+
+
+class CalibrationCache:
+    def __init__(self, root, capacity=8):
+        """
+        @param root: folder of the calibration files (created if needed)
+        @param capacity: number of calibration sets kept in memory
+        """
+        self.root = root
+        self.capacity = capacity
+        self.memory = collections.OrderedDict()
+        os.makedirs(root, exist_ok=True)
+
+        self.index = {}
+        index_path = os.path.join(root, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as IndexFile:
+                for entry in json.load(IndexFile):
+                    key = CalibrationKey(*entry['key'])
+                    self.index[key] = entry['file']
+
+    """
+    LRU
+    """
+    def _remember(self, key, calibration):
+        self.memory[key] = calibration
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def _recall(self, key):
+        calibration = self.memory.get(key)
+        if calibration is not None:
+            self.memory.move_to_end(key)
+        return calibration
+
+    """
+    DISK
+    """
+    def _write_index(self):
+        entries = [{'key': list(key), 'file': name} for key, name in self.index.items()]
+        with open(os.path.join(self.root, INDEX_FILE), "w") as IndexFile:
+            json.dump(entries, IndexFile, indent=1)
+
+    def save(self, key, calibration):
+        """
+        @param key: CalibrationKey
+        @param calibration: ProbeCalibration measured with that probe and frequency plan
+        """
+        name = key.filename()
+        write_calibration(os.path.join(self.root, name), calibration)
+        self.index[key] = name
+        self._write_index()
+        self._remember(key, calibration)
+
+    def load(self, key):
+        """
+        @return: ProbeCalibration of exactly that key (KeyError if it was never saved)
+        """
+        calibration = self._recall(key)
+        if calibration is not None:
+            return calibration
+
+        calibration = read_calibration(os.path.join(self.root, self.index[key]))
+        self._remember(key, calibration)
+        return calibration
+
+    def keys(self, probe=None):
+        return [key for key in self.index if probe is None or key.probe == probe]
+
+    """
+    LOOKUP
+    """
+    def lookup(self, probe, frequencies, temperature=25.0, ifbw=None, max_temperature_gap=5.0):
+        """
+        Calibration of a probe on any frequency axis.
+
+        @param frequencies: frequency axis of the run (Hz)
+        @param temperature: temperature of the references wanted (degC), the nearest set is used
+        @param ifbw: IF bandwidth of the run (Hz), None = any
+        @param max_temperature_gap: largest accepted difference with temperature (degC)
+        @return: ProbeCalibration on frequencies, or None when no saved set fits
+        """
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        f_low, f_high = frequencies.min(), frequencies.max()
+
+        candidates = [key for key in self.keys(probe) if key.start <= f_low and key.stop >= f_high and
+                      (ifbw is None or key.ifbw == ifbw) and abs(key.temperature - temperature) <= max_temperature_gap]
+        if len(candidates) == 0:
+            return None
+
+        # Nearest temperature, then densest frequency plan
+        key = min(candidates, key=lambda k: (abs(k.temperature - temperature), -_density(k)))
+
+        grid_key = ('grid', key, len(frequencies), float(f_low), float(f_high), hash(frequencies.tobytes()))
+        calibration = self._recall(grid_key)
+        if calibration is not None:
+            return calibration
+
+        calibration = interpolate(self.load(key), frequencies)
+        self._remember(grid_key, calibration)
+        return calibration
+
+
+def write_calibration(filename, calibration):
+    """
+    @param filename: .npz file
+    @param calibration: ProbeCalibration
+    """
+    np.savez(filename, **calibration.coefficients())
+
+
+def read_calibration(filename):
+    """
+    @return: ProbeCalibration saved by write_calibration()
+    """
+    with np.load(filename) as data:
+        return ProbeCalibration(data['frequencies'], data['alpha'], data['beta'], data['s11_short'])
+
+
+def _density(key):
+    # Points per Hz of a set, a CW set (start == stop) being the densest there is
+    span = key.stop - key.start
+    return key.points / span if span > 0 else float('inf')
+
+
+def interpolate(calibration, frequencies):
+    """
+    Coefficients of a calibration interpolated (real and imaginary parts, linear) onto another
+    frequency axis inside its range.
+
+    @return: ProbeCalibration
+    """
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    if len(frequencies) == len(calibration.frequencies) and np.array_equal(frequencies, calibration.frequencies):
+        return calibration
+
+    source = calibration.frequencies
+
+    def resample(values):
+        return np.interp(frequencies, source, values.real) + 1j * np.interp(frequencies, source, values.imag)
+
+    return ProbeCalibration(frequencies, resample(calibration.alpha), resample(calibration.beta),
+                            resample(calibration.s11_short))
+
+
+"""
+MEASUREMENT OF THE REFERENCES
+"""
+def measure_references(analyzer, prompt, repetitions=REPETITIONS, channel=1):
+    """
+    Sweeps the references one after the other on the frequency plan loaded in a channel of the ENA.
+
+    @param analyzer: pyvisa resource of the ENA, channel set like the run (points, span, IF bandwidth, segments)
+    @param prompt: callable(reference) returning when the probe is in that reference, False = cancel
+    @param repetitions: sweeps per reference (averaged by ProbeCalibration.from_references())
+    @return: (frequencies, {reference: (repetitions, datapoints) complex array}), None when cancelled
+    """
+    frequencies = fetch_frequencies(analyzer, channel)
+    traces = {}
+    for reference in REFERENCES:
+        if prompt(reference) is False:
+            return None
+
+        rows = []
+        for _ in range(repetitions):
+            analyzer.write("SENS" + str(channel) + ":SWE:MODE SINGLE")
+            analyzer.write("TRIGger:SCOPe CURRent")
+            analyzer.write("INITiate" + str(channel) + ":IMMediate")
+            analyzer.query("*OPC?")
+            rows.append(fetch_trace(analyzer, channel))
+        traces[reference] = np.vstack(rows)
+
+    analyzer.write("SENS" + str(channel) + ":SWE:MODE HOLD")
+    return frequencies, traces
+
+
+def calibrate(cache, analyzer, probe, ifbw, temperature=25.0, prompt=None, repetitions=REPETITIONS, channel=1):
+    """
+    Measures the references of a probe and saves the calibration under the frequency plan of the channel.
+
+    @param cache: CalibrationCache
+    @param ifbw: IF bandwidth set on the channel (Hz), part of the key
+    @param temperature: temperature of the water reference (degC)
+    @param prompt: see measure_references() (None = question in the terminal)
+    @return: (CalibrationKey, ProbeCalibration), None when cancelled
+    """
+    if prompt is None:
+        prompt = _terminal_prompt
+
+    measured = measure_references(analyzer, prompt, repetitions, channel)
+    if measured is None:
+        return None
+
+    frequencies, traces = measured
+    calibration = ProbeCalibration.from_references(frequencies, traces['air'], traces['short'], traces['water'],
+                                                   temperature)
+    key = CalibrationKey(probe, float(frequencies.min()), float(frequencies.max()), len(frequencies), float(ifbw),
+                         float(temperature))
+    cache.save(key, calibration)
+    return key, calibration
+
+
+def _terminal_prompt(reference):
+    answer = input("Place the probe in " + reference + " and press Enter (q to cancel) ")
+    return answer.strip().lower() != 'q'
+
+
+"""
+COMMAND LINE
+"""
+def open_analyzer(backend, disk_root="ENA_Disk"):
+    if backend == 'sim':
+        from sim_e5080a import SimulatedResourceManager
+        rm = SimulatedResourceManager(disk_root=disk_root, time_scale=0)
+    else:
+        import pyvisa
+        rm = pyvisa.ResourceManager()
+    return rm.open_resource('USB0::0x2A8D::0x0001::MY55201231::0::INSTR')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calibration sets of the coaxial probes")
+    parser.add_argument('root', help="folder of the calibration files")
+    commands = parser.add_subparsers(dest='command')
+
+    measure = commands.add_parser('measure', help="measure air / short / water and save the set")
+    measure.add_argument('probe', help="probe ID (PROBE_ID of the five iteration test)")
+    measure.add_argument('--start', type=float, required=True, help="start frequency (MHz)")
+    measure.add_argument('--stop', type=float, required=True, help="stop frequency (MHz)")
+    measure.add_argument('--points', type=int, required=True)
+    measure.add_argument('--ifbw', type=float, required=True, help="IF bandwidth (Hz)")
+    measure.add_argument('--temperature', type=float, default=25.0, help="water temperature (degC)")
+    measure.add_argument('--log', action='store_true', help="logarithmic sweep")
+    measure.add_argument('--repetitions', type=int, default=REPETITIONS)
+    measure.add_argument('--analyzer', choices=['sim', 'usb'], default='usb')
+
+    commands.add_parser('list', help="show the saved sets")
+
+    args = parser.parse_args(argv)
+    cache = CalibrationCache(args.root)
+
+    if args.command == 'measure':
+        analyzer = open_analyzer(args.analyzer)
+        analyzer.write("SENS1:SWE:POIN " + str(args.points))
+        analyzer.write("SENS1:FREQ:START " + str(args.start * 1000000))
+        analyzer.write("SENS1:FREQ:STOP " + str(args.stop * 1000000))
+        analyzer.write("SENS1:BAND " + str(args.ifbw))
+        analyzer.write("SENS1:SWEep:TYPE " + ("LOG" if args.log else "LIN"))
+
+        result = calibrate(cache, analyzer, args.probe, args.ifbw, args.temperature, repetitions=args.repetitions)
+        analyzer.close()
+        if result is None:
+            print("Calibration cancelled, nothing saved")
+            return 1
+        print("Saved " + result[0].filename())
+
+    elif args.command == 'list':
+        for key in sorted(cache.keys()):
+            print("%-12s %12g %12g Hz %6d pts %8g Hz %6g degC" % key)
+
+    else:
+        parser.print_help()
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+
+DIELECTRIC STOP CHECK
+
+Atlantic Cancer Research Institute - ACRI
+
+Decides whether the minimum dielectric value chosen in the GUI is reached, directly on the S11
+trace just transferred from the ENA (no .s1p file is read back).
+
+The test stops when at least STOP_FRACTION of the points have a real part of S11 above the
+threshold of the target. The thresholds of each target are precomputed once per number of points
+as one array (one value per frequency point), so the check is a single vectorized comparison.
+
+The S11 thresholds below are the placeholder values used since 2021 (to change for real
+dielectric values).
+"""
+
+import math
+import functools
+import numpy as np
+
+# S11 REAL PART THRESHOLD FOR EACH MINIMUM DIELECTRIC VALUE OF THE GUI
+S11_THRESHOLDS = {20: 0.75, 25: 0.7, 30: 0.65, 35: 0.6}
+
+# FRACTION OF THE POINTS THAT MUST BE OVER THE THRESHOLD TO STOP THE TEST
+STOP_FRACTION = 0.25
+
+
+class DielectricCheck:
+    def __init__(self, datapoints, thresholds=None, stop_fraction=STOP_FRACTION):
+        """
+        @param datapoints: number of points of the traces
+        @param thresholds: {target: S11 threshold (scalar or one value per point)}, S11_THRESHOLDS if None
+        @param stop_fraction: fraction of the points over the threshold that stops the test
+        """
+        if thresholds is None:
+            thresholds = S11_THRESHOLDS
+
+        self.datapoints = int(datapoints)
+        self.min_count = int(math.ceil(stop_fraction * self.datapoints))
+
+        # Lookup table: target -> threshold of every point
+        self.table = {}
+        for target, value in thresholds.items():
+            self.table[float(target)] = np.broadcast_to(np.asarray(value, dtype=np.float32), (self.datapoints,)).copy()
+
+    def threshold(self, target):
+        try:
+            return self.table[float(target)]
+        except KeyError:
+            raise ValueError("No S11 threshold for a minimum dielectric value of " + str(target) + " (available: " +
+                             ", ".join("%g" % t for t in sorted(self.table)) + ")")
+
+    def count(self, trace, target):
+        """
+        @return: number of points of the trace over the threshold of target
+        """
+        return int(np.count_nonzero(np.real(trace) > self.threshold(target)))
+
+    def reached(self, trace, target):
+        """
+        @param trace: complex S11 trace (datapoints values)
+        @return: True when the test must stop
+        """
+        return self.count(trace, target) >= self.min_count
+
+    def margin(self, trace, target):
+        """
+        Continuous version of the stop rule, for trend estimation (trend.py): the k-th largest value of
+        Re(S11) - threshold, with k = min_count. The test stops as soon as the margin is positive.
+        """
+        diff = np.real(trace) - self.threshold(target)
+        return float(np.partition(diff, self.datapoints - self.min_count)[self.datapoints - self.min_count])
+
+    def reached_all(self, traces, target):
+        """
+        Same check on every row of an (iterations, datapoints) array (e.g. S11Store.traces).
+
+        @return: bool array, one value per iteration
+        """
+        over = np.real(traces) > self.threshold(target)
+        return np.count_nonzero(over, axis=1) >= self.min_count
+
+
+@functools.lru_cache(maxsize=8)
+def lookup_table(datapoints):
+    """
+    @return: DielectricCheck with the default thresholds for this number of points (built once)
+    """
+    return DielectricCheck(datapoints)
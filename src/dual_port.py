@@ -0,0 +1,111 @@
+"""
+
+DUAL PORT ACQUISITION - NETWORK ANALYZER E5080A
+
+Atlantic Cancer Research Institute - ACRI
+
+Reusable version of 2Ports_Measurements.py. Channel 1 measures S11 (probe on port 1) and
+channel 2 measures S22 (probe on port 2).
+
+2Ports_Measurements.py triggered each channel on its own with TRIGger:SCOPe CURRent, so two
+probes needed two sweep windows. Here both channels are armed with TRIGger:SCOPe ALL: a single
+INITiate sweeps channel 1 then channel 2 back to back, then each trace is read in one binary
+block with CALC<ch>:MEAS<m>:DATA:SDATA? (corrected real/imaginary pairs, whatever the display
+format). CALCulate:DATA:MSData? would read both in one transfer, but it returns formatted data:
+(dB, 0) pairs with the default LogMag format of the measurements.
+"""
+
+from s11_store import fetch_trace
+
+
+class DualPortAcquisition:
+    def __init__(self, analyzer, measurements=(1, 2)):
+        """
+        @param analyzer: pyvisa resource of the ENA
+        @param measurements: measurement numbers of the S11 (channel 1) and S22 (channel 2) traces
+        """
+        self.analyzer = analyzer
+        self.measurements = measurements
+        self.datapoints = 0
+
+    def configure(self, startFreqHz, stopFreqHz, datapoints, BW, IsLog, sweeptime, startFreqHz2=None,
+                  stopFreqHz2=None):
+        """
+        Creates one trace on each channel and applies the same frequency plan to both (unless a
+        second plan is given for port 2).
+
+        @param sweeptime: sweep time of each channel (s). A trigger takes twice this time.
+        """
+        m1, m2 = self.measurements
+        self.datapoints = int(datapoints)
+
+        if startFreqHz2 is None:
+            startFreqHz2 = startFreqHz
+        if stopFreqHz2 is None:
+            stopFreqHz2 = stopFreqHz
+
+        self.analyzer.write(":DISPlay:SPLit 2")
+
+        # CHANNEL 1 = S11 (port 1) / CHANNEL 2 = S22 (port 2)
+        self.analyzer.write(":CALCulate1:PARameter:COUNt 1")
+        self.analyzer.write("CALCulate1:MEASure" + str(m1) + ":PARameter 'S11'")
+        self.analyzer.write(":CALCulate2:PARameter:COUNt 1")
+        self.analyzer.write("CALCulate2:MEASure" + str(m2) + ":PARameter 'S22'")
+
+        for channel, start, stop in ((1, startFreqHz, stopFreqHz), (2, startFreqHz2, stopFreqHz2)):
+            sens = "SENS" + str(channel)
+            self.analyzer.write(sens + ":SWE:POIN " + str(datapoints))
+            self.analyzer.write(sens + ":FREQ:START " + str(start))
+            self.analyzer.write(sens + ":FREQ:STOP " + str(stop))
+            self.analyzer.write(sens + ":BAND " + str(BW))
+            self.analyzer.write(sens + ":SWE:TIME " + str(sweeptime))
+            if IsLog == 1:
+                self.analyzer.write(sens + ":SWEep:TYPE LOG")
+            else:
+                self.analyzer.write(sens + ":SWEep:TYPE LIN")
+            self.analyzer.write(sens + ":SWE:MODE HOLD")
+
+        # ONE TRIGGER SWEEPS EVERY CHANNEL
+        self.analyzer.write("TRIGger:SCOPe ALL")
+
+        # BINARY TRANSFERS
+        self.analyzer.write("FORM:DATA REAL,32")
+        self.analyzer.write("FORM:BORD SWAP")
+
+    def trigger(self):
+        # Both channels in SINGLE mode, then one trigger for the whole instrument
+        self.analyzer.write("SENS1:SWE:MODE SINGLE")
+        self.analyzer.write("SENS2:SWE:MODE SINGLE")
+        self.analyzer.write("TRIGger:SCOPe ALL")
+        self.analyzer.write("INITiate:IMMediate")
+
+    def wait(self):
+        # INITiate is overlapped: *OPC? answers once both sweeps are done
+        self.analyzer.query("*OPC?")
+
+    def fetch(self):
+        """
+        Reads both traces, one binary transfer each.
+
+        @return: (S11, S22) complex64 arrays
+        """
+        m1, m2 = self.measurements
+        s11 = fetch_trace(self.analyzer, 1, m1)
+        s22 = fetch_trace(self.analyzer, 2, m2)
+
+        for trace in (s11, s22):
+            if len(trace) != self.datapoints:
+                raise IOError("Dual port transfer returned " + str(len(trace)) + " points, expected " +
+                              str(self.datapoints))
+
+        return s11, s22
+
+    def acquire(self):
+        """
+        Trigger, wait for both sweeps and fetch both traces.
+
+        @return: (S11, S22) complex64 arrays
+        """
+        self.trigger()
+        self.wait()
+        return self.fetch()
@@ -0,0 +1,369 @@
+"""
+
+HARDWARE-IN-THE-LOOP TIMING BENCHMARK - FIVE ITERATION TEST CYCLE
+
+Atlantic Cancer Research Institute - ACRI
+
+Runs the OFF/ON cycle of Five_Iteration_Test (ablation_cycle.run_cycle(), the code the test runs)
+against the simulators (sim_e5080a.py, sim_kms200.py) or the real devices, with the same Modbus
+scheduler, KMS200 setpoint driver, safety interlock and watchdog keep-alive as the test, and times
+every phase with time.perf_counter_ns():
+
+    rpower_check    read reg 103 (reflected power safety check)
+    mw_off          reg 2 = 0x00
+    rise_fall       time.sleep(0.001)
+    power_check     read reg 102 (transmitted power must be 0)
+    trigger         SENS1:SWE:MODE SINGLE / TRIG:SCOP CURR / INIT1:IMM
+    sweep_wait      time.sleep(delaimesure)          (--pipelined: *OPC? at the end of the sweep)
+    save            CALC:MEAS:DATA:SNP:PORTs:Save + *OPC?   (--pipelined: not in the OFF window)
+    fetch           binary trace transfer + run store append   (--pipelined: transfer only)
+    on_delay        ON delay of the cycle (--adaptive: interval_scheduler.py)
+    mw_on           reg 2 = 0x50
+    convert         permittivity of the trace (only with a calibration, in the ON delay)
+    on_wait         time.sleep(rest of delaimicro)
+    power_readback  read reg 103 and reg 102
+    gui             live plot update (only when a callback is given)
+    log             log file lines of the cycle (one sample per line)
+
+The report gives, per phase: count, mean, p50, p95, p99 and max (ms) with a text histogram,
+plus the duty cycle achieved (time with microwaves ON / cycle time) vs the requested one
+(delaimicro / (delaimicro + delaimesure)). Results can be saved as JSON and compared with a
+baseline, so that every optimisation is measured against the same cycle.
+
+Usage:
+    python hil_benchmark.py --cycles 50 --on 1 --off 0.2                  (both simulators)
+    python hil_benchmark.py --analyzer usb --generator com --port COM7    (real devices)
+    python hil_benchmark.py --save new.json --baseline old.json
+    python hil_benchmark.py --pipelined --baseline old.json               (pipeline.py vs ENA saves)
+    python hil_benchmark.py --adaptive 0.2 5 0.02 --dielectric 30         (adaptive ON delay, dielectric stop)
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+from s11_store import S11Store, fetch_frequencies
+from pipeline import MeasurementPipeline
+from ablation_cycle import Measurement, run_cycle, CYCLE_DONE
+from modbus_scheduler import ModbusScheduler
+from kms200 import KMS200
+from interlock import Interlock
+from keepalive import WatchdogKeepAlive
+from interval_scheduler import IntervalScheduler
+
+UNIT = 0x01
+
+# SAME AS CircuitAutomatisation_V5_2021.py
+INTERLOCK_PERIOD = 0.02     # s
+WATCHDOG_TIMEOUT = 30.0     # s
+
+PHASES = ['rpower_check', 'mw_off', 'rise_fall', 'power_check', 'trigger', 'sweep_wait', 'save', 'fetch', 'on_delay',
+          'mw_on', 'convert', 'on_wait', 'power_readback', 'gui', 'log']
+
+# HISTOGRAM BINS (ms, logarithmic)
+HISTOGRAM_BINS = [0, 0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000, 10000]
+
+
+class PhaseTimer:
+    def __init__(self):
+        # phase -> list of durations (ns)
+        self.samples = {}
+        self.cycles = []
+        self.on_time = 0
+        self.t_on = None
+        self._phase = None
+        self._t0 = 0
+
+    def begin(self, phase):
+        self._phase = phase
+        self._t0 = time.perf_counter_ns()
+
+    def end(self):
+        t1 = time.perf_counter_ns()
+        self.samples.setdefault(self._phase, []).append(t1 - self._t0)
+        self._phase = None
+        return t1
+
+    """
+    MICROWAVE ON TIME (from the end of the ON write to the end of the next OFF write)
+    """
+    def microwaves_on(self, t_ns=None):
+        self.t_on = time.perf_counter_ns() if t_ns is None else t_ns
+
+    def microwaves_off(self, t_ns=None):
+        if t_ns is None:
+            t_ns = time.perf_counter_ns()
+        if self.t_on is not None:
+            self.on_time += t_ns - self.t_on
+            self.t_on = None
+
+    """
+    RESULTS
+    """
+    def statistics(self):
+        """
+        @return: {phase: {count, mean, p50, p95, p99, max}} in ms
+        """
+        stats = {}
+        for phase in PHASES + sorted(set(self.samples) - set(PHASES)):
+            if phase not in self.samples:
+                continue
+            values = np.asarray(self.samples[phase], dtype=np.float64) / 1e6
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            stats[phase] = {'count': int(len(values)), 'mean': float(values.mean()), 'p50': float(p50),
+                            'p95': float(p95), 'p99': float(p99), 'max': float(values.max())}
+        return stats
+
+    def duty_cycle(self):
+        """
+        @return: achieved duty cycle over the complete cycles
+        """
+        total = sum(self.cycles)
+        return self.on_time / total if total > 0 else 0.0
+
+    def to_dict(self, requested_duty=None):
+        return {'phases': self.statistics(), 'samples': self.samples, 'cycles': self.cycles,
+                'duty_cycle': self.duty_cycle(), 'requested_duty_cycle': requested_duty}
+
+
+"""
+CYCLE
+"""
+def setup(analyzer, client, generator, datapoints, delaimesure, folder, freq=2450, startFreq=2000, stopFreq=3000,
+          BW=1000):
+    # Same configuration as the initialisation of Five_Iteration_Test
+    analyzer.write("SENS1:SWE:POIN " + str(datapoints))
+    analyzer.write("SENS1:FREQ:START " + str(startFreq * 1000000))
+    analyzer.write("SENS1:FREQ:STOP " + str(stopFreq * 1000000))
+    analyzer.write("SENS1:BAND " + str(BW))
+    analyzer.write("SENS1:SWE:TIME " + str(delaimesure))
+    analyzer.write("SENS1:SWE:MODE HOLD")
+    analyzer.write("MMEMory:STOR:TRAC:FORM:SNP RI")
+    analyzer.write("SENS1:SWEep:TYPE LIN")
+    analyzer.write("mmemory:mdirectory 'D:/" + folder + "'")
+
+    generator.refresh()
+    generator.setpoints(frequency=freq * 10)
+    client.write_register(2, 0x10, unit=UNIT)
+    client.write_register(2, 0x00, unit=UNIT)
+
+
+def run_cycles(client, generator, measurement, timer, cycles, delaimicro, delaimesure, power, rpower, interlock=None,
+               scheduler=None, dielectric=None, gui_update=None, log_file=None):
+    """
+    Runs cycles of ablation_cycle.run_cycle() like one step of Five_Iteration_Test and times each phase.
+
+    @param measurement: ablation_cycle.Measurement of the run, timed by timer
+    @param timer: PhaseTimer
+    @param rpower: reflected power limit (W), 0 = 50 % of power and reflected power check of the OFF phase
+    @param interlock: started interlock.Interlock (None = no interlock)
+    @param scheduler: IntervalScheduler giving the ON delay (None = delaimicro)
+    @param dielectric: minimum dielectric value stopping the cycles (None = no check)
+    @param gui_update: callable run where the test refreshes the live plot (None = no GUI)
+    @param log_file: open text file receiving the same log lines as the test (None = os.devnull)
+    @return: timer
+    """
+    rpowergraph = []
+    powergraph = []
+
+    if log_file is None:
+        log_file = open(os.devnull, "w")
+
+    def log(line):
+        timer.begin('log')
+        log_file.write("      " + line + "\n")
+        timer.end()
+
+    def on_delay(trace, acquired):
+        timer.begin('on_delay')
+        delay = scheduler.update(trace, acquired) if scheduler is not None else delaimicro
+        timer.end()
+        return delay
+
+    auto_rpower = 0.5 * power
+    generator.setpoints(rpower=int(rpower) if int(rpower) != 0 else int(auto_rpower), power=int(power))
+
+    for n in range(cycles):
+        t_cycle = time.perf_counter_ns()
+        log("Time: " + time.strftime("%H:%M:%S"))
+
+        cycle = run_cycle(client, measurement, n + 1, delaimesure, on_delay, UNIT, interlock,
+                          auto_rpower if int(rpower) == 0 else None, dielectric, log=log, timer=timer)
+        if cycle.status != CYCLE_DONE:
+            print("Cycle " + str(n + 1) + ": " + cycle.message)
+            break
+
+        rpowergraph.append([cycle.reflected])
+        powergraph.append([cycle.forward])
+
+        if gui_update is not None:
+            timer.begin('gui')
+            gui_update(measurement.store, powergraph, rpowergraph)
+            timer.end()
+
+        log_file.flush()
+        timer.cycles.append(time.perf_counter_ns() - t_cycle)
+
+    # Last ON window ends with the final OFF
+    client.write_register(2, 0x00, unit=UNIT)
+    timer.microwaves_off()
+
+    return timer
+
+
+"""
+REPORT
+"""
+def histogram(values_ms, width=40):
+    counts, edges = np.histogram(values_ms, bins=HISTOGRAM_BINS + [float('inf')])
+    lines = []
+    peak = max(counts.max(), 1)
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        if count == 0:
+            continue
+        label = ("%g-%g ms" % (low, high)) if high != float('inf') else ("> %g ms" % low)
+        lines.append("    %-16s %6d %s" % (label, count, "#" * int(round(width * count / peak))))
+    return "\n".join(lines)
+
+
+def report(results, baseline=None):
+    """
+    @param results: PhaseTimer.to_dict()
+    @param baseline: to_dict() of a previous run (or None)
+    @return: text report
+    """
+    lines = ["%-16s %6s %10s %10s %10s %10s %10s" % ('phase', 'count', 'mean', 'p50', 'p95', 'p99', 'max')]
+    for phase, stats in results['phases'].items():
+        line = "%-16s %6d %10.3f %10.3f %10.3f %10.3f %10.3f" % (phase, stats['count'], stats['mean'], stats['p50'],
+                                                                 stats['p95'], stats['p99'], stats['max'])
+        if baseline is not None and phase in baseline['phases']:
+            line += "   p50 %+.3f ms vs baseline" % (stats['p50'] - baseline['phases'][phase]['p50'])
+        lines.append(line)
+
+    cycles = np.asarray(results['cycles'], dtype=np.float64) / 1e6
+    lines.append("\nCycle time (ms): mean %.3f / p50 %.3f / p99 %.3f" % (cycles.mean(), np.percentile(cycles, 50),
+                                                                        np.percentile(cycles, 99)))
+    lines.append("Duty cycle achieved: %.2f %%" % (100 * results['duty_cycle']))
+    if results['requested_duty_cycle'] is not None:
+        lines.append("Duty cycle requested: %.2f %%" % (100 * results['requested_duty_cycle']))
+    if baseline is not None:
+        lines.append("Duty cycle baseline: %.2f %%" % (100 * baseline['duty_cycle']))
+
+    lines.append("\nHistograms:")
+    for phase in results['phases']:
+        lines.append("  " + phase)
+        lines.append(histogram(np.asarray(results['samples'][phase], dtype=np.float64) / 1e6))
+
+    return "\n".join(lines)
+
+
+"""
+DEVICES
+"""
+def open_devices(args):
+    if args.analyzer == 'sim':
+        from sim_e5080a import SimulatedResourceManager
+        rm = SimulatedResourceManager(disk_root=args.disk, time_scale=args.time_scale)
+    else:
+        import pyvisa
+        rm = pyvisa.ResourceManager()
+    analyzer = rm.open_resource('USB0::0x2A8D::0x0001::MY55201231::0::INSTR')
+
+    if args.generator == 'sim':
+        from sim_kms200 import SimulatedKMS200, SimulatedModbusClient
+        client = SimulatedModbusClient(SimulatedKMS200(), latency=args.latency)
+    elif args.generator == 'tcp':
+        from pymodbus.client.sync import ModbusTcpClient
+        client = ModbusTcpClient('localhost', port=5020, timeout=4)
+    else:
+        from pymodbus.client.sync import ModbusSerialClient
+        client = ModbusSerialClient(method='rtu', port=args.port, timeout=4, baudrate=115200, strict=False)
+
+    return analyzer, client
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Timing benchmark of the Five_Iteration_Test cycle")
+    parser.add_argument('--analyzer', choices=['sim', 'usb'], default='sim')
+    parser.add_argument('--generator', choices=['sim', 'tcp', 'com'], default='sim')
+    parser.add_argument('--port', default='COM7', help="serial port of the generator")
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--on', type=float, default=1.0, help="delaimicro (s)")
+    parser.add_argument('--off', type=float, default=0.2, help="delaimesure (s)")
+    parser.add_argument('--points', type=int, default=201)
+    parser.add_argument('--power', type=int, default=30)
+    parser.add_argument('--rpower', type=int, default=15, help="reflected power limit (W), 0 = 50 %% of the power")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="simulated analyzer delay scale")
+    parser.add_argument('--latency', type=float, default=0.005, help="simulated Modbus transaction time (s)")
+    parser.add_argument('--disk', default="ENA_Disk", help="local folder standing for D:/ (simulated analyzer)")
+    parser.add_argument('--folder', default="Benchmark", help="folder of the .s1p files on D:/")
+    parser.add_argument('--pipelined', action='store_true', help="pipelined measurement (pipeline.py)")
+    parser.add_argument('--adaptive', type=float, nargs=3, metavar=('MIN', 'MAX', 'TOL'),
+                        help="adaptive ON delay (interval_scheduler.py)")
+    parser.add_argument('--dielectric', type=float, help="minimum dielectric value stopping the cycles")
+    parser.add_argument('--no-scheduler', action='store_true', help="Modbus calls without the ModbusScheduler")
+    parser.add_argument('--no-interlock', action='store_true', help="no safety interlock thread")
+    parser.add_argument('--save', help="JSON file receiving the results")
+    parser.add_argument('--baseline', help="JSON results of a previous run to compare with")
+    args = parser.parse_args(argv)
+
+    analyzer, client = open_devices(args)
+    if not args.no_scheduler:
+        client = ModbusScheduler(client)
+    client.connect()
+    generator = KMS200(client, UNIT)
+    interlock = None if args.no_interlock else Interlock(client, period=INTERLOCK_PERIOD, unit=UNIT)
+    keepalive = WatchdogKeepAlive(client, WATCHDOG_TIMEOUT, unit=UNIT)
+    setup(analyzer, client, generator, args.points, args.off, args.folder)
+
+    store_path = os.path.join(args.disk, args.folder, "RunStore " + time.strftime("%Y-%m-%d %H-%M-%S"))
+    store = S11Store(store_path, args.points, args.cycles + 1)
+    store.set_frequencies(fetch_frequencies(analyzer))
+
+    timer = PhaseTimer()
+    scheduler = IntervalScheduler(*args.adaptive, start=args.on) if args.adaptive else None
+    pipeline = None
+    try:
+        pipeline = MeasurementPipeline() if args.pipelined else None
+        disk_root = args.disk if args.analyzer == 'sim' else "D:/"
+        measurement = Measurement(analyzer, args.folder, store, pipeline=pipeline, disk_root=disk_root, timer=timer)
+
+        if interlock is not None:
+            interlock.reset()
+            interlock.start()
+        keepalive.start()
+        run_cycles(client, generator, measurement, timer, args.cycles, args.on, args.off, args.power, args.rpower,
+                   interlock, scheduler, args.dielectric)
+    finally:
+        try:
+            client.write_register(2, 0x00, unit=UNIT)
+            if interlock is not None:
+                interlock.stop()
+            keepalive.stop()
+            # Every queued trace is written before the run store is closed
+            if pipeline is not None:
+                pipeline.close()
+        finally:
+            client.close()
+            if not args.no_scheduler:
+                client.shutdown()
+            store.close()
+
+    results = timer.to_dict(args.on / (args.on + args.off))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as BaselineFile:
+            baseline = json.load(BaselineFile)
+
+    print(report(results, baseline))
+
+    if args.save:
+        with open(args.save, "w") as ResultFile:
+            json.dump(results, ResultFile)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,340 @@
+"""
+
+SAFETY INTERLOCK - KMS200 TELEMETRY MONITOR
+
+Atlantic Cancer Research Institute - ACRI
+
+Thread that reads the telemetry of the generator (regs 102-105, one block read) every period
+seconds, independently of the test loop, and turns the microwaves OFF (reg 2 = 0) as soon as a
+limit is exceeded. The OFF command is sent by the interlock thread itself: the latency is at most
+one period plus two Modbus transactions, whatever the test loop is doing (sleeping during the ON
+delay, waiting on the ENA...).
+
+Limits are declared as a list of dicts:
+
+    {'kind': 'reflected_ratio', 'max': 0.5, 'min_forward': 5, 'samples': 2}
+        reflected / transmitted power above max (only while transmitted >= min_forward W)
+    {'kind': 'reflected_power', 'max': 60, 'samples': 2}
+        reflected power above max (W)
+    {'kind': 'forward_off', 'max': 0, 'settle': 0.05, 'samples': 2}
+        transmitted power above max (W) more than settle s after the microwaves were commanded OFF
+    {'kind': 'comms_loss', 'max': 1.0}
+        no telemetry read for more than max s
+    {'kind': 'pump_stall', 'min_fraction': 0.5, 'max_pressure': 350, 'settle': 10}
+        isocratic pump ON (isocratic_pump.py) with a flow below min_fraction of its setpoint more
+        than settle s after its last command, or a pressure above max_pressure (bar)
+
+'samples' is the number of consecutive readings over the limit before a trip (default 1).
+
+The commanded microwave state comes from the reg 2 writes of the test, seen through the client:
+attach() wraps its methods. The wrappers also hold one lock around every Modbus transaction, so
+the test thread and the interlock thread never talk on the link at the same time (not needed with
+a ModbusScheduler, which runs every transaction on its own thread and sends the OFF command first).
+
+A trip latches: until reset(), the wrappers refuse every reg 2 write with the microwave ON bit
+(InterlockError), so a test that did not see the trip yet can not turn the microwaves back ON.
+
+Every trip is kept in trips: time, limit, message, latency and the last samples before the trip.
+"""
+
+import json
+import time
+import threading
+import collections
+
+from kms200 import *
+
+# TELEMETRY BLOCK: 102 TRANSMITTED, 103 REFLECTED, 104, 105 STATUS
+TELEMETRY_START = REG_FORWARD
+TELEMETRY_COUNT = REG_STATUS - REG_FORWARD + 1
+
+# SAMPLES KEPT WITH A TRIP
+TRIP_SAMPLES = 20
+
+DEFAULT_LIMITS = [
+    {'kind': 'reflected_ratio', 'max': 0.5, 'min_forward': 5, 'samples': 2},
+    {'kind': 'forward_off', 'max': 0, 'settle': 0.05, 'samples': 2},
+    {'kind': 'comms_loss', 'max': 1.0},
+    {'kind': 'pump_stall', 'min_fraction': 0.5, 'max_pressure': 350, 'settle': 10},
+]
+
+LIMIT_KINDS = ('reflected_ratio', 'reflected_power', 'forward_off', 'comms_loss', 'pump_stall')
+
+
+class Sample(collections.namedtuple('Sample', 'time forward reflected status commanded_on')):
+    """
+    time: time.monotonic() of the read / forward, reflected: W / status: reg 105 /
+    commanded_on: last reg 2 write had the microwave ON bit
+    """
+    __slots__ = ()
+
+
+class Trip(collections.namedtuple('Trip', 'time kind message latency samples')):
+    """
+    time: time.time() of the trip / kind: limit / latency: s from the triggering sample to the OFF
+    command acknowledged / samples: last Sample before the trip
+    """
+    __slots__ = ()
+
+
+class InterlockError(IOError):
+    pass
+
+
+class Interlock:
+    def __init__(self, client, limits=None, period=0.02, unit=UNIT, pump=None):
+        """
+        @param client: Modbus client of the generator
+        @param limits: list of limit dicts (see above), DEFAULT_LIMITS if None
+        @param period: time between two telemetry reads (s)
+        @param pump: PumpController of the isocratic pump, None = no pump limit
+        """
+        self.client = client
+        self.limits = [dict(limit) for limit in (DEFAULT_LIMITS if limits is None else limits)]
+        for limit in self.limits:
+            if limit.get('kind') not in LIMIT_KINDS:
+                raise ValueError("Unknown interlock limit: " + str(limit.get('kind')))
+        self.period = period
+        self.unit = unit
+        self.pump = pump
+
+        self.lock = threading.RLock()
+        self.patches = []
+        self.samples = collections.deque(maxlen=TRIP_SAMPLES)
+        self.trips = []
+        self.listeners = []
+        self.over = [0] * len(self.limits)
+        self.active = set()
+
+        self.commanded_on = False
+        self.t_command = time.monotonic()
+        self.t_read = None
+        self.pump_key = None
+        self.pump_since = time.monotonic()
+
+        self.running = False
+        self.worker = None
+        self.attach()
+
+    """
+    CLIENT
+    """
+    def attach(self):
+        """
+        Serialises every Modbus call of the client and follows the reg 2 writes.
+        """
+        for name in ('read_holding_registers', 'write_register', 'write_registers'):
+            if not hasattr(self.client, name):
+                continue
+            original = getattr(self.client, name)
+            instance_attribute = name in vars(self.client)
+            setattr(self.client, name, self._wrapper(name, original))
+            self.patches.append((name, original if instance_attribute else None))
+
+    def _wrapper(self, name, original):
+        # A client that serialises its own transactions (modbus_scheduler.py) is not locked: the test thread
+        # would hold the lock while its request waits in the queue, and delay the OFF command of the interlock
+        serialized = getattr(self.client, 'serialized', False)
+
+        def wrapper(*args, **kwargs):
+            control = self._control(name, args)
+            if control is not None and control & CTRL_MICROWAVE_ON and self.tripped:
+                raise InterlockError("Microwaves ON refused, safety interlock tripped: " + self.last_trip().message)
+            if serialized:
+                result = original(*args, **kwargs)
+            else:
+                with self.lock:
+                    result = original(*args, **kwargs)
+            if control is not None:
+                self._command(control)
+            return result
+        return wrapper
+
+    @staticmethod
+    def _control(name, args):
+        # Value written to reg 2 by a call, None if the call does not write it
+        if name == 'write_register' and args[0] == REG_CONTROL:
+            return args[1]
+        if name == 'write_registers' and args[0] <= REG_CONTROL < args[0] + len(args[1]):
+            return args[1][REG_CONTROL - args[0]]
+        return None
+
+    def detach(self):
+        for name, original in reversed(self.patches):
+            if original is None:
+                delattr(self.client, name)
+            else:
+                setattr(self.client, name, original)
+        self.patches = []
+
+    def _command(self, value):
+        on = bool(value & CTRL_MICROWAVE_ON)
+        if on != self.commanded_on:
+            self.t_command = time.monotonic()
+        self.commanded_on = on
+
+    """
+    THREAD
+    """
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.t_read = time.monotonic()
+        self.over = [0] * len(self.limits)
+        self.active = set()
+        self.worker = threading.Thread(target=self._run, name="Interlock", daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        self.running = False
+        if self.worker is not None and self.worker is not threading.current_thread():
+            self.worker.join()
+        self.worker = None
+
+    def _run(self):
+        next_read = time.monotonic()
+        while self.running:
+            self.poll()
+            next_read += self.period
+            delay = next_read - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_read = time.monotonic()
+
+    def poll(self):
+        """
+        One telemetry read and evaluation of every limit.
+
+        @return: Trip, or None
+        """
+        sample = None
+        try:
+            with self.lock:
+                response = self.client.read_holding_registers(TELEMETRY_START, TELEMETRY_COUNT, unit=self.unit)
+            if response is not None and not (hasattr(response, 'isError') and response.isError()):
+                block = response.registers
+                sample = Sample(time.monotonic(), block[0], block[REG_REFLECTED - TELEMETRY_START],
+                                block[REG_STATUS - TELEMETRY_START], self.commanded_on)
+        except Exception:
+            sample = None
+
+        now = time.monotonic()
+        if sample is not None:
+            self.t_read = sample.time
+            self.samples.append(sample)
+
+        for n, limit in enumerate(self.limits):
+            message = self._check(limit, sample, now)
+            if message is None:
+                self.over[n] = 0
+                self.active.discard(n)
+                continue
+            self.over[n] += 1
+            # One trip per excursion: the limit must clear before it can trip again
+            if self.over[n] >= limit.get('samples', 1) and n not in self.active:
+                self.active.add(n)
+                return self.trip(limit['kind'], message, sample.time if sample is not None else now)
+        return None
+
+    def _check(self, limit, sample, now):
+        kind = limit['kind']
+
+        if kind == 'comms_loss':
+            if self.t_read is not None and now - self.t_read > limit['max']:
+                return "No telemetry for %.2f s" % (now - self.t_read)
+            return None
+
+        if kind == 'pump_stall':
+            return self._check_pump(limit, now)
+
+        if sample is None:
+            return None
+
+        if kind == 'reflected_ratio':
+            if sample.forward >= limit.get('min_forward', 1) and sample.reflected > limit['max'] * sample.forward:
+                return "Reflected power %d W for %d W transmitted (limit %g)" % (sample.reflected, sample.forward,
+                                                                                 limit['max'])
+        elif kind == 'reflected_power':
+            if sample.reflected > limit['max']:
+                return "Reflected power %d W (limit %g W)" % (sample.reflected, limit['max'])
+        elif kind == 'forward_off':
+            if not sample.commanded_on and now - self.t_command > limit.get('settle', 0.05) \
+                    and sample.forward > limit['max']:
+                return "Transmitted power %d W while OFF" % sample.forward
+        return None
+
+    def _check_pump(self, limit, now):
+        if self.pump is None:
+            return None
+        status = self.pump.status()
+        if status.state != "on":
+            return None
+        if status.pressure is not None and status.pressure > limit.get('max_pressure', float('inf')):
+            return "Pump pressure %.0f bar" % status.pressure
+        if status.flow is None or not status.setpoint:
+            return None
+        # The flow needs settle s to reach a new setpoint
+        if (status.state, status.setpoint) != self.pump_key:
+            self.pump_key = (status.state, status.setpoint)
+            self.pump_since = now
+        if now - self.pump_since < limit.get('settle', 10):
+            return None
+        if status.flow < limit.get('min_fraction', 0.5) * status.setpoint:
+            return "Pump flow %.2f ml/min for a setpoint of %.2f ml/min" % (status.flow, status.setpoint)
+        return None
+
+    """
+    TRIP
+    """
+    def trip(self, kind, message, t_sample=None):
+        """
+        Microwaves OFF now, then records the trip.
+        """
+        if t_sample is None:
+            t_sample = time.monotonic()
+        try:
+            with self.lock:
+                self.client.write_register(REG_CONTROL, CTRL_OFF, unit=self.unit)
+        except Exception as error:
+            message += " (OFF command failed: " + str(error) + ")"
+
+        record = Trip(time.time(), kind, message, time.monotonic() - t_sample, list(self.samples))
+        self.trips.append(record)
+        for callback in list(self.listeners):
+            try:
+                callback(record)
+            except Exception:
+                pass
+        return record
+
+    @property
+    def tripped(self):
+        return len(self.trips) > 0
+
+    def last_trip(self):
+        return self.trips[-1] if self.trips else None
+
+    def reset(self):
+        """
+        Clears the trips (new test): the microwaves can be turned ON again.
+        """
+        self.trips = []
+        self.samples.clear()
+        self.over = [0] * len(self.limits)
+        self.active = set()
+
+    def save(self, path):
+        """
+        JSON file of the trips with their samples.
+        """
+        with open(path, "w") as f:
+            json.dump([dict(trip._asdict(), samples=[sample._asdict() for sample in trip.samples])
+                       for trip in self.trips], f, indent=1)
+
+    def subscribe(self, callback):
+        """
+        @param callback: called with the Trip, on the interlock thread
+        """
+        self.listeners.append(callback)
@@ -0,0 +1,84 @@
+"""
+
+ADAPTIVE MEASUREMENT INTERVAL SCHEDULER
+
+Atlantic Cancer Research Institute - ACRI
+
+Chooses the ON delay of each cycle of Five_Iteration_Test from how fast S11 is changing, instead of
+a fixed delaimicro:
+
+    - change = rms(trace - previous trace) / rms(previous trace)
+    - change below the tolerance: the ON delay grows (x GROW), fewer OFF windows while the tissue is
+      stable, so a higher microwave duty cycle
+    - change above the tolerance: the ON delay is scaled down towards the interval that would give a
+      change equal to the tolerance (at most / SHRINK)
+    - change rate (change per second of ON) going up by more than ACCELERATION: the ON delay is
+      shortened at once (x SHRINK)
+
+The ON delay always stays between the bounds set by the operator.
+"""
+
+import time
+import numpy as np
+
+GROW = 1.5
+SHRINK = 0.5
+ACCELERATION = 1.5
+
+
+class IntervalScheduler:
+    def __init__(self, min_on, max_on, tolerance, start=None):
+        """
+        @param min_on, max_on: bounds of the ON delay (s)
+        @param tolerance: relative change between consecutive traces considered stable
+        @param start: first ON delay (s), min_on if None
+        """
+        if min_on <= 0 or max_on < min_on:
+            raise ValueError("ON delay bounds must be 0 < min <= max")
+        if tolerance <= 0:
+            raise ValueError("The tolerance must be positive")
+
+        self.min_on = min_on
+        self.max_on = max_on
+        self.tolerance = tolerance
+        self.start = min_on if start is None else start
+        self.reset()
+
+    def reset(self):
+        self.on_delay = min(max(self.start, self.min_on), self.max_on)
+        self.previous = None
+        self.t_previous = None
+        self.rate = None
+        self.history = []
+
+    def update(self, trace, t=None):
+        """
+        @param trace: S11 trace just measured
+        @param t: time of the trace (s, monotonic), now if None
+        @return: ON delay of the next ON window (s)
+        """
+        if t is None:
+            t = time.monotonic()
+        trace = np.asarray(trace)
+
+        if self.previous is not None:
+            reference = np.sqrt(np.mean(np.abs(self.previous) ** 2))
+            change = np.sqrt(np.mean(np.abs(trace - self.previous) ** 2)) / max(reference, 1e-12)
+            elapsed = max(t - self.t_previous, 1e-6)
+            rate = change / elapsed
+
+            if change < self.tolerance:
+                factor = GROW
+            else:
+                factor = max(self.tolerance / change, SHRINK)
+
+            if self.rate is not None and rate > ACCELERATION * self.rate:
+                factor = min(factor, SHRINK)
+
+            self.on_delay = min(max(self.on_delay * factor, self.min_on), self.max_on)
+            self.rate = rate
+            self.history.append((t, float(change), self.on_delay))
+
+        self.previous = trace.copy()
+        self.t_previous = t
+        return self.on_delay
@@ -0,0 +1,408 @@
+"""
+
+ISOCRATIC PUMP CONTROLLER - AGILENT 1200
+
+Atlantic Cancer Research Institute - ACRI
+
+One long-lived controller for the isocratic (alcohol) pump instead of one os.system() call of a
+LicopDemo executable per state change.
+
+The controller owns a worker thread and one session with the pump. Commands (run at a flow, ON,
+OFF, standby) are queued and return at once with a concurrent.futures.Future. Between commands,
+the worker polls the pump and publishes its status (state, flow, pressure) to status() and to the
+subscribed callbacks. A failed command raises its error from Future.result(): the tests wait for it
+(at most COMMAND_TIMEOUT) before turning the microwaves ON at a new flow or when they stop.
+
+Backends:
+    LicopBackend        the LicopDemo executables used since 2021 (only their pre-built flows)
+    InstrumentBackend   text command session with the pump (RS-232 with pyserial, or LAN), any
+                        flow between 0 and MAX_FLOW, flow and pressure read back
+    MockBackend         pump model in memory (offline runs, simulators)
+
+The command strings of InstrumentBackend are in its COMMANDS table (to check against the command
+reference of the pump firmware, they can be replaced with the commands argument).
+"""
+
+import os
+import time
+import queue
+import socket
+import threading
+import subprocess
+import collections
+import concurrent.futures
+
+# FLOW RANGE OF THE PUMP (ml/min)
+MAX_FLOW = 10.0
+
+# LONGEST WAIT FOR THE RESULT OF A COMMAND (s), same as the timeout of a LicopDemo executable
+COMMAND_TIMEOUT = 60.0
+
+# STATES
+OFF = "off"
+ON = "on"
+STANDBY = "standby"
+FAULT = "fault"
+
+
+class PumpError(IOError):
+    pass
+
+
+PumpStatus = collections.namedtuple('PumpStatus', 'state setpoint flow pressure error time')
+
+
+"""
+BACKENDS
+"""
+class LicopBackend:
+    """
+    Runs the LicopDemo executables (PumpON.exe, PumpON_Flow2.exe...). No read back: the status is
+    the last command.
+    """
+    FLOWS = (0, 1, 2, 2.5, 3, 4, 5, 10)
+
+    def __init__(self, folder="C:/Windows/Licop/LicopDemo", timeout=60.0):
+        self.folder = folder
+        self.timeout = timeout
+
+    def _execute(self, name):
+        result = subprocess.run([os.path.join(self.folder, name)], timeout=self.timeout)
+        if result.returncode != 0:
+            raise PumpError(name + " returned " + str(result.returncode))
+
+    def supports(self, flow):
+        return float(flow) in self.FLOWS
+
+    def run(self, flow):
+        if not self.supports(flow):
+            raise ValueError("No LicopDemo executable for a flow of %g ml/min (available: %s)" %
+                             (flow, ", ".join("%g" % f for f in self.FLOWS)))
+        self._execute("PumpON_Flow%g.exe" % flow)
+
+    def on(self):
+        self._execute("PumpON.exe")
+
+    def off(self):
+        self._execute("PumpOFF.exe")
+
+    def standby(self, end=False):
+        # PumpSTANDBY1 is the default end state of the tests
+        self._execute("PumpSTANDBY1.exe" if end else "PumpSTANDBY.exe")
+
+    def read_status(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class InstrumentBackend:
+    """
+    Line based command session: one command per line, one reply line per command.
+
+    @param connection: object with write(bytes) and readline() (pyserial Serial, socket.makefile('rwb'))
+    """
+    COMMANDS = {
+        'flow': "FLOW %.3f",
+        'on': "PUMP ON",
+        'off': "PUMP OFF",
+        'standby': "PUMP STANDBY",
+        'flow?': "ACT:FLOW?",
+        'pressure?': "ACT:PRES?",
+        'state?': "PUMP?",
+    }
+
+    def __init__(self, connection, commands=None, terminator=b"\n"):
+        self.connection = connection
+        self.commands = dict(self.COMMANDS)
+        if commands:
+            self.commands.update(commands)
+        self.terminator = terminator
+        self.lock = threading.Lock()
+
+    def command(self, text):
+        """
+        @return: reply of the pump (PumpError when it is an error or when it does not answer)
+        """
+        with self.lock:
+            self.connection.write(text.encode("ascii") + self.terminator)
+            if hasattr(self.connection, 'flush'):
+                self.connection.flush()
+            reply = self.connection.readline()
+        if not reply:
+            raise PumpError("No reply from the pump to " + text)
+        reply = reply.decode("ascii", "replace").strip()
+        if reply.upper().startswith("ERR"):
+            raise PumpError(text + ": " + reply)
+        return reply
+
+    def supports(self, flow):
+        return 0 <= float(flow) <= MAX_FLOW
+
+    def run(self, flow):
+        if not self.supports(flow):
+            raise ValueError("Flow must be between 0 and %g ml/min" % MAX_FLOW)
+        self.command(self.commands['flow'] % flow)
+        self.command(self.commands['on'])
+
+    def on(self):
+        self.command(self.commands['on'])
+
+    def off(self):
+        self.command(self.commands['off'])
+
+    def standby(self, end=False):
+        self.command(self.commands['standby'])
+
+    def read_status(self):
+        """
+        @return: (state, flow, pressure) read on the pump
+        """
+        state = self.command(self.commands['state?']).lower()
+        flow = float(self.command(self.commands['flow?']).split()[-1])
+        pressure = float(self.command(self.commands['pressure?']).split()[-1])
+        if "stand" in state:
+            state = STANDBY
+        elif "on" in state.split() or state.endswith("1"):
+            state = ON
+        elif "err" in state or "fault" in state:
+            state = FAULT
+        else:
+            state = OFF
+        return state, flow, pressure
+
+    def close(self):
+        self.connection.close()
+
+
+def open_serial(port, baudrate=19200, timeout=1.0, **kwargs):
+    """
+    InstrumentBackend on an RS-232 port (pyserial).
+    """
+    import serial
+    return InstrumentBackend(serial.Serial(port, baudrate=baudrate, timeout=timeout), **kwargs)
+
+
+def open_lan(host, port=9100, timeout=1.0, **kwargs):
+    """
+    InstrumentBackend on the LAN port of the pump.
+    """
+    connection = socket.create_connection((host, port), timeout=timeout)
+    return InstrumentBackend(connection.makefile('rwb'), **kwargs)
+
+
+class MockBackend:
+    """
+    Pump in memory: the flow ramps to the setpoint at RAMP ml/min per second, the pressure follows
+    the flow. stall = True stands for a blocked line (no flow, pressure at its maximum).
+    """
+    RAMP = 2.0                  # ml/min per s
+    BAR_PER_ML_MIN = 20.0
+    MAX_PRESSURE = 400.0        # bar
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.state = OFF
+        self.setpoint = 1.0
+        self.flow = 0.0
+        self.stall = False
+        self.commands = []
+        self.t_last = clock()
+
+    def _advance(self):
+        now = self.clock()
+        target = self.setpoint if self.state == ON and not self.stall else 0.0
+        step = self.RAMP * (now - self.t_last)
+        if self.flow < target:
+            self.flow = min(self.flow + step, target)
+        else:
+            self.flow = max(self.flow - step, target)
+        self.t_last = now
+
+    def supports(self, flow):
+        return 0 <= float(flow) <= MAX_FLOW
+
+    def run(self, flow):
+        if not self.supports(flow):
+            raise ValueError("Flow must be between 0 and %g ml/min" % MAX_FLOW)
+        self._advance()
+        self.commands.append(('run', flow))
+        self.setpoint = float(flow)
+        self.state = ON
+
+    def on(self):
+        self._advance()
+        self.commands.append(('on',))
+        self.state = ON
+
+    def off(self):
+        self._advance()
+        self.commands.append(('off',))
+        self.state = OFF
+
+    def standby(self, end=False):
+        self._advance()
+        self.commands.append(('standby',))
+        self.state = STANDBY
+
+    def read_status(self):
+        self._advance()
+        if self.stall and self.state == ON:
+            pressure = self.MAX_PRESSURE
+        else:
+            pressure = self.flow * self.BAR_PER_ML_MIN
+        return self.state, self.flow, pressure
+
+    def close(self):
+        pass
+
+
+def open_backend(name):
+    """
+    @param name: 'LICOP', 'MOCK', 'COMx' / '/dev/tty...' (RS-232) or 'LAN:host[:port]'
+    """
+    if name == "LICOP":
+        return LicopBackend()
+    if name == "MOCK":
+        return MockBackend()
+    if name.startswith("LAN:"):
+        address = name[4:].split(":")
+        return open_lan(address[0], int(address[1]) if len(address) > 1 else 9100)
+    return open_serial(name)
+
+
+"""
+CONTROLLER
+"""
+class PumpController:
+    def __init__(self, backend, poll_interval=1.0, name="IsocraticPump"):
+        """
+        @param backend: LicopBackend, InstrumentBackend or MockBackend
+        @param poll_interval: time between two status reads while no command is queued (s)
+        """
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.commands = queue.Queue()
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.closed = False
+        self._status = PumpStatus(OFF, None, None, None, None, time.time())
+
+        self.worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self.worker.start()
+
+    def _run(self):
+        while True:
+            try:
+                job = self.commands.get(timeout=self.poll_interval)
+            except queue.Empty:
+                self._poll()
+                continue
+
+            if job is None:
+                return
+            future, action, args = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                getattr(self.backend, action)(*args)
+            except Exception as error:
+                self._publish(error=str(error))
+                future.set_exception(error)
+                continue
+
+            if action == 'run':
+                self._publish(state=ON, setpoint=float(args[0]))
+            elif action == 'on':
+                self._publish(state=ON)
+            elif action == 'off':
+                self._publish(state=OFF)
+            else:
+                self._publish(state=STANDBY)
+            self._poll()
+            future.set_result(self._status)
+
+    def _poll(self):
+        try:
+            reading = self.backend.read_status()
+        except Exception as error:
+            self._publish(error=str(error))
+            return
+        if reading is not None:
+            state, flow, pressure = reading
+            self._publish(state=state, flow=flow, pressure=pressure, error=None)
+
+    def _publish(self, **changes):
+        with self.lock:
+            self._status = self._status._replace(time=time.time(), **changes)
+            status = self._status
+            listeners = list(self.listeners)
+        for callback in listeners:
+            try:
+                callback(status)
+            except Exception:
+                pass
+
+    def _submit(self, action, *args):
+        if self.closed:
+            raise RuntimeError("The pump controller is closed")
+        future = concurrent.futures.Future()
+        self.commands.put((future, action, args))
+        return future
+
+    """
+    COMMANDS (return a Future of the status after the command)
+    """
+    def run(self, flow):
+        """
+        Pump ON at flow (ml/min).
+        """
+        return self._submit('run', flow)
+
+    def on(self):
+        return self._submit('on')
+
+    def off(self):
+        return self._submit('off')
+
+    def standby(self):
+        return self._submit('standby')
+
+    def end(self):
+        """
+        Default end state of the tests.
+        """
+        return self._submit('standby', True)
+
+    def supports(self, flow):
+        return self.backend.supports(flow)
+
+    """
+    STATUS
+    """
+    def status(self):
+        with self.lock:
+            return self._status
+
+    def subscribe(self, callback):
+        """
+        @param callback: called with the PumpStatus after every command and status read (worker thread)
+        """
+        with self.lock:
+            self.listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.listeners.remove(callback)
+
+    def close(self):
+        """
+        Runs the queued commands, stops the worker and closes the session.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.commands.put(None)
+        self.worker.join()
+        self.backend.close()
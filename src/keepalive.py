@@ -0,0 +1,148 @@
+"""
+
+KMS200 COMMUNICATION WATCHDOG KEEP-ALIVE
+
+Atlantic Cancer Research Institute - ACRI
+
+The generator faults (microwaves OFF, red light) when it receives no Modbus request for the time
+of reg 98 (0.1 s units). The procedures used to write 3000 (300 s) and count on the requests of
+the test to come often enough, which a long ON window does not guarantee.
+
+WatchdogKeepAlive writes the watchdog time of the test (start()) and makes sure a request reaches
+the generator at least every interval = fraction x timeout. Every successful request of the client
+(the telemetry reads of the interlock, the test reads and writes) counts: the keep-alive thread only
+sends its own request, one read of reg 98, when nothing else went out during an interval. The read
+also checks that reg 98 still holds the watchdog time (it is written again after a generator
+restart). stop() puts back the watchdog time found at start().
+
+The watchdog time can then be short (tens of seconds): if the program stops, the generator turns
+itself OFF soon after, while the test keeps it alive as long as it runs.
+"""
+
+import time
+import threading
+
+from kms200 import *
+
+
+class WatchdogKeepAlive:
+    def __init__(self, client, timeout=30.0, fraction=0.25, unit=UNIT):
+        """
+        @param client: Modbus client of the generator (its calls are followed, see attach())
+        @param timeout: watchdog time written to reg 98 while the keep-alive runs (s)
+        @param fraction: longest time without a request, as a fraction of timeout
+        """
+        if not 0 < fraction < 1:
+            raise ValueError("The keep-alive interval must be a fraction of the watchdog time")
+        if int(round(timeout / TIMEOUT_UNIT)) > 0xFFFF:
+            raise ValueError("Watchdog time above " + str(0xFFFF * TIMEOUT_UNIT) + " s")
+        self.client = client
+        self.timeout = timeout
+        self.interval = fraction * timeout
+        self.unit = unit
+
+        self.t_last = time.monotonic()
+        self.sent = 0
+        self.rewritten = 0
+        self.previous = None
+
+        self.patches = []
+        self.wake = threading.Event()
+        self.running = False
+        self.worker = None
+        self.attach()
+
+    """
+    CLIENT
+    """
+    def attach(self):
+        """
+        Follows the requests of the client.
+        """
+        for name in ('read_holding_registers', 'write_register', 'write_registers'):
+            if not hasattr(self.client, name):
+                continue
+            original = getattr(self.client, name)
+            instance_attribute = name in vars(self.client)
+            setattr(self.client, name, self._wrapper(original))
+            self.patches.append((name, original if instance_attribute else None))
+
+    def _wrapper(self, original):
+        def wrapper(*args, **kwargs):
+            result = original(*args, **kwargs)
+            if result is not None and not (hasattr(result, 'isError') and result.isError()):
+                self.t_last = time.monotonic()
+            return result
+        return wrapper
+
+    def detach(self):
+        for name, original in reversed(self.patches):
+            if original is None:
+                delattr(self.client, name)
+            else:
+                setattr(self.client, name, original)
+        self.patches = []
+
+    def register_value(self):
+        """
+        @return: reg 98 value of the watchdog time
+        """
+        return int(round(self.timeout / TIMEOUT_UNIT))
+
+    """
+    THREAD
+    """
+    def start(self):
+        """
+        Writes the watchdog time and starts the keep-alive thread.
+        """
+        if self.running:
+            return
+        response = self.client.read_holding_registers(REG_TIMEOUT, 1, unit=self.unit)
+        if response is not None and not (hasattr(response, 'isError') and response.isError()):
+            self.previous = response.registers[0]
+        self.client.write_register(REG_TIMEOUT, self.register_value(), unit=self.unit)
+
+        self.running = True
+        self.wake.clear()
+        self.worker = threading.Thread(target=self._run, name="WatchdogKeepAlive", daemon=True)
+        self.worker.start()
+
+    def stop(self, restore=True):
+        """
+        @param restore: write back the watchdog time found by start()
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.wake.set()
+        if self.worker is not threading.current_thread():
+            self.worker.join()
+        self.worker = None
+        if restore and self.previous is not None:
+            self.client.write_register(REG_TIMEOUT, self.previous, unit=self.unit)
+
+    def _run(self):
+        while self.running:
+            remaining = self.t_last + self.interval - time.monotonic()
+            if remaining > 0:
+                self.wake.wait(remaining)
+                continue
+            self.refresh()
+
+    def refresh(self):
+        """
+        Own request: reads reg 98, written again if the generator lost it.
+        """
+        try:
+            response = self.client.read_holding_registers(REG_TIMEOUT, 1, unit=self.unit)
+            self.sent += 1
+            if response is None or (hasattr(response, 'isError') and response.isError()):
+                # Tried again after one interval (several tries within the watchdog time)
+                self.t_last = time.monotonic()
+                return
+            if response.registers[0] != self.register_value():
+                self.client.write_register(REG_TIMEOUT, self.register_value(), unit=self.unit)
+                self.rewritten += 1
+        except Exception:
+            self.t_last = time.monotonic()
@@ -0,0 +1,214 @@
+"""
+
+SAIREM KMS200 MICROWAVE GENERATOR - MODBUS REGISTER MAP
+
+Atlantic Cancer Research Institute - ACRI
+
+Holding registers used by this software (see the KMS200 Modbus documentation --> Cabinet 18,
+room 455, IARC). Frequencies are in 100 kHz units (MHz * 10), powers in W.
+
+The meaning of the reg 105 status bits is taken from the values seen during automatic scans
+(160, 32 and 224 all mean "scan complete").
+
+KMS200: setpoint driver keeping a shadow of holding registers 0-17 and 98. refresh() reads them
+(two block reads), set() only writes the registers that differ from the shadow, one request per
+contiguous run of changed registers (function 16 when more than one), and checks them with one
+block read (plus one for reg 98). The control word (reg 2) is always written.
+"""
+
+# SLAVE ADDRESS OF THE GENERATOR
+UNIT = 0x01
+
+# CONTROL / SETPOINT REGISTERS
+REG_POWER = 0               # Transmitted power setpoint (W)
+REG_RPOWER_LIMIT = 1        # Reflected power limit (W)
+REG_CONTROL = 2             # Control word, see CTRL_*
+REG_START_MODE = 3          # Starting mode, bit 0 = 0 -> normal
+REG_FREQUENCY = 9           # Working frequency (100 kHz)
+REG_SCAN_START = 11         # Scan start frequency (100 kHz)
+REG_SCAN_STOP = 12          # Scan stop frequency (100 kHz)
+REG_SCAN_STEP = 16          # Scan frequency step (100 kHz)
+REG_SCAN_CONTROL = 17       # Scan control word, see SCAN_*
+REG_TIMEOUT = 98            # Communication watchdog (0.1 s units, 3000 = 300 s)
+
+# MEASUREMENT / STATUS REGISTERS
+REG_FORWARD = 102           # Measured transmitted power (W)
+REG_REFLECTED = 103         # Measured reflected power (W)
+REG_STATUS = 105            # Status word, see STATUS_*
+REG_SCAN_PENDING = 109      # Scan data still being prepared (0 = ready)
+REG_FREQUENCY_READ = 112    # Working frequency readback (100 kHz)
+REG_SCAN_MIN_FREQ = 113     # Frequency of the reflected power minimum (100 kHz)
+REG_SCAN_MIN_REFLECTED = 114    # Reflected power at the minimum (W)
+REG_SCAN_MIN_FORWARD = 115      # Transmitted power at the minimum (W)
+
+# SCAN RECORD (filled in scan data mode): number of points, then (frequency, reflected power) pairs
+REG_SCAN_COUNT = 110
+REG_SCAN_RECORD = 200
+SCAN_RECORD_MAX = 400
+
+# REG 2 CONTROL BITS
+CTRL_RPOWER_LIMIT = 0x10    # Reflected power limitation mode
+CTRL_MICROWAVE_ON = 0x40    # Microwaves ON
+CTRL_FAULT_RESET = 0x80     # Fault reset (write 1 then 0)
+CTRL_OFF = 0x00
+CTRL_ON = CTRL_RPOWER_LIMIT | CTRL_MICROWAVE_ON     # 0x50
+
+# REG 17 SCAN CONTROL BITS
+SCAN_MODE = 0x01            # Automatic frequency scan
+SCAN_DATA = 0x04            # Scan data mode (results are prepared in 109-115 and the record)
+
+# REG 105 STATUS BITS
+STATUS_FAULT = 0x01
+STATUS_WATCHDOG = 0x02
+STATUS_RPOWER_LIMITED = 0x04
+STATUS_SCAN_COMPLETE = 0x20
+STATUS_RPOWER_LIMIT_MODE = 0x40
+STATUS_MICROWAVE_ON = 0x80
+
+STATUS_FLAGS = {
+    STATUS_FAULT: 'fault',
+    STATUS_WATCHDOG: 'watchdog',
+    STATUS_RPOWER_LIMITED: 'rpower_limited',
+    STATUS_SCAN_COMPLETE: 'scan_complete',
+    STATUS_RPOWER_LIMIT_MODE: 'rpower_limit_mode',
+    STATUS_MICROWAVE_ON: 'microwave_on',
+}
+
+# WATCHDOG UNIT (s)
+TIMEOUT_UNIT = 0.1
+
+
+def decode_status(value):
+    """
+    @param value: content of reg 105
+    @return: set of the names of the bits that are set (see STATUS_FLAGS)
+    """
+    return set(name for bit, name in STATUS_FLAGS.items() if value & bit)
+
+
+# REGISTERS KEPT IN THE SHADOW OF KMS200
+SHADOW_START = REG_POWER
+SHADOW_COUNT = REG_SCAN_CONTROL - REG_POWER + 1
+SHADOW_REGISTERS = tuple(range(SHADOW_START, SHADOW_START + SHADOW_COUNT)) + (REG_TIMEOUT,)
+
+# NAMES ACCEPTED BY KMS200.setpoints()
+SETPOINTS = {
+    'power': REG_POWER,
+    'rpower': REG_RPOWER_LIMIT,
+    'control': REG_CONTROL,
+    'start_mode': REG_START_MODE,
+    'frequency': REG_FREQUENCY,
+    'scan_start': REG_SCAN_START,
+    'scan_stop': REG_SCAN_STOP,
+    'scan_step': REG_SCAN_STEP,
+    'scan_control': REG_SCAN_CONTROL,
+    'timeout': REG_TIMEOUT,
+}
+
+
+class KMS200:
+    def __init__(self, client, unit=UNIT):
+        """
+        @param client: Modbus client of the generator (pymodbus, ModbusScheduler or SimulatedModbusClient)
+        """
+        self.client = client
+        self.unit = unit
+        self.shadow = {}
+        self.writes = 0
+        self.skipped = 0
+
+    def _read(self, address, count):
+        response = self.client.read_holding_registers(address, count, unit=self.unit)
+        if response is None or (hasattr(response, 'isError') and response.isError()):
+            raise IOError("Modbus read of " + str(count) + " registers at " + str(address) + " failed: " + str(response))
+        return response.registers
+
+    def refresh(self):
+        """
+        Reads the shadowed registers from the generator (after a restart, the front panel or another program).
+        """
+        values = self._read(SHADOW_START, SHADOW_COUNT)
+        self.shadow = dict(zip(range(SHADOW_START, SHADOW_START + SHADOW_COUNT), values))
+        self.shadow[REG_TIMEOUT] = self._read(REG_TIMEOUT, 1)[0]
+
+    def invalidate(self, addresses=None):
+        """
+        Forgets registers written without this driver (all if None): their next set() writes them.
+        """
+        if addresses is None:
+            self.shadow = {}
+        else:
+            for address in addresses:
+                self.shadow.pop(address, None)
+
+    def value(self, address):
+        """
+        @return: last value written or read, None if unknown
+        """
+        return self.shadow.get(address)
+
+    def set(self, values, verify=True, force=False):
+        """
+        @param values: {register: value}, registers of SHADOW_REGISTERS
+        @param verify: read the written registers back (one block read, one more for reg 98)
+        @param force: write even the registers equal to the shadow
+        @return: list of the registers written
+        """
+        changed = {}
+        for address, value in values.items():
+            if address not in SHADOW_REGISTERS:
+                raise ValueError("Register " + str(address) + " is not a generator setpoint")
+            value = int(value) & 0xFFFF
+            if force or address == REG_CONTROL or self.shadow.get(address) != value:
+                changed[address] = value
+            else:
+                self.skipped += 1
+        if not changed:
+            return []
+
+        # RUNS OF CONTIGUOUS REGISTERS
+        runs = []
+        for address in sorted(changed):
+            if runs and address == runs[-1][0] + len(runs[-1][1]):
+                runs[-1][1].append(changed[address])
+            else:
+                runs.append((address, [changed[address]]))
+
+        for address, run in runs:
+            if len(run) == 1:
+                self.client.write_register(address, run[0], unit=self.unit)
+            else:
+                self.client.write_registers(address, run, unit=self.unit)
+            self.writes += 1
+            # Written registers are known, the shadow is only trusted after the check
+            for offset, value in enumerate(run):
+                self.shadow[address + offset] = value
+
+        if verify:
+            # One block read from the first to the last register written of 0-17, reg 98 on its own
+            readback = {}
+            block = [address for address in changed if address != REG_TIMEOUT]
+            if block:
+                start = min(block)
+                readback.update(zip(range(start, max(block) + 1), self._read(start, max(block) - start + 1)))
+            if REG_TIMEOUT in changed:
+                readback[REG_TIMEOUT] = self._read(REG_TIMEOUT, 1)[0]
+            for address, value in changed.items():
+                # Control bits such as the fault reset are not kept by the generator
+                if address == REG_CONTROL:
+                    self.shadow[REG_CONTROL] = readback[address]
+                elif readback[address] != value:
+                    self.shadow.pop(address, None)
+                    raise IOError("Generator register " + str(address) + " is " + str(readback[address]) +
+                                  " instead of " + str(value))
+        return sorted(changed)
+
+    def setpoints(self, verify=True, **values):
+        """
+        set() with names (see SETPOINTS), in register units: power and rpower in W, frequencies in 100 kHz,
+        timeout in 0.1 s.
+
+        @return: {name: value} of the generator after the call
+        """
+        self.set(dict((SETPOINTS[name], value) for name, value in values.items()), verify)
+        return dict((name, self.shadow.get(SETPOINTS[name])) for name in values)
@@ -0,0 +1,118 @@
+"""
+
+LIST FREQUENCY SWEEP - GENERATOR FREQUENCY PLAN WITH ONE S11 RUN
+
+Atlantic Cancer Research Institute - ACRI
+
+Fast version of the manual mode of Freq_sweep. The generator frequencies are computed once as a
+plan (frequency_plan) and the ENA is configured once. Each step only does what the physics needs:
+
+    microwaves ON at the frequency of the step for on_delay
+    transmitted / reflected power read in one block read (regs 102-103)
+    microwaves OFF, single sweep of the ENA
+    generator retuned to the next frequency of the plan while the ENA sweeps
+    trace read in one binary transfer (no .s1p file saved by the ENA per step)
+
+The OFF window lasts the sweep and the transfer, and at least off_delay. Every trace of the sweep
+goes into one S11 run store (one row per generator frequency); the plan and the powers are saved
+beside it (sweep.npz).
+"""
+
+import os
+import time
+import numpy as np
+
+from kms200 import *
+from s11_store import fetch_trace
+
+SWEEP_FILE = "sweep.npz"
+
+
+def frequency_plan(startfreq, stopfreq, stepfreq):
+    """
+    @param startfreq, stopfreq, stepfreq: MHz (100 kHz resolution of reg 9)
+    @return: generator frequencies of the sweep (MHz), stop included when it falls on a step
+    """
+    start = int(round(startfreq * 10))
+    stop = int(round(stopfreq * 10))
+    step = max(int(round(stepfreq * 10)), 1)
+    if stop < start:
+        raise ValueError("Stop frequency is below the start frequency")
+    return np.arange(start, stop + 1, step, dtype=np.int64) / 10.0
+
+
+class ListSweep:
+    def __init__(self, plan, store):
+        """
+        @param plan: generator frequencies (MHz), see frequency_plan()
+        @param store: S11Store receiving one trace per frequency
+        """
+        self.plan = np.asarray(plan, dtype=np.float64)
+        self.store = store
+        self.forward = np.full(len(self.plan), np.nan)
+        self.reflected = np.full(len(self.plan), np.nan)
+        self.times = np.full(len(self.plan), np.nan)
+        self.completed = 0
+        self.aborted = None
+
+    def run(self, analyzer, client, on_delay, off_delay, rpower_limit=None, unit=UNIT, progress=None):
+        """
+        @param on_delay: microwave ON time of each step (s)
+        @param off_delay: shortest OFF window of each step (s)
+        @param rpower_limit: reflected power (W) that stops the sweep, None = no check
+        @param progress: called with (step, number of steps) after each step
+        @return: number of steps completed (self.aborted holds the reason of an early stop)
+        """
+        analyzer.write("SENS1:SWE:MODE HOLD")
+        client.write_register(REG_FREQUENCY, int(round(self.plan[0] * 10)), unit=unit)
+
+        for k in range(len(self.plan)):
+            # MICROWAVES ON AT THE FREQUENCY OF THE STEP
+            client.write_register(REG_CONTROL, CTRL_ON, unit=unit)
+            time.sleep(on_delay)
+            power = client.read_holding_registers(REG_FORWARD, 2, unit=unit).registers
+            self.forward[k] = power[0]
+            self.reflected[k] = power[1]
+
+            # MICROWAVES OFF, THEN SWEEP
+            client.write_register(REG_CONTROL, CTRL_OFF, unit=unit)
+            t_off = time.monotonic()
+            self.times[k] = time.time()
+
+            if rpower_limit is not None and power[1] > rpower_limit:
+                self.aborted = "Reflected power of " + str(power[1]) + " W at " + str(self.plan[k]) + " MHz"
+                break
+
+            analyzer.write("SENS1:SWE:MODE SINGLE")
+            analyzer.write("TRIGger:SCOPe CURRent")
+            analyzer.write("INITiate1:IMMediate")
+
+            # Next frequency while the ENA sweeps (microwaves are OFF)
+            if k + 1 < len(self.plan):
+                client.write_register(REG_FREQUENCY, int(round(self.plan[k + 1] * 10)), unit=unit)
+
+            analyzer.query("*OPC?")
+            self.store.append(fetch_trace(analyzer), self.times[k])
+            self.completed = k + 1
+
+            if progress is not None:
+                progress(k + 1, len(self.plan))
+
+            remaining = off_delay - (time.monotonic() - t_off)
+            if remaining > 0 and k + 1 < len(self.plan):
+                time.sleep(remaining)
+
+        self.store.flush()
+        self.save()
+        return self.completed
+
+    def traces(self):
+        """
+        @return: (completed steps, datapoints) view of the S11 traces, row k = generator at plan[k]
+        """
+        return self.store.traces[:self.completed]
+
+    def save(self):
+        np.savez(os.path.join(self.store.path, SWEEP_FILE), frequency=self.plan[:self.completed],
+                 forward=self.forward[:self.completed], reflected=self.reflected[:self.completed],
+                 times=self.times[:self.completed])
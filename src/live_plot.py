@@ -0,0 +1,240 @@
+"""
+
+LIVE S11 AND POWER PLOT PANEL
+
+Atlantic Cancer Research Institute - ACRI
+
+Embedded PySimpleGUI panel showing, while a test is running:
+    - the latest S11 trace on a Smith chart
+    - |S11| at the centre frequency vs time
+    - forward and reflected power vs time
+
+The panel reads the in-memory run store (see s11_store.py) and the power lists filled by the test.
+Only new samples are drawn at each cycle. When a time axis is full, its range is doubled and the
+whole series is redrawn once, decimated to one min/max pair per pixel column. A 1601 points
+trace is reduced to the pixels it actually covers before being drawn on the Smith chart.
+"""
+
+import time
+import numpy as np
+import PySimpleGUI as sg
+
+
+"""
+DECIMATION
+"""
+def minmax_decimate(x, y, x_start, x_stop, buckets):
+    """
+    Level of detail reduction of a time series: keeps the min and the max of y inside each pixel
+    column. The drawn shape is identical to the full series at that resolution.
+
+    @param x: increasing x values
+    @param y: y values
+    @param x_start, x_stop: x range covered by the graph
+    @param buckets: number of pixel columns
+    @return: (x, y) arrays with at most 2 * buckets points
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    if len(x) <= 2 * buckets:
+        return x, y
+
+    column = ((x - x_start) * (buckets / (x_stop - x_start))).astype(np.int64)
+    column = np.clip(column, 0, buckets - 1)
+
+    # x is increasing, so the columns are sorted: every column is one contiguous block
+    starts = np.flatnonzero(np.r_[True, column[1:] != column[:-1]])
+    y_min = np.minimum.reduceat(y, starts)
+    y_max = np.maximum.reduceat(y, starts)
+    x_col = x_start + (column[starts] + 0.5) * ((x_stop - x_start) / buckets)
+
+    return np.repeat(x_col, 2), np.column_stack((y_min, y_max)).ravel()
+
+
+def pixel_decimate(points, pixels):
+    """
+    Level of detail reduction of a 2-D curve (Smith chart): consecutive points falling in the
+    same pixel are dropped.
+
+    @param points: complex array (x = real, y = imaginary)
+    @param pixels: number of pixels per unit
+    @return: complex array
+    """
+    points = np.asarray(points)
+    if len(points) < 3:
+        return points
+
+    grid = np.round(points * pixels)
+    keep = np.r_[True, grid[1:] != grid[:-1]]
+    keep[-1] = True
+    return points[keep]
+
+
+"""
+LIVE PLOT PANEL
+"""
+class LivePlotPanel:
+    def __init__(self, width=380, height=240, key_prefix='_LIVE'):
+        self.width = width
+        self.height = height
+        self.margin = 30
+
+        self.smith_key = key_prefix + 'SMITH_'
+        self.s11_key = key_prefix + 'S11_'
+        self.power_key = key_prefix + 'POWER_'
+
+        self.smith = sg.Graph(canvas_size=(height, height), graph_bottom_left=(-1.1, -1.1),
+                              graph_top_right=(1.1, 1.1), background_color='white', key=self.smith_key)
+        self.s11 = sg.Graph(canvas_size=(width, height), graph_bottom_left=(0, 0), graph_top_right=(width, height),
+                            background_color='white', key=self.s11_key)
+        self.power = sg.Graph(canvas_size=(width, height), graph_bottom_left=(0, 0),
+                              graph_top_right=(width, height), background_color='white', key=self.power_key)
+
+        self.reset()
+
+    def layout(self):
+        return [[sg.Text('Smith chart (last trace)', font=("Helvetica", 12), size=(22, 1)),
+                 sg.Text('|S11| at centre frequency vs time', font=("Helvetica", 12), size=(32, 1)),
+                 sg.Text('Forward (red) / reflected (blue) power vs time', font=("Helvetica", 12))],
+                [self.smith, self.s11, self.power]]
+
+    def reset(self):
+        """
+        Forgets the previous run. Axes are redrawn at the next update.
+        """
+        self.t0 = None
+        self.drawn = False
+        self.smith_trace = None
+
+        # Time series kept by the panel: (time, value) of every sample already received
+        self.s11_t = []
+        self.s11_y = []
+        self.power_t = []
+        self.fwd_y = []
+        self.ref_y = []
+
+        # Number of samples already drawn and current axis ranges
+        self.s11_drawn = 0
+        self.power_drawn = 0
+        self.t_range = 60.0
+        self.s11_range = (0.0, 1.0)
+        self.power_range = 10.0
+
+    """
+    AXES
+    """
+    def _draw_smith_grid(self):
+        self.smith.erase()
+        self.smith.draw_circle((0, 0), 1, line_color='black')
+        self.smith.draw_line((-1, 0), (1, 0), color='grey')
+        for r in (0.2, 0.5, 1, 2, 5):
+            self.smith.draw_circle((r / (1 + r), 0), 1 / (1 + r), line_color='light grey')
+        self.smith_trace = None
+
+    def _draw_time_axes(self, graph, label_low, label_high):
+        graph.erase()
+        m = self.margin
+        graph.draw_line((m, m), (self.width - 5, m), color='black')
+        graph.draw_line((m, m), (m, self.height - 5), color='black')
+        graph.draw_text(label_low, (m - 2, m), font=("Helvetica", 7), text_location=sg.TEXT_LOCATION_RIGHT)
+        graph.draw_text(label_high, (m - 2, self.height - 10), font=("Helvetica", 7),
+                        text_location=sg.TEXT_LOCATION_RIGHT)
+        graph.draw_text(str(int(self.t_range)) + " s", (self.width - 15, m - 10), font=("Helvetica", 7))
+
+    def _to_pixels(self, t, y, y_low, y_high):
+        m = self.margin
+        px = m + np.asarray(t) * ((self.width - m - 5) / self.t_range)
+        py = m + (np.asarray(y) - y_low) * ((self.height - m - 5) / (y_high - y_low))
+        return px, py
+
+    def _draw_series(self, graph, t, y, y_low, y_high, color, first):
+        # first = index of the last sample already on screen, so the new segment joins the old one
+        t = t[max(first - 1, 0):]
+        y = y[max(first - 1, 0):]
+        if len(t) < 2:
+            return
+
+        t, y = minmax_decimate(t, y, 0.0, self.t_range, self.width - self.margin)
+        px, py = self._to_pixels(t, y, y_low, y_high)
+        graph.draw_lines(list(zip(px.tolist(), py.tolist())), color=color)
+
+    """
+    UPDATE
+    """
+    def update(self, store, powergraph, rpowergraph):
+        """
+        Draws the samples received since the previous call.
+
+        @param store: S11Store of the run
+        @param powergraph: forward power list of the test ([value] per sample)
+        @param rpowergraph: reflected power list of the test ([value] per sample)
+        """
+        now = time.time()
+        if self.t0 is None:
+            self.t0 = now
+
+        if not self.drawn:
+            self._draw_smith_grid()
+            self._draw_time_axes(self.s11, "%.2f" % self.s11_range[0], "%.2f" % self.s11_range[1])
+            self._draw_time_axes(self.power, "0 W", str(int(self.power_range)) + " W")
+            self.drawn = True
+
+        redraw_s11 = False
+        redraw_power = False
+
+        # NEW S11 SAMPLES (zero-copy column of the run store)
+        count = len(store)
+        if count > len(self.s11_y):
+            column = store.datapoints // 2
+            magnitude = np.abs(store.frequency_slice(column)[len(self.s11_y):count])
+            self.s11_y.extend(magnitude.tolist())
+            self.s11_t.extend((store.timestamps[len(self.s11_t):count] - self.t0).tolist())
+
+            low, high = self.s11_range
+            if min(magnitude) < low or max(magnitude) > high:
+                self.s11_range = (min(low, float(np.floor(min(magnitude) * 10) / 10)),
+                                  max(high, float(np.ceil(max(magnitude) * 10) / 10)))
+                redraw_s11 = True
+
+            # Latest trace on the Smith chart, only the pixels it covers
+            trace = pixel_decimate(store.iteration(count - 1), self.height / 2.2)
+            if self.smith_trace is not None:
+                self.smith.delete_figure(self.smith_trace)
+            self.smith_trace = self.smith.draw_lines(list(zip(trace.real.tolist(), trace.imag.tolist())), color='red')
+
+        # NEW POWER SAMPLES
+        n_power = min(len(powergraph), len(rpowergraph))
+        if n_power > len(self.fwd_y):
+            new_fwd = [float(p[0]) for p in powergraph[len(self.fwd_y):n_power]]
+            new_ref = [float(p[0]) for p in rpowergraph[len(self.ref_y):n_power]]
+            self.power_t.extend([now - self.t0] * len(new_fwd))
+            self.fwd_y.extend(new_fwd)
+            self.ref_y.extend(new_ref)
+
+            if max(new_fwd + new_ref) > self.power_range:
+                while max(new_fwd + new_ref) > self.power_range:
+                    self.power_range *= 2
+                redraw_power = True
+
+        # TIME AXIS FULL: DOUBLE ITS RANGE AND REDRAW EVERYTHING ONCE
+        if now - self.t0 > self.t_range:
+            while now - self.t0 > self.t_range:
+                self.t_range *= 2
+            redraw_s11 = True
+            redraw_power = True
+
+        if redraw_s11:
+            self._draw_time_axes(self.s11, "%.2f" % self.s11_range[0], "%.2f" % self.s11_range[1])
+            self.s11_drawn = 0
+        if redraw_power:
+            self._draw_time_axes(self.power, "0 W", str(int(self.power_range)) + " W")
+            self.power_drawn = 0
+
+        self._draw_series(self.s11, self.s11_t, self.s11_y, self.s11_range[0], self.s11_range[1], 'black',
+                          self.s11_drawn)
+        self.s11_drawn = len(self.s11_y)
+
+        self._draw_series(self.power, self.power_t, self.fwd_y, 0.0, self.power_range, 'red', self.power_drawn)
+        self._draw_series(self.power, self.power_t, self.ref_y, 0.0, self.power_range, 'blue', self.power_drawn)
+        self.power_drawn = len(self.fwd_y)
@@ -0,0 +1,285 @@
+"""
+
+MODBUS TRANSACTION SCHEDULER - GENERATOR SERIAL LINE
+
+Atlantic Cancer Research Institute - ACRI
+
+One worker thread owns the Modbus client of the generator and runs every transaction. The test
+procedures, the manual controls, the safety interlock and the scan monitor submit their requests to
+three priority lanes:
+
+    SAFETY      microwaves OFF (reg 2 written without the microwave ON bit)
+    CONTROL     every other write, connect / close
+    TELEMETRY   reads
+
+The worker always takes the oldest request of the highest priority lane. A transaction already on
+the line is never interrupted: a microwaves OFF command waits at most for the end of the current
+transaction, whatever the number of reads queued before it.
+
+Consecutive writes of a lane to contiguous registers (same slave) are sent as one write_registers
+request (function 16), e.g. a power setpoint followed by the reflected power limit.
+
+ModbusScheduler has the client methods used by this software (connect, close, write_register,
+write_registers, read_holding_registers), so it replaces the client object as it is: the calls
+block until their transaction is done and return its response. submit() gives a Future instead.
+
+metrics(): per lane queue depth (current / highest), number of transactions and of batched writes,
+waiting time in the queue and transaction time (p50 / p95 / max, ms).
+"""
+
+import time
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+
+from kms200 import *
+
+# LANES (LOWER = SERVED FIRST)
+SAFETY = 0
+CONTROL = 1
+TELEMETRY = 2
+LANE_NAMES = ('safety', 'control', 'telemetry')
+
+# LATENCIES KEPT PER LANE FOR THE METRICS
+METRICS_WINDOW = 1000
+
+# LARGEST BATCHED WRITE (MODBUS LIMIT OF FUNCTION 16)
+MAX_WRITE = 123
+
+
+class Request:
+    def __init__(self, lane, action, args, kwargs):
+        self.lane = lane
+        self.action = action
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+        self.t_submit = time.monotonic()
+
+    def write_block(self):
+        """
+        @return: (address, values, unit) of a write, None for any other request
+        """
+        if self.action == 'write_register':
+            return self.args[0], [self.args[1]], self.kwargs.get('unit', UNIT)
+        if self.action == 'write_registers':
+            return self.args[0], list(self.args[1]), self.kwargs.get('unit', UNIT)
+        return None
+
+
+def classify(action, args):
+    """
+    @return: lane of a client call
+    """
+    if action == 'write_register' and args[0] == REG_CONTROL and not args[1] & CTRL_MICROWAVE_ON:
+        return SAFETY
+    if action == 'write_registers' and args[0] <= REG_CONTROL < args[0] + len(args[1]) \
+            and not args[1][REG_CONTROL - args[0]] & CTRL_MICROWAVE_ON:
+        return SAFETY
+    if action == 'read_holding_registers':
+        return TELEMETRY
+    return CONTROL
+
+
+class ModbusScheduler:
+    # The scheduler serialises the transactions itself (see interlock.py)
+    serialized = True
+
+    def __init__(self, client, name="ModbusScheduler"):
+        """
+        @param client: Modbus client of the generator (pymodbus or sim_kms200.SimulatedModbusClient)
+        """
+        self.client = client
+        self.lanes = [collections.deque() for _ in LANE_NAMES]
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.max_depth = [0] * len(LANE_NAMES)
+        self.transactions = [0] * len(LANE_NAMES)
+        self.batched = [0] * len(LANE_NAMES)
+        self.waits = [collections.deque(maxlen=METRICS_WINDOW) for _ in LANE_NAMES]
+        self.services = [collections.deque(maxlen=METRICS_WINDOW) for _ in LANE_NAMES]
+
+        self.worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self.worker.start()
+
+    def __getattr__(self, name):
+        # Other attributes of the client (timeout, port...)
+        if name == 'client':
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+    """
+    SUBMISSION
+    """
+    def submit(self, action, *args, lane=None, **kwargs):
+        """
+        @param action: client method ('write_register', 'write_registers', 'read_holding_registers', 'connect', 'close')
+        @param lane: SAFETY, CONTROL or TELEMETRY, from the call if None (see classify())
+        @return: concurrent.futures.Future of the response
+        """
+        if lane is None:
+            lane = classify(action, args)
+        request = Request(lane, action, args, kwargs)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The Modbus scheduler is closed")
+            self.lanes[lane].append(request)
+            self.max_depth[lane] = max(self.max_depth[lane], len(self.lanes[lane]))
+            self.condition.notify()
+        return request.future
+
+    def _call(self, action, *args, **kwargs):
+        if threading.current_thread() is self.worker:
+            # Called from a response callback: already on the line
+            return getattr(self.client, action)(*args, **kwargs)
+        return self.submit(action, *args, **kwargs).result()
+
+    """
+    CLIENT METHODS
+    """
+    def connect(self):
+        return self._call('connect')
+
+    def close(self):
+        """
+        Closes the client (it reconnects on the next transaction), the scheduler keeps running.
+        """
+        return self._call('close')
+
+    def write_register(self, address, value, unit=UNIT, **kwargs):
+        return self._call('write_register', address, value, unit=unit, **kwargs)
+
+    def write_registers(self, address, values, unit=UNIT, **kwargs):
+        return self._call('write_registers', address, values, unit=unit, **kwargs)
+
+    def read_holding_registers(self, address, count=1, unit=UNIT, **kwargs):
+        return self._call('read_holding_registers', address, count, unit=unit, **kwargs)
+
+    def shutdown(self):
+        """
+        Runs the queued requests and stops the worker.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        self.worker.join()
+
+    """
+    WORKER
+    """
+    def _next(self):
+        # Oldest request of the highest priority lane, with the contiguous writes that follow it
+        for lane in self.lanes:
+            if not lane:
+                continue
+            batch = [lane.popleft()]
+            block = batch[0].write_block()
+            if block is None:
+                return batch
+            address, values, unit = block
+            while lane:
+                following = lane[0].write_block()
+                if following is None or following[2] != unit or following[0] != address + len(values) \
+                        or len(values) + len(following[1]) > MAX_WRITE:
+                    break
+                batch.append(lane.popleft())
+                values = values + following[1]
+            return batch
+        return None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                batch = self._next()
+                while batch is None:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                    batch = self._next()
+
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            first = batch[0]
+            t_start = time.monotonic()
+            try:
+                if len(batch) == 1:
+                    response = getattr(self.client, first.action)(*first.args, **first.kwargs)
+                else:
+                    address, values, unit = first.write_block()
+                    for request in batch[1:]:
+                        values = values + request.write_block()[1]
+                    response = self.client.write_registers(address, values, unit=unit)
+            except Exception as error:
+                response = error
+            t_end = time.monotonic()
+
+            lane = first.lane
+            with self.condition:
+                self.transactions[lane] += 1
+                if len(batch) > 1:
+                    self.batched[lane] += len(batch)
+                for request in batch:
+                    self.waits[lane].append(t_start - request.t_submit)
+                self.services[lane].append(t_end - t_start)
+
+            for request in batch:
+                if isinstance(response, Exception):
+                    request.future.set_exception(response)
+                else:
+                    request.future.set_result(response)
+
+    """
+    METRICS
+    """
+    def depth(self, lane=None):
+        """
+        @return: number of queued requests of a lane, of every lane if None
+        """
+        with self.condition:
+            if lane is None:
+                return sum(len(queue) for queue in self.lanes)
+            return len(self.lanes[lane])
+
+    def metrics(self):
+        """
+        @return: {lane: {depth, max_depth, transactions, batched, wait_p50, wait_p95, wait_max,
+                  service_p50, service_p95, service_max}}, times in ms
+        """
+        report = {}
+        with self.condition:
+            for lane, name in enumerate(LANE_NAMES):
+                stats = {'depth': len(self.lanes[lane]), 'max_depth': self.max_depth[lane],
+                         'transactions': self.transactions[lane], 'batched': self.batched[lane]}
+                for key, values in (('wait', self.waits[lane]), ('service', self.services[lane])):
+                    values = np.asarray(values, dtype=np.float64) * 1000
+                    if len(values) == 0:
+                        stats.update({key + '_p50': 0.0, key + '_p95': 0.0, key + '_max': 0.0})
+                    else:
+                        p50, p95 = np.percentile(values, [50, 95])
+                        stats.update({key + '_p50': float(p50), key + '_p95': float(p95),
+                                      key + '_max': float(values.max())})
+                report[name] = stats
+        return report
+
+    def metrics_text(self):
+        lines = ["%-10s %6s %6s %8s %8s %10s %10s %10s %10s" % ('lane', 'depth', 'max', 'trans.', 'batched',
+                                                                'wait p50', 'wait p95', 'wait max', 'line p95')]
+        for name, stats in self.metrics().items():
+            lines.append("%-10s %6d %6d %8d %8d %10.3f %10.3f %10.3f %10.3f" % (
+                name, stats['depth'], stats['max_depth'], stats['transactions'], stats['batched'],
+                stats['wait_p50'], stats['wait_p95'], stats['wait_max'], stats['service_p95']))
+        return "\n".join(lines)
+
+    def reset_metrics(self):
+        with self.condition:
+            self.max_depth = [len(lane) for lane in self.lanes]
+            self.transactions = [0] * len(LANE_NAMES)
+            self.batched = [0] * len(LANE_NAMES)
+            for values in self.waits + self.services:
+                values.clear()
@@ -0,0 +1,303 @@
+"""
+
+MULTI-STATION ORCHESTRATOR
+
+Atlantic Cancer Research Institute - ACRI
+
+Runs several ablation stations (station.py) from one workstation. Each station has its own runner
+process (multiprocessing): its devices are opened in that process only, so a blocked VISA or Modbus
+call, a crash or a safety stop on one bench never holds the others.
+
+The Coordinator, in the main process:
+    - sends the jobs (protocol file + run folder) to the runner of their station, or to the idle
+      station with the shortest queue when no station is given
+    - follows every runner through one event queue: job start / end / error, step changes, safety
+      trips and the telemetry record of each cycle
+    - keeps the state of each station (idle, running, error, stopped, dead when its process ended
+      without saying so) and the last telemetry of every station in one table (telemetry_text())
+
+Usage:
+    python orchestrator.py stations.json "Bench A=liver.json" "Bench B=liver.json,Sample 2" any=muscle.json
+"""
+
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import collections
+import multiprocessing
+
+from station import Station, load_stations, run_protocol
+from protocol import load_protocol
+
+# STATES OF A STATION
+IDLE = "idle"
+RUNNING = "running"
+ERROR = "error"
+STOPPED = "stopped"
+DEAD = "dead"
+
+# TELEMETRY RECORDS KEPT PER STATION
+HISTORY = 1000
+
+
+class Job(collections.namedtuple('Job', 'number protocol directory')):
+    """
+    number: job number of the coordinator / protocol: protocol file (protocol.load_protocol) /
+    directory: run folder name under the root of the station
+    """
+    __slots__ = ()
+
+
+def station_runner(config, jobs, events):
+    """
+    Runner process of one station: opens its devices, then runs its jobs until None.
+
+    @param config: station.StationConfig
+    @param jobs: multiprocessing queue of Job
+    @param events: multiprocessing queue of (station name, kind, time, data)
+    """
+    def publish(kind, data):
+        events.put((config.name, kind, time.time(), data))
+
+    try:
+        station = Station(config).open()
+    except Exception as error:
+        publish('error', {'job': None, 'message': "Devices could not be opened: " + str(error)})
+        return
+
+    publish('ready', {'pid': os.getpid()})
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            publish('start', {'job': job.number, 'protocol': job.protocol})
+            try:
+                timeline = load_protocol(job.protocol).compile(station.pump)
+                result = run_protocol(station, timeline, job.directory, publish)
+                result['job'] = job.number
+                publish('end', result)
+            except Exception as error:
+                publish('error', {'job': job.number, 'message': str(error)})
+    finally:
+        station.close()
+        publish('stopped', {})
+
+
+class StationHandle:
+    def __init__(self, config, context, events):
+        self.config = config
+        self.name = config.name
+        self.jobs = context.Queue()
+        self.process = context.Process(target=station_runner, args=(config, self.jobs, events),
+                                       name="Station " + config.name, daemon=True)
+        self.state = IDLE
+        self.queued = []
+        self.current = None
+        self.last_event = None
+        self.telemetry = collections.deque(maxlen=HISTORY)
+        self.results = []
+
+
+class Coordinator:
+    def __init__(self, configs, start_method="spawn"):
+        """
+        @param configs: list of station.StationConfig
+        @param start_method: multiprocessing start method ('spawn' is the only one on Windows)
+        """
+        self.context = multiprocessing.get_context(start_method)
+        self.events = self.context.Queue()
+        self.stations = collections.OrderedDict((config.name, StationHandle(config, self.context, self.events))
+                                                for config in configs)
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.jobs = 0
+        self.running = False
+        self.monitor = None
+
+    def start(self):
+        self.running = True
+        for handle in self.stations.values():
+            handle.process.start()
+        self.monitor = threading.Thread(target=self._monitor, name="Coordinator", daemon=True)
+        self.monitor.start()
+
+    def stop(self, timeout=None):
+        """
+        Lets every runner finish its queued jobs, then stops them.
+        """
+        for handle in self.stations.values():
+            if handle.process.is_alive():
+                handle.jobs.put(None)
+        for handle in self.stations.values():
+            handle.process.join(timeout)
+        self.running = False
+        if self.monitor is not None:
+            self.monitor.join()
+
+    """
+    SCHEDULING
+    """
+    def submit(self, protocol, directory, station=None):
+        """
+        @param protocol: protocol file
+        @param directory: run folder name
+        @param station: station name, None = idle station with the shortest queue
+        @return: job number
+        """
+        with self.lock:
+            if station is None:
+                candidates = [handle for handle in self.stations.values() if handle.state in (IDLE, RUNNING)]
+                if not candidates:
+                    raise RuntimeError("No station can take the job")
+                handle = min(candidates, key=lambda h: (len(h.queued) + (h.current is not None), h.state != IDLE))
+            else:
+                handle = self.stations[station]
+                if handle.state in (STOPPED, DEAD):
+                    raise RuntimeError(station + " is " + handle.state)
+            self.jobs += 1
+            job = Job(self.jobs, protocol, directory)
+            handle.queued.append(job)
+        handle.jobs.put(job)
+        return job.number
+
+    def idle(self):
+        """
+        @return: True when no station has a job to run
+        """
+        with self.lock:
+            return all(not handle.queued and handle.current is None for handle in self.stations.values())
+
+    def wait(self, poll=1.0, report=None):
+        """
+        Blocks until every job is over.
+
+        @param report: called every poll seconds (progress display)
+        """
+        while not self.idle():
+            time.sleep(poll)
+            if report is not None:
+                report()
+
+    """
+    MONITORING
+    """
+    def subscribe(self, callback):
+        """
+        @param callback: called with (station name, kind, time, data) for every event (coordinator thread)
+        """
+        self.listeners.append(callback)
+
+    def _monitor(self):
+        while True:
+            try:
+                event = self.events.get(timeout=0.5)
+            except queue.Empty:
+                self._check_processes()
+                if not self.running and not any(handle.process.is_alive() for handle in self.stations.values()):
+                    return
+                continue
+            self._handle(event)
+            for callback in list(self.listeners):
+                try:
+                    callback(*event)
+                except Exception:
+                    pass
+
+    def _handle(self, event):
+        name, kind, t, data = event
+        with self.lock:
+            handle = self.stations[name]
+            handle.last_event = t
+            if kind == 'start':
+                handle.state = RUNNING
+                handle.current = handle.queued.pop(0) if handle.queued else None
+            elif kind == 'cycle':
+                handle.telemetry.append(data)
+            elif kind == 'end':
+                handle.results.append(data)
+                handle.current = None
+                handle.state = IDLE
+            elif kind == 'error':
+                handle.results.append(data)
+                if data.get('job') is None:
+                    # Devices could not be opened: the queued jobs will never run
+                    handle.state = ERROR
+                    handle.queued = []
+                else:
+                    handle.current = None
+                    handle.state = IDLE
+            elif kind == 'stopped':
+                handle.state = STOPPED
+                handle.queued = []
+                handle.current = None
+
+    def _check_processes(self):
+        with self.lock:
+            for handle in self.stations.values():
+                if handle.state not in (STOPPED, DEAD, ERROR) and handle.process.exitcode is not None:
+                    handle.state = DEAD
+                    handle.results.append({'job': handle.current.number if handle.current else None,
+                                           'message': "Runner process ended with code " + str(handle.process.exitcode)})
+                    handle.queued = []
+                    handle.current = None
+
+    def status(self):
+        """
+        @return: {station: {state, job, queued, telemetry (last record or None), results}}
+        """
+        with self.lock:
+            return dict((name, {'state': handle.state,
+                                'job': handle.current.number if handle.current else None,
+                                'queued': len(handle.queued),
+                                'telemetry': handle.telemetry[-1] if handle.telemetry else None,
+                                'results': list(handle.results)})
+                        for name, handle in self.stations.items())
+
+    def telemetry_text(self):
+        lines = ["%-16s %-8s %5s %6s %10s %10s %8s %10s %s" % ('station', 'state', 'job', 'queue', 'forward W',
+                                                              'reflect W', 'flow', 'pressure', 'trip')]
+        for name, status in self.status().items():
+            record = status['telemetry'] or {}
+            lines.append("%-16s %-8s %5s %6d %10s %10s %8s %10s %s" % (
+                name, status['state'], status['job'] or '-', status['queued'],
+                _value(record.get('forward')), _value(record.get('reflected')), _value(record.get('flow')),
+                _value(record.get('pressure')), 'YES' if record.get('tripped') else ''))
+        return "\n".join(lines)
+
+
+def _value(value):
+    return '-' if value is None else "%g" % value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs ablation protocols on several stations")
+    parser.add_argument('stations', help="JSON station file (station.py)")
+    parser.add_argument('jobs', nargs='+', help="station=protocol[,run folder], station 'any' = first idle station")
+    parser.add_argument('--poll', type=float, default=2.0, help="time between two telemetry displays (s)")
+    args = parser.parse_args(argv)
+
+    coordinator = Coordinator(load_stations(args.stations))
+    coordinator.subscribe(lambda name, kind, t, data: print(name + ": " + kind + " " + str(data))
+                          if kind in ('ready', 'start', 'end', 'error', 'trip', 'stopped') else None)
+    coordinator.start()
+    try:
+        for text in args.jobs:
+            station, _, job = text.partition('=')
+            protocol, _, directory = job.partition(',')
+            if not directory:
+                directory = os.path.splitext(os.path.basename(protocol))[0]
+            coordinator.submit(protocol, directory, None if station == 'any' else station)
+        coordinator.wait(args.poll, lambda: print(coordinator.telemetry_text() + "\n"))
+    finally:
+        coordinator.stop()
+
+    print(coordinator.telemetry_text())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+"""
+
+S11 TO COMPLEX PERMITTIVITY - OPEN-ENDED COAXIAL PROBE
+
+Atlantic Cancer Research Institute - ACRI
+
+Converts S11 traces measured with the open-ended coaxial probe into the complex permittivity of the
+tissue, eps = eps' - j eps''.
+
+Probe model: the admittance of the probe aperture is linear in the permittivity of the material
+(capacitive model, Y = jw(Cf + eps C0)), and the ENA sees that admittance through an unknown
+two-port (cable, connector, probe body). The measured reflection is then a bilinear (Moebius)
+function of eps, fixed at each frequency by three reference measurements:
+
+    air     eps = 1
+    short   eps -> infinity (aperture shorted)
+    water   eps = Debye model of water at the calibration temperature
+
+Inverting the bilinear map with the short as its pole gives, at every frequency:
+
+    eps = (alpha * S11 + beta) / (S11 - S11_short)
+
+alpha and beta come from the air and water references (cross-ratio / Marsland-Evans calibration).
+Radiation of the aperture is neglected (valid while the probe is small vs the wavelength in the
+tissue).
+
+Everything is computed with NumPy broadcasting: one trace (datapoints,) or a whole run
+(iterations, datapoints) at once.
+"""
+
+import numpy as np
+
+# DEBYE MODEL OF WATER (Kaatze 1989 / Malmberg & Maryott 1956)
+WATER_TAU_A = 3.745e-15      # s
+WATER_TAU_B = 7.00e-5        # 1/degC^2
+WATER_TAU_T0 = 27.5          # degC
+WATER_TAU_E = 2295.7         # K
+
+
+def debye_water(frequencies, temperature=25.0):
+    """
+    Complex permittivity of pure water (single Debye relaxation).
+
+    @param frequencies: Hz (array)
+    @param temperature: degC
+    @return: complex array, eps' - j eps''
+    """
+    t = float(temperature)
+    eps_s = 87.74 - 0.40008 * t + 9.398e-4 * t ** 2 - 1.410e-6 * t ** 3
+    eps_inf = 5.77 - 0.0274 * t
+    tau = WATER_TAU_A * (1 + WATER_TAU_B * (t - WATER_TAU_T0) ** 2) * np.exp(WATER_TAU_E / (t + 273.15))
+
+    w = 2 * np.pi * np.asarray(frequencies, dtype=np.float64)
+    return eps_inf + (eps_s - eps_inf) / (1 + 1j * w * tau)
+
+
+class ProbeCalibration:
+    def __init__(self, frequencies, alpha, beta, s11_short):
+        """
+        Calibration coefficients of the probe at each frequency (see from_references()).
+
+        @param frequencies: Hz
+        @param alpha, beta: complex coefficients of the bilinear map
+        @param s11_short: S11 measured on the short (pole of the map)
+        """
+        self.frequencies = np.asarray(frequencies, dtype=np.float64)
+        self.alpha = np.asarray(alpha, dtype=np.complex128)
+        self.beta = np.asarray(beta, dtype=np.complex128)
+        self.s11_short = np.asarray(s11_short, dtype=np.complex128)
+
+        if not (self.alpha.shape == self.beta.shape == self.s11_short.shape == self.frequencies.shape):
+            raise ValueError("Calibration coefficients and frequency axis must have the same length")
+
+    @classmethod
+    def from_references(cls, frequencies, s11_air, s11_short, s11_water, temperature=25.0, eps_water=None):
+        """
+        Calibration from the three reference measurements (same frequency axis as the test).
+
+        @param s11_air, s11_short, s11_water: complex S11 traces (several rows are averaged)
+        @param temperature: temperature of the water (degC)
+        @param eps_water: permittivity of the third reference (Debye water at temperature if None)
+        """
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        air = _mean_trace(s11_air)
+        short = _mean_trace(s11_short)
+        water = _mean_trace(s11_water)
+
+        if eps_water is None:
+            eps_water = debye_water(frequencies, temperature)
+
+        # eps(air) = 1 and eps(water) = eps_water, with the short as the pole
+        alpha = (eps_water * (water - short) - (air - short)) / (water - air)
+        beta = (air - short) - alpha * air
+        return cls(frequencies, alpha, beta, short)
+
+    """
+    CONVERSION
+    """
+    def to_permittivity(self, s11):
+        """
+        @param s11: complex array (..., datapoints), e.g. one trace or S11Store.traces
+        @return: complex128 array of the same shape, eps' - j eps''
+        """
+        s11 = np.asarray(s11)
+        if s11.shape[-1] != len(self.frequencies):
+            raise ValueError("Trace has " + str(s11.shape[-1]) + " points, calibration has " +
+                             str(len(self.frequencies)))
+        return (self.alpha * s11 + self.beta) / (s11 - self.s11_short)
+
+    def to_s11(self, eps):
+        """
+        Inverse conversion (expected S11 of a material), e.g. to turn a permittivity target into an
+        S11 threshold for dielectric_check.py.
+        """
+        eps = np.asarray(eps)
+        return (self.beta + eps * self.s11_short) / (eps - self.alpha)
+
+    def eps_prime(self, s11):
+        return self.to_permittivity(s11).real
+
+    def eps_second(self, s11):
+        return -self.to_permittivity(s11).imag
+
+    def coefficients(self):
+        """
+        @return: {name: array} to save the calibration (see calibration_cache.py)
+        """
+        return {'frequencies': self.frequencies, 'alpha': self.alpha, 'beta': self.beta,
+                's11_short': self.s11_short}
+
+
+def _mean_trace(traces):
+    traces = np.asarray(traces)
+    if traces.ndim == 2:
+        return traces.astype(np.complex128).mean(axis=0)
+    return traces.astype(np.complex128)
+
+
+"""
+LIVE CONVERSION OF A RUN
+"""
+class RunPermittivity:
+    def __init__(self, calibration=None, band=None):
+        """
+        Mean permittivity of each trace of a run, converted as the traces are measured.
+
+        @param calibration: ProbeCalibration on the frequency axis of the run, None = nothing is converted
+        @param band: (start, stop) Hz of the means (see summary()), whole axis if None
+        """
+        self.calibration = calibration
+        self.band = band
+        self.eps_prime = []
+        self.eps_second = []
+
+    def convert(self, trace):
+        """
+        @param trace: complex S11 trace (datapoints,)
+        @return: (eps', eps'') mean of the trace, None without calibration
+        """
+        if self.calibration is None:
+            return None
+        eps_prime, eps_second = summary(self.calibration.to_permittivity(trace), self.calibration.frequencies,
+                                        self.band)
+        self.eps_prime.append(float(eps_prime[0]))
+        self.eps_second.append(float(eps_second[0]))
+        return self.eps_prime[-1], self.eps_second[-1]
+
+    def __len__(self):
+        return len(self.eps_prime)
+
+
+"""
+BULK CONVERSION OF A RUN
+"""
+def convert_store(store, calibration, chunk=512, out=None):
+    """
+    Converts every trace of an S11Store, chunk rows at a time so a long run never has to be loaded
+    entirely in memory.
+
+    @param store: S11Store (or any (iterations, datapoints) array)
+    @param calibration: ProbeCalibration on the same frequency axis
+    @param out: array receiving the result (e.g. a complex64 np.memmap), allocated if None
+    @return: (iterations, datapoints) permittivity array
+    """
+    traces = store.traces if hasattr(store, 'traces') else np.asarray(store)
+    if out is None:
+        out = np.empty(traces.shape, dtype=np.complex64)
+
+    for start in range(0, len(traces), chunk):
+        out[start:start + chunk] = calibration.to_permittivity(traces[start:start + chunk])
+    return out
+
+
+def summary(eps, frequencies, band=None):
+    """
+    Mean eps' and eps'' of each trace over a frequency band (one value per iteration, as in the
+    "Permitivite dielectrique reel/im" columns of the Excel file).
+
+    @param eps: (iterations, datapoints) or (datapoints,) permittivity
+    @param band: (start, stop) Hz, whole axis if None
+    @return: (eps_prime, eps_second) arrays
+    """
+    eps = np.atleast_2d(eps)
+    frequencies = np.asarray(frequencies)
+    if band is None:
+        columns = slice(None)
+    else:
+        columns = (frequencies >= band[0]) & (frequencies <= band[1])
+    selected = eps[:, columns]
+    return selected.real.mean(axis=1), -selected.imag.mean(axis=1)
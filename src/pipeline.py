@@ -0,0 +1,87 @@
+"""
+
+MEASUREMENT PIPELINE
+
+Atlantic Cancer Research Institute - ACRI
+
+Bounded background queue for the work that does not need the microwaves OFF.
+
+During the OFF window only the sweep and one binary transfer of the trace are done (see
+ablation_cycle.Measurement). Everything else is handed to this queue and runs on a worker thread
+while the microwaves are ON: run store append, writing the .s1p file, checks on the trace, log lines...
+
+The queue is bounded: when the worker falls more than maxsize jobs behind, submit() blocks, so a
+slow disk slows the test down instead of filling the memory. A failed job does not stop the worker.
+Its exception is raised by the next check(), drain() or close(), in the test thread: check() is
+called at every cycle (ablation_cycle.py), so a failed write stops the test at the next OFF window.
+"""
+
+import queue
+import threading
+
+
+class MeasurementPipeline:
+    def __init__(self, maxsize=8, name="MeasurementPipeline"):
+        self.jobs = queue.Queue(maxsize=maxsize)
+        self.errors = []
+        self.lock = threading.Lock()
+        self.done = 0
+        self.closed = False
+
+        self.worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self.worker.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                func, args, kwargs = job
+                func(*args, **kwargs)
+            except Exception as error:
+                with self.lock:
+                    self.errors.append(error)
+            finally:
+                with self.lock:
+                    self.done += 1
+                self.jobs.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues func(*args, **kwargs). Blocks while the queue is full.
+        """
+        if self.closed:
+            raise RuntimeError("The measurement pipeline is closed")
+        self.jobs.put((func, args, kwargs))
+
+    def pending(self):
+        return self.jobs.unfinished_tasks
+
+    def check(self):
+        """
+        Raises the first error of the jobs already done (if any), without waiting for the others.
+        """
+        with self.lock:
+            errors = self.errors
+            self.errors = []
+        if errors:
+            raise errors[0]
+
+    def drain(self):
+        """
+        Waits for every queued job, then raises the first error of the failed jobs (if any).
+        """
+        self.jobs.join()
+        self.check()
+
+    def close(self):
+        """
+        Runs the remaining jobs and stops the worker.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.jobs.put(None)
+        self.worker.join()
+        self.check()
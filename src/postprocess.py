@@ -0,0 +1,182 @@
+"""
+
+RUN POST-PROCESSING - AVERAGE FILE AND EXCEL EXPORT FROM THE S11 RUN STORE
+
+Atlantic Cancer Research Institute - ACRI
+
+Versions of S_Averages and Excel_Data_Format (CircuitAutomatisation_V5_2021.py) that only need
+the run folder of station.run_protocol(): the S11 run store and its telemetry file. They do not
+read any .s1p file from the ENA disk and can run in the background while the next run is measured
+(run_queue.py).
+
+    averages    one line per trace: mean frequency, mean real and imaginary part of S11, in the
+                DonneesMoyennes/<directory>.s1p layout of S_Averages, plus the relative standard
+                deviation (%) of the real and imaginary parts
+    excel       DonneesMoyennes/<directory>.xlsx, sheet <directory>, from row 14: time (s), mean
+                eps' / eps'' when the run folder holds the calibration of the probe (mean S11
+                real / imaginary otherwise), transmitted and reflected power of the following ON
+                window, standard deviations (needs openpyxl)
+
+Each step can be run again on the same run folder (the output files are rewritten).
+"""
+
+import os
+import json
+import numpy as np
+
+from s11_store import S11Store
+from station import TELEMETRY_FILE
+from permittivity import convert_store
+from calibration_cache import read_calibration, RUN_CALIBRATION_FILE
+
+# OUTPUT FOLDER OF THE AVERAGE AND EXCEL FILES
+OUTPUT = "D:/Ablation_Automatisation/Programmation/Automatisation_Andre/DonneesMoyennes"
+
+# FIRST ROW OF THE DATA IN THE EXCEL SHEET (Excel_Data_Format)
+EXCEL_FIRST_ROW = 14
+
+
+def run_averages(run_path):
+    """
+    @return: (frequencies, mean frequency, mean real (iterations,), mean imaginary (iterations,),
+              relative stdev of the real parts (%), relative stdev of the imaginary parts (%), timestamps)
+    """
+    store = S11Store(run_path, mode='r')
+    try:
+        if len(store) == 0:
+            raise ValueError("No trace in " + str(run_path))
+        frequencies = np.asarray(store.frequencies, dtype=np.float64)
+        traces = np.asarray(store.traces)
+        reel = traces.real.astype(np.float64)
+        im = traces.imag.astype(np.float64)
+        av_reel = reel.mean(axis=1)
+        av_im = im.mean(axis=1)
+        # Same ratios as S_Averages: statistics.stdev (n - 1) / mean, in %
+        et_reel = np.abs(reel.std(axis=1, ddof=1) / av_reel) * 100
+        et_im = np.abs(im.std(axis=1, ddof=1) / av_im) * 100
+        timestamps = np.array(store.timestamps, dtype=np.float64)
+    finally:
+        store.close()
+    return frequencies, frequencies.mean(), av_reel, av_im, et_reel, et_im, timestamps
+
+
+def s_averages(run_path, directory, output=OUTPUT):
+    """
+    Average file of a run (S_Averages).
+
+    @return: path of the .s1p file
+    """
+    frequencies, av_f, av_reel, av_im, et_reel, et_im, timestamps = run_averages(run_path)
+    os.makedirs(output, exist_ok=True)
+    filename = os.path.join(output, directory + ".s1p")
+    with open(filename, "w") as AverageFile:
+        AverageFile.write("!Keysight E5080A averages of each trace\n")
+        AverageFile.write("!Run: " + str(run_path) + "\n")
+        AverageFile.write("!S1P File: Measurement: S11\n")
+        AverageFile.write("!Freq ReS11 ImS11\n")
+        AverageFile.write("# Hz S RI R 50\n")
+        for k in range(len(av_reel)):
+            AverageFile.write(str(round(av_f, 0)) + " " + str(round(av_reel[k], 8)) + " " + str(round(av_im[k], 8)) + " \n")
+    np.savetxt(os.path.join(run_path, "stdev.csv"), np.column_stack((et_reel, et_im)), delimiter=",",
+               header="Ecart-Type Reel (%),Ecart-Type Im (%)", comments="")
+    return filename
+
+
+def run_permittivity(run_path):
+    """
+    Mean permittivity of each trace, with the calibration saved in the run folder.
+
+    @return: (mean eps' (iterations,), mean eps'' (iterations,), stdev of eps' (iterations,),
+              stdev of eps'' (iterations,)), None when the run has no calibration
+    """
+    filename = os.path.join(run_path, RUN_CALIBRATION_FILE)
+    if not os.path.exists(filename):
+        return None
+    calibration = read_calibration(filename)
+    store = S11Store(run_path, mode='r')
+    try:
+        eps = convert_store(store, calibration)
+    finally:
+        store.close()
+    eps_prime = eps.real.astype(np.float64)
+    eps_second = -eps.imag.astype(np.float64)
+    return (eps_prime.mean(axis=1), eps_second.mean(axis=1), eps_prime.std(axis=1, ddof=1),
+            eps_second.std(axis=1, ddof=1))
+
+
+def _telemetry(run_path, count):
+    # Transmitted / reflected power of the ON window after each trace (None when there was none)
+    forward = [None] * count
+    reflected = [None] * count
+    path = os.path.join(run_path, TELEMETRY_FILE)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            for record in json.load(f):
+                k = record.get('trace')
+                if k is not None and 0 <= k < count:
+                    forward[k] = record.get('forward')
+                    reflected[k] = record.get('reflected')
+    return forward, reflected
+
+
+def excel_export(run_path, directory, output=OUTPUT):
+    """
+    Excel file of a run (layout of Excel_Data_Format), created or updated.
+
+    @return: path of the .xlsx file
+    """
+    import openpyxl
+
+    frequencies, av_f, av_reel, av_im, et_reel, et_im, timestamps = run_averages(run_path)
+    forward, reflected = _telemetry(run_path, len(av_reel))
+    permittivity = run_permittivity(run_path)
+
+    os.makedirs(output, exist_ok=True)
+    filename = os.path.join(output, directory + ".xlsx")
+    if os.path.exists(filename):
+        wb = openpyxl.load_workbook(filename=filename)
+    else:
+        wb = openpyxl.Workbook()
+        wb.remove(wb.active)
+    # Excel sheet names are limited to 31 characters
+    sheet_name = directory[:31]
+    sheet_ranges = wb[sheet_name] if sheet_name in wb.sheetnames else wb.create_sheet(sheet_name)
+
+    # Same columns as Excel_Data_Format when the permittivity is known
+    if permittivity is not None:
+        reel, im, sd_reel, sd_im = permittivity
+        et_reel = np.abs(sd_reel / reel) * 100
+        et_im = np.abs(sd_im / im) * 100
+        headers = ['Temps (s)', 'Permitivite dielectrique reel', 'Permitivite dielectrique im', 'Puissance transmise (W)',
+                   'Puissance réfléchie (W)', 'Écart-Type Réel (%)', 'Écart-Type Im (%)', 'Écart-Type Réel (eps prime)',
+                   'Écart-Type Im (eps prime prime)']
+    else:
+        reel, im = av_reel, av_im
+        headers = ['Temps (s)', 'S11 reel moyen', 'S11 im moyen', 'Puissance transmise (W)', 'Puissance réfléchie (W)',
+                   'Écart-Type Réel (%)', 'Écart-Type Im (%)']
+    for column, header in enumerate(headers):
+        sheet_ranges.cell(row=EXCEL_FIRST_ROW - 1, column=2 + column).value = header
+
+    times = timestamps - timestamps[0]
+    for k in range(len(reel)):
+        row = EXCEL_FIRST_ROW + k
+        sheet_ranges.cell(row=row, column=2).value = float(times[k])
+        sheet_ranges.cell(row=row, column=3).value = float(reel[k])
+        sheet_ranges.cell(row=row, column=4).value = float(im[k])
+        sheet_ranges.cell(row=row, column=5).value = forward[k]
+        sheet_ranges.cell(row=row, column=6).value = reflected[k]
+        sheet_ranges.cell(row=row, column=7).value = float(et_reel[k])
+        sheet_ranges.cell(row=row, column=8).value = float(et_im[k])
+        if permittivity is not None:
+            sheet_ranges.cell(row=row, column=9).value = float(sd_reel[k])
+            sheet_ranges.cell(row=row, column=10).value = float(sd_im[k])
+
+    wb.save(filename=filename)
+    return filename
+
+
+# POST-PROCESSING STEPS BY NAME: function(run_path, directory, output)
+POSTPROCESS = {
+    'averages': s_averages,
+    'excel': excel_export,
+}
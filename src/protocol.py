@@ -0,0 +1,246 @@
+"""
+
+TEST PROTOCOL - DECLARATIVE STEPS COMPILED INTO A TIMELINE
+
+Atlantic Cancer Research Institute - ACRI
+
+A test procedure is described in a JSON (or YAML, with PyYAML installed) file instead of the five
+fixed rows of the five iteration window. Any number of steps:
+
+    {
+      "name": "Liver 3 stages",
+      "defaults": {"on_delay": 5, "off_delay": 1},
+      "steps": [
+        {"power": 30, "duration": 60, "flow": 2},
+        {"power": 60, "duration": 120, "flow": 5, "stop": {"dielectric": 30}},
+        {"power": 60, "duration": 120, "on_delay": 10},
+        {"power": 0, "duration": 30, "flow": 0}
+      ]
+    }
+
+    power       transmitted power (W), below MAX_POWER
+    duration    duration of the step (s), ONdelay of Five_Iteration_Test
+    flow        isocratic pump flow (ml/min), absent = pump left as it is
+    rpower      reflected power limit (W), 0 = 50 % of the power, absent = value of the generator window
+    on_delay    microwave ON delay of each cycle (s), delaimicro
+    off_delay   dielectric measurement delay (s), delaimesure
+    stop        stop conditions: {"dielectric": minimum dielectric value of dielectric_check.py}
+
+compile() checks the whole protocol before anything is switched on, merges consecutive steps with
+the same settings (one step, no register writes or pump command in between), drops pump commands
+that would not change the flow, and gives the start time of every step, the number of traces
+(size of the S11 run store) and the total duration. Five_Iteration_Test then runs the steps one
+after the other without going back to the GUI.
+"""
+
+import os
+import json
+import collections
+
+from dielectric_check import S11_THRESHOLDS
+from isocratic_pump import MAX_FLOW
+
+# SAFETY CLAUSE OF THE GUI: TRANSMITTED POWER MUST STAY BELOW 200 W
+MAX_POWER = 200
+
+STEP_FIELDS = ('power', 'duration', 'flow', 'rpower', 'on_delay', 'off_delay', 'stop')
+STOP_FIELDS = ('dielectric',)
+
+DEFAULTS = {'flow': None, 'rpower': None, 'on_delay': 5.0, 'off_delay': 1.0, 'stop': None}
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class TimelineStep(collections.namedtuple('TimelineStep', 'index start power duration flow rpower on_delay '
+                                                           'off_delay dielectric cycles')):
+    """
+    index: step number (1...) / start: time of the step from the start of the test (s) /
+    flow: None = no pump command / rpower: None = value of the generator window /
+    dielectric: minimum dielectric value, None = no verification / cycles: expected number of ON/OFF cycles
+    """
+    __slots__ = ()
+
+
+class Timeline:
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = list(steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def duration(self):
+        return sum(step.duration for step in self.steps)
+
+    def trace_count(self, min_on=None):
+        """
+        @param min_on: shortest ON delay of a cycle (s) when the ON delays change during the test (trend.py,
+                       interval_scheduler.py), None = ON delay of each step
+        @return: number of traces of the run (one per cycle, one at the end of each step, the first and the last)
+        """
+        if min_on is None:
+            return sum(step.cycles + 1 for step in self.steps) + 2
+        return sum(int(step.duration // (min(min_on, step.on_delay) + step.off_delay)) + 1
+                   for step in self.steps) + 2
+
+    def summary(self):
+        lines = [self.name + ": " + str(len(self.steps)) + " steps, " + "%g" % self.duration() + " s"]
+        for step in self.steps:
+            line = "  %d. t=%gs  %g W for %g s (ON %g s / OFF %g s, %d cycles)" % (
+                step.index, step.start, step.power, step.duration, step.on_delay, step.off_delay, step.cycles)
+            if step.flow is not None:
+                line += ", pump %g ml/min" % step.flow
+            if step.dielectric is not None:
+                line += ", stop at dielectric %g" % step.dielectric
+            lines.append(line)
+        return "\n".join(lines)
+
+
+class Protocol:
+    def __init__(self, steps, name="Protocol", defaults=None):
+        """
+        @param steps: list of dicts (fields of STEP_FIELDS)
+        @param defaults: values used for the fields missing in a step
+        """
+        self.name = name
+        self.defaults = dict(DEFAULTS)
+        self.declared = set(defaults or ())
+        if defaults:
+            self.defaults.update(defaults)
+        self.steps = list(steps)
+
+    def set_default(self, name, value):
+        """
+        Default of a field for the steps without it, unless the protocol declares its own default.
+
+        @return: True when the default was changed
+        """
+        if name in self.declared:
+            return False
+        self.defaults[name] = value
+        return True
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict) or 'steps' not in data:
+            raise ProtocolError("A protocol needs a list of steps")
+        return cls(data['steps'], data.get('name', "Protocol"), data.get('defaults'))
+
+    @classmethod
+    def from_five_steps(cls, powers, durations, flows, delaimicro, delaimesure, dielectric=None):
+        """
+        Protocol of the five rows of the five iteration window (a flow of -1 skips the row).
+        """
+        steps = []
+        for power, duration, flow in zip(powers, durations, flows):
+            if flow == -1:
+                continue
+            steps.append({'power': power, 'duration': duration, 'flow': flow,
+                          'stop': None if dielectric is None else {'dielectric': dielectric}})
+        return cls(steps, "Five iteration test", {'on_delay': delaimicro, 'off_delay': delaimesure})
+
+    """
+    COMPILATION
+    """
+    def _resolve(self, number, step, pump):
+        if not isinstance(step, dict):
+            raise ProtocolError("Step " + str(number) + " is not a set of fields")
+        unknown = set(step) - set(STEP_FIELDS)
+        if unknown:
+            raise ProtocolError("Step " + str(number) + ": unknown field(s) " + ", ".join(sorted(unknown)))
+
+        fields = dict(self.defaults)
+        fields.update(step)
+        for name in ('power', 'duration'):
+            if fields.get(name) is None:
+                raise ProtocolError("Step " + str(number) + ": '" + name + "' is missing")
+
+        try:
+            power = float(fields['power'])
+            duration = float(fields['duration'])
+            rpower = None if fields['rpower'] is None else float(fields['rpower'])
+            on_delay = float(fields['on_delay'])
+            off_delay = float(fields['off_delay'])
+            flow = None if fields['flow'] is None else float(fields['flow'])
+        except (TypeError, ValueError):
+            raise ProtocolError("Step " + str(number) + ": numeric value expected")
+
+        stop = fields['stop'] or {}
+        unknown = set(stop) - set(STOP_FIELDS)
+        if unknown:
+            raise ProtocolError("Step " + str(number) + ": unknown stop condition(s) " + ", ".join(sorted(unknown)))
+        dielectric = stop.get('dielectric')
+
+        if not 0 <= power < MAX_POWER:
+            raise ProtocolError("Step " + str(number) + ": power must be between 0 and " + str(MAX_POWER) + " W")
+        if on_delay <= 0 or off_delay <= 0:
+            raise ProtocolError("Step " + str(number) + ": ON and OFF delays must be positive")
+        if duration < 0:
+            raise ProtocolError("Step " + str(number) + ": duration must not be negative")
+        if rpower is not None and not 0 <= rpower < MAX_POWER:
+            raise ProtocolError("Step " + str(number) + ": reflected power limit must be between 0 and " + str(MAX_POWER) + " W")
+        if flow is not None and not 0 <= flow <= MAX_FLOW:
+            raise ProtocolError("Step " + str(number) + ": flow must be between 0 and %g ml/min" % MAX_FLOW)
+        if flow is not None and pump is not None and not pump.supports(flow):
+            raise ProtocolError("Step " + str(number) + ": the pump backend cannot run at %g ml/min" % flow)
+        if dielectric is not None:
+            dielectric = float(dielectric)
+            if dielectric not in S11_THRESHOLDS:
+                raise ProtocolError("Step " + str(number) + ": no S11 threshold for a dielectric value of %g" % dielectric)
+
+        return [power, duration, flow, rpower, on_delay, off_delay, dielectric]
+
+    def compile(self, pump=None):
+        """
+        @param pump: PumpController (isocratic_pump.py) whose backend must support every flow, None = no check
+        @return: Timeline (ProtocolError on the first invalid step)
+        """
+        if len(self.steps) == 0:
+            raise ProtocolError("The protocol has no step")
+
+        resolved = [self._resolve(number + 1, step, pump) for number, step in enumerate(self.steps)]
+
+        # Consecutive steps with the same settings become one longer step
+        merged = [resolved[0]]
+        for fields in resolved[1:]:
+            last = merged[-1]
+            same_flow = fields[2] is None or fields[2] == last[2]
+            if same_flow and fields[0] == last[0] and fields[3:] == last[3:]:
+                last[1] += fields[1]
+            else:
+                merged.append(fields)
+
+        steps = []
+        start = 0.0
+        flow = None
+        for index, (power, duration, step_flow, rpower, on_delay, off_delay, dielectric) in enumerate(merged):
+            # Pump command only when the flow changes
+            command = step_flow if step_flow is not None and step_flow != flow else None
+            if step_flow is not None:
+                flow = step_flow
+            cycles = int(duration // (on_delay + off_delay))
+            steps.append(TimelineStep(index + 1, start, power, duration, command, rpower, on_delay, off_delay,
+                                      dielectric, cycles))
+            start += duration
+
+        return Timeline(self.name, steps)
+
+
+def load_protocol(path):
+    """
+    @param path: .json, .yaml or .yml file
+    @return: Protocol
+    """
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, "r") as ProtocolFile:
+        if extension in ('.yaml', '.yml'):
+            import yaml
+            data = yaml.safe_load(ProtocolFile)
+        else:
+            data = json.load(ProtocolFile)
+    return Protocol.from_dict(data)
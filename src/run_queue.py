@@ -0,0 +1,340 @@
+"""
+
+RUN QUEUE - UNATTENDED SERIES OF ABLATION RUNS
+
+Atlantic Cancer Research Institute - ACRI
+
+A series of runs is queued in an SQLite file instead of filling the GUI frames between samples.
+Each job holds a protocol file (protocol.py), the name of its run folder, the post-processing
+steps to apply (postprocess.POSTPROCESS) and optionally the station that must run it.
+
+BatchScheduler runs the queued jobs of one station (station.py) back to back. As soon as the
+acquisition of a job is over, its post-processing (average file, Excel export) is handed to a
+background worker (pipeline.MeasurementPipeline) and the next acquisition starts at once.
+
+States of a job:
+
+    queued      waiting for the station
+    acquiring   protocol running on the station
+    acquired    run folder complete, post-processing waiting or running
+    done        post-processing done
+    failed      acquisition failed (error column)
+    postprocess_failed
+                run folder complete, post-processing failed (error column): reprocess() runs the
+                post-processing again on the same run folder, no new acquisition
+
+Every change of state is committed, so the queue survives a restart of the program or of the
+workstation. When the scheduler starts again:
+    - the jobs still 'acquired' (post-processing not finished) are post-processed again from their
+      run folder
+    - recover() marks 'failed' the jobs interrupted during their acquisition: the sample was partly
+      ablated, the run is not started again on its own (retry() queues it again)
+
+Usage:
+    python run_queue.py series.db add liver.json "Sample 1" --post averages,excel
+    python run_queue.py series.db list
+    python run_queue.py series.db run stations.json --station "Bench A"
+    python run_queue.py series.db retry 4
+    python run_queue.py series.db reprocess 5
+"""
+
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+from pipeline import MeasurementPipeline
+from postprocess import POSTPROCESS, OUTPUT
+from protocol import load_protocol
+from station import Station, load_stations, run_protocol
+
+# STATES
+QUEUED = "queued"
+ACQUIRING = "acquiring"
+ACQUIRED = "acquired"
+DONE = "done"
+FAILED = "failed"
+POSTPROCESS_FAILED = "postprocess_failed"
+
+DEFAULT_POSTPROCESS = ('averages', 'excel')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    protocol TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    postprocess TEXT NOT NULL,
+    station TEXT,
+    runner TEXT,
+    state TEXT NOT NULL,
+    run_path TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    acquired REAL,
+    finished REAL
+)
+"""
+
+
+class RunQueue:
+    def __init__(self, path):
+        """
+        @param path: SQLite file of the queue (created if it does not exist)
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _execute(self, sql, args=()):
+        with self.lock:
+            return self.connection.execute(sql, args)
+
+    """
+    JOBS
+    """
+    def add(self, protocol, directory, postprocess=DEFAULT_POSTPROCESS, station=None):
+        """
+        @param protocol: protocol file, checked now (ProtocolError when it is not valid)
+        @param postprocess: names of postprocess.POSTPROCESS, in order
+        @return: job id
+        """
+        load_protocol(protocol).compile()
+        unknown = [name for name in postprocess if name not in POSTPROCESS]
+        if unknown:
+            raise ValueError("Unknown post-processing step(s): " + ", ".join(unknown))
+        cursor = self._execute("INSERT INTO jobs (protocol, directory, postprocess, station, state, created) "
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               (protocol, directory, json.dumps(list(postprocess)), station, QUEUED, time.time()))
+        return cursor.lastrowid
+
+    def job(self, job_id):
+        return self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def jobs(self, state=None):
+        if state is None:
+            return self._execute("SELECT * FROM jobs ORDER BY id").fetchall()
+        return self._execute("SELECT * FROM jobs WHERE state = ? ORDER BY id", (state,)).fetchall()
+
+    def take(self, station=None):
+        """
+        Oldest queued job for a station (jobs without station go to any station), marked 'acquiring'.
+
+        @return: job row, or None when nothing is queued
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute("SELECT * FROM jobs WHERE state = ? AND (station IS NULL OR station = ?) "
+                                              "ORDER BY id LIMIT 1", (QUEUED, station)).fetchone()
+                if row is not None:
+                    self.connection.execute("UPDATE jobs SET state = ?, runner = ?, started = ?, error = NULL "
+                                            "WHERE id = ?", (ACQUIRING, station, time.time(), row['id']))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return None if row is None else self.job(row['id'])
+
+    def acquired(self, job_id, run_path):
+        self._execute("UPDATE jobs SET state = ?, run_path = ?, acquired = ? WHERE id = ?",
+                      (ACQUIRED, run_path, time.time(), job_id))
+
+    def done(self, job_id):
+        self._execute("UPDATE jobs SET state = ?, finished = ? WHERE id = ?", (DONE, time.time(), job_id))
+
+    def failed(self, job_id, error, state=FAILED):
+        self._execute("UPDATE jobs SET state = ?, error = ?, finished = ? WHERE id = ?",
+                      (state, str(error), time.time(), job_id))
+
+    def retry(self, job_id):
+        """
+        Queues a failed acquisition again (new sample: acquisition and post-processing).
+        """
+        self._execute("UPDATE jobs SET state = ?, runner = NULL, run_path = NULL, error = NULL, started = NULL, "
+                      "acquired = NULL, finished = NULL WHERE id = ? AND state = ?", (QUEUED, job_id, FAILED))
+
+    def reprocess(self, job_id):
+        """
+        Sends a job whose post-processing failed back to 'acquired', to run its post-processing again on its
+        run folder (run_postprocess(), or the next start of the scheduler of its station).
+
+        @return: True when the job was waiting for it
+        """
+        cursor = self._execute("UPDATE jobs SET state = ?, error = NULL, finished = NULL WHERE id = ? AND state = ?",
+                               (ACQUIRED, job_id, POSTPROCESS_FAILED))
+        return cursor.rowcount > 0
+
+    def recover(self, station=None):
+        """
+        Marks 'failed' the jobs of a station left in acquisition by a stopped program.
+
+        @return: number of jobs interrupted during their acquisition
+        """
+        cursor = self._execute("UPDATE jobs SET state = ?, error = ?, finished = ? WHERE state = ? AND runner IS ?",
+                               (FAILED, "Acquisition interrupted by a restart", time.time(), ACQUIRING, station))
+        return cursor.rowcount
+
+    def text(self):
+        lines = ["%4s %-18s %-24s %-24s %s" % ('id', 'state', 'directory', 'protocol', 'error')]
+        for row in self.jobs():
+            lines.append("%4d %-18s %-24s %-24s %s" % (row['id'], row['state'], row['directory'], row['protocol'],
+                                                      row['error'] or ''))
+        return "\n".join(lines)
+
+
+def run_postprocess(run_queue, job_id, output=OUTPUT):
+    """
+    Post-processing steps of an acquired job. Every error is kept in the queue (state 'postprocess_failed'),
+    not raised.
+
+    @return: True when every step was done
+    """
+    job = run_queue.job(job_id)
+    try:
+        for name in json.loads(job['postprocess']):
+            POSTPROCESS[name](job['run_path'], job['directory'], output)
+    except Exception as error:
+        run_queue.failed(job_id, "Post-processing: " + str(error), POSTPROCESS_FAILED)
+        print("Job " + str(job_id) + ": post-processing failed (" + str(error) + ")")
+        return False
+    run_queue.done(job_id)
+    print("Job " + str(job_id) + ": post-processing done")
+    return True
+
+
+class BatchScheduler:
+    def __init__(self, run_queue, station, output=OUTPUT):
+        """
+        @param run_queue: RunQueue
+        @param station: opened station.Station
+        @param output: folder of the average and Excel files
+        """
+        self.queue = run_queue
+        self.station = station
+        self.output = output
+        self.pipeline = MeasurementPipeline(maxsize=4, name="PostProcessing")
+
+    def postprocess(self, job_id):
+        # Runs on the post-processing worker
+        run_postprocess(self.queue, job_id, self.output)
+
+    def run(self, wait=False, poll=5.0):
+        """
+        Runs the queued jobs of the station one after the other.
+
+        @param wait: keep waiting for new jobs when the queue is empty (False = return)
+        @param poll: time between two looks at an empty queue (s)
+        """
+        name = self.station.name
+        interrupted = self.queue.recover(name)
+        if interrupted:
+            print(str(interrupted) + " job(s) interrupted during their acquisition, see the list (retry to run them again)")
+
+        # Post-processing left over by the last session
+        for job in self.queue.jobs(ACQUIRED):
+            if job['runner'] == name:
+                self.pipeline.submit(self.postprocess, job['id'])
+
+        try:
+            while True:
+                job = self.queue.take(name)
+                if job is None:
+                    if not wait:
+                        break
+                    time.sleep(poll)
+                    continue
+
+                print("Job " + str(job['id']) + ": " + job['protocol'] + " -> " + job['directory'])
+                try:
+                    timeline = load_protocol(job['protocol']).compile(self.station.pump)
+                    result = run_protocol(self.station, timeline, job['directory'])
+                except Exception as error:
+                    self.queue.failed(job['id'], error)
+                    print("Job " + str(job['id']) + ": failed (" + str(error) + ")")
+                    continue
+
+                if result['trip'] is not None:
+                    # Safety stop: no next sample until an operator has looked at the bench
+                    self.queue.failed(job['id'], "Safety interlock: " + result['trip'])
+                    print("Job " + str(job['id']) + ": safety interlock, the series is stopped (" + result['trip'] + ")")
+                    break
+
+                # Post-processing of this run while the next one is measured
+                self.queue.acquired(job['id'], result['path'])
+                self.pipeline.submit(self.postprocess, job['id'])
+        finally:
+            self.pipeline.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Queue of unattended ablation runs")
+    parser.add_argument('database', help="SQLite file of the queue")
+    commands = parser.add_subparsers(dest='command')
+
+    add = commands.add_parser('add', help="queue a run")
+    add.add_argument('protocol')
+    add.add_argument('directory')
+    add.add_argument('--post', default=",".join(DEFAULT_POSTPROCESS),
+                     help="post-processing steps (" + ", ".join(POSTPROCESS) + "), empty = none")
+    add.add_argument('--station', help="station that must run it (any station if absent)")
+
+    commands.add_parser('list', help="show the queue")
+
+    retry = commands.add_parser('retry', help="queue a failed acquisition again (new sample)")
+    retry.add_argument('id', type=int)
+
+    reprocess = commands.add_parser('reprocess', help="post-process a job again on its run folder")
+    reprocess.add_argument('id', type=int)
+    reprocess.add_argument('--output', default=OUTPUT, help="folder of the average and Excel files")
+
+    run = commands.add_parser('run', help="run the queued jobs on a station")
+    run.add_argument('stations', help="JSON station file (station.py)")
+    run.add_argument('--station', help="station name (first station of the file if absent)")
+    run.add_argument('--wait', action='store_true', help="keep waiting for new jobs")
+    run.add_argument('--output', default=OUTPUT, help="folder of the average and Excel files")
+
+    args = parser.parse_args(argv)
+    run_queue = RunQueue(args.database)
+    try:
+        if args.command == 'add':
+            steps = [name for name in args.post.split(",") if name]
+            print("Job " + str(run_queue.add(args.protocol, args.directory, steps, args.station)) + " queued")
+        elif args.command == 'retry':
+            run_queue.retry(args.id)
+            print(run_queue.text())
+        elif args.command == 'reprocess':
+            if not run_queue.reprocess(args.id):
+                raise SystemExit("Job " + str(args.id) + " is not waiting for its post-processing")
+            run_postprocess(run_queue, args.id, args.output)
+            print(run_queue.text())
+        elif args.command == 'run':
+            configs = load_stations(args.stations)
+            if args.station is not None:
+                configs = [config for config in configs if config.name == args.station]
+                if not configs:
+                    raise SystemExit("No station " + args.station + " in " + args.stations)
+            station = Station(configs[0]).open()
+            try:
+                BatchScheduler(run_queue, station, args.output).run(args.wait)
+            finally:
+                station.close()
+            print(run_queue.text())
+        else:
+            print(run_queue.text())
+    finally:
+        run_queue.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+"""
+
+S11 RUN STORE
+
+Atlantic Cancer Research Institute - ACRI
+
+Every S11 trace of a run is appended to a single memory mapped complex64 array of shape
+(iterations, datapoints). The frequency axis and the timestamp of each trace are kept beside it
+in the same run folder. Any slice of the run (one frequency through time, one iteration across
+frequency) is therefore a view of the file on disk: no .s1p re-parsing and no copy.
+
+append() may run on another thread than the readers (pipelined measurement, live plot): one lock
+covers the append, the growth of the files and the slicing of the reads.
+
+Run folder content:
+    run.json          -> datapoints and allocated capacity
+    traces.c64        -> raw complex64 traces, row major (iteration, datapoint)
+    timestamps.f64    -> acquisition time of each trace (seconds since epoch, NaN = empty row)
+    frequencies.npy   -> frequency axis (Hz)
+"""
+
+import os
+import json
+import time
+import threading
+import numpy as np
+
+# FILE NAMES INSIDE A RUN FOLDER
+META_FILE = "run.json"
+TRACES_FILE = "traces.c64"
+TIMES_FILE = "timestamps.f64"
+FREQS_FILE = "frequencies.npy"
+
+
+class S11Store:
+    def __init__(self, path, datapoints=None, capacity=256, mode='r+'):
+        """
+        Opens the run folder at path. The folder is created when datapoints is given and no run
+        exists yet.
+
+        @param path: run folder
+        @param datapoints: number of points per trace (only needed to create a new run)
+        @param capacity: number of traces allocated up front. The files double when it is reached
+        @param mode: 'r+' to append, 'r' for read-only analysis
+        """
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        meta_path = os.path.join(path, META_FILE)
+
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as MetaFile:
+                meta = json.load(MetaFile)
+            self.datapoints = int(meta["datapoints"])
+            self.capacity = int(meta["capacity"])
+
+        else:
+            if datapoints is None or mode == 'r':
+                raise IOError("No S11 run found in " + str(path))
+            os.makedirs(path, exist_ok=True)
+            self.datapoints = int(datapoints)
+            self.capacity = max(int(capacity), 1)
+            self._allocate(0, self.capacity)
+            self._write_meta()
+
+        self._map()
+
+        # Number of traces already written = leading timestamps that are not NaN
+        empty = np.flatnonzero(np.isnan(self._times))
+        self.count = int(empty[0]) if len(empty) else self.capacity
+
+        self._frequencies = None
+        freqs_path = os.path.join(path, FREQS_FILE)
+        if os.path.exists(freqs_path):
+            self._frequencies = np.load(freqs_path, mmap_mode='r')
+
+    """
+    FILE MANAGEMENT
+    """
+    def _write_meta(self):
+        with open(os.path.join(self.path, META_FILE), "w") as MetaFile:
+            json.dump({"datapoints": self.datapoints, "capacity": self.capacity, "dtype": "complex64"}, MetaFile)
+
+    def _allocate(self, old_capacity, new_capacity):
+        # Grow (or create) both files. New timestamp rows are filled with NaN to mark them as empty.
+        with open(os.path.join(self.path, TRACES_FILE), "ab") as TraceFile:
+            TraceFile.truncate(new_capacity * self.datapoints * np.dtype(np.complex64).itemsize)
+
+        with open(os.path.join(self.path, TIMES_FILE), "ab") as TimeFile:
+            TimeFile.write(np.full(new_capacity - old_capacity, np.nan, dtype=np.float64).tobytes())
+
+    def _map(self):
+        self._traces = np.memmap(os.path.join(self.path, TRACES_FILE), dtype=np.complex64, mode=self.mode,
+                                 shape=(self.capacity, self.datapoints))
+        self._times = np.memmap(os.path.join(self.path, TIMES_FILE), dtype=np.float64, mode=self.mode,
+                                shape=(self.capacity,))
+
+    def _grow(self):
+        # Lock held by append(). The new mapping replaces the old one, views handed out before this call keep
+        # pointing at the old mapping
+        self.flush()
+        old_capacity = self.capacity
+        self._allocate(old_capacity, 2 * old_capacity)
+        self.capacity = 2 * old_capacity
+        self._write_meta()
+        self._map()
+
+    def flush(self):
+        if self.mode != 'r':
+            self._traces.flush()
+            self._times.flush()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            del self._traces
+            del self._times
+
+    """
+    WRITE
+    """
+    def set_frequencies(self, frequencies):
+        """
+        Saves the frequency axis (Hz) of the run.
+
+        @param frequencies: array of datapoints values
+        """
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        if frequencies.shape != (self.datapoints,):
+            raise ValueError("Frequency axis has " + str(frequencies.size) + " points, run has " + str(self.datapoints))
+        np.save(os.path.join(self.path, FREQS_FILE), frequencies)
+        self._frequencies = np.load(os.path.join(self.path, FREQS_FILE), mmap_mode='r')
+
+    def append(self, trace, timestamp=None):
+        """
+        Appends one trace to the run.
+
+        @param trace: complex S11 values (datapoints values)
+        @param timestamp: acquisition time in seconds since epoch (now if None)
+        @return: index of the trace in the run
+        """
+        with self.lock:
+            if self.count == self.capacity:
+                self._grow()
+
+            index = self.count
+            self._traces[index] = trace
+            # The timestamp is written last: a trace only counts once its timestamp exists
+            self._times[index] = time.time() if timestamp is None else timestamp
+            self.count += 1
+        return index
+
+    """
+    READ (all slices are views of the memory map, no copy)
+    """
+    def __len__(self):
+        return self.count
+
+    @property
+    def traces(self):
+        with self.lock:
+            return self._traces[:self.count]
+
+    @property
+    def timestamps(self):
+        with self.lock:
+            return self._times[:self.count]
+
+    @property
+    def frequencies(self):
+        return self._frequencies
+
+    def iteration(self, index):
+        """
+        @return: trace of one iteration across frequency
+        """
+        with self.lock:
+            return self._traces[:self.count][index]
+
+    def frequency_slice(self, column):
+        """
+        @return: S11 of one frequency point through time (strided view)
+        """
+        with self.lock:
+            return self._traces[:self.count, column]
+
+    def frequency_index(self, freq):
+        """
+        @return: column of the frequency point closest to freq (Hz)
+        """
+        if self._frequencies is None:
+            raise ValueError("The frequency axis of this run was never saved")
+        return int(np.argmin(np.abs(self._frequencies - freq)))
+
+
+"""
+ANALYZER TRANSFERS
+"""
+def fetch_trace(analyzer, channel=1, measurement=1):
+    """
+    Reads the corrected S11 data of a measurement in one binary block (REAL,32).
+
+    @param analyzer: pyvisa resource of the ENA
+    @return: complex64 array
+    """
+    analyzer.write("FORM:DATA REAL,32")
+    analyzer.write("FORM:BORD SWAP")
+    values = analyzer.query_binary_values("CALC" + str(channel) + ":MEAS" + str(measurement) + ":DATA:SDATA?",
+                                          datatype='f', is_big_endian=False, container=np.array)
+    return np.ascontiguousarray(values, dtype=np.float32).view(np.complex64)
+
+
+def fetch_frequencies(analyzer, channel=1):
+    """
+    Reads the stimulus values of a channel (Hz) in one binary block (REAL,64).
+
+    @param analyzer: pyvisa resource of the ENA
+    @return: float64 array
+    """
+    analyzer.write("FORM:DATA REAL,64")
+    analyzer.write("FORM:BORD SWAP")
+    values = analyzer.query_binary_values("SENS" + str(channel) + ":X?", datatype='d', is_big_endian=False,
+                                          container=np.array)
+    return np.asarray(values, dtype=np.float64)
+
+
+"""
+S1P FILES
+"""
+def read_s1p(filename):
+    """
+    Reads a .s1p file saved in RI format.
+
+    @return: (frequencies, complex S11) arrays
+    """
+    data = np.loadtxt(filename, comments=('!', '#'), ndmin=2)
+    return data[:, 0], (data[:, 1] + 1j * data[:, 2]).astype(np.complex64)
+
+
+def write_s1p(filename, frequencies, trace, port=1):
+    """
+    Writes a trace in the same layout as CALC:MEAS:DATA:SNP:PORTs:Save in RI format: 5 header lines
+    followed by "frequency real imaginary" rows, so S_Averages reads it like an analyzer file.
+
+    @param filename: .s1p file to create
+    @param frequencies: frequency axis (Hz)
+    @param trace: complex S values
+    @param port: port number written in the header
+    """
+    trace = np.asarray(trace)
+    with open(filename, "w") as S1PFile:
+        S1PFile.write("!Keysight E5080A trace transferred to host\n")
+        S1PFile.write("!Date: " + time.ctime() + "\n")
+        S1PFile.write("!S1P File: Measurement: S" + str(port) + str(port) + "\n")
+        S1PFile.write("!Freq ReS" + str(port) + str(port) + " ImS" + str(port) + str(port) + "\n")
+        S1PFile.write("# Hz S RI R 50\n")
+        np.savetxt(S1PFile, np.column_stack((frequencies, trace.real, trace.imag)), fmt=("%d", "%.9e", "%.9e"),
+                   delimiter=' ')
+
+
+def import_s1p_folder(folder, path, count):
+    """
+    Builds a run store from the Iteration_1.s1p ... Iteration_<count>.s1p files of an older test.
+
+    @param folder: folder holding the .s1p files
+    @param path: run folder to create
+    @return: S11Store
+    """
+    freqs, trace = read_s1p(os.path.join(folder, "Iteration_1.s1p"))
+    store = S11Store(path, datapoints=len(freqs), capacity=count)
+    store.set_frequencies(freqs)
+
+    for j in range(count):
+        filename = os.path.join(folder, "Iteration_" + str(j + 1) + ".s1p")
+        if j != 0:
+            freqs, trace = read_s1p(filename)
+        store.append(trace, os.path.getmtime(filename))
+
+    store.flush()
+    return store
@@ -0,0 +1,164 @@
+"""
+
+KMS200 AUTOMATIC SCAN MONITOR
+
+Atlantic Cancer Research Institute - ACRI
+
+Follows an automatic frequency scan of the generator (reg 17 scan mode, then microwaves ON) until
+its result is ready, instead of reading reg 105 every 2 s and reg 109 every 5 s.
+
+Polling adapts to the scan: while the scan is expected to run (number of points x POINT_TIME), the
+monitor waits half of the remaining time between reads (never more than slow). Past the expected
+end, it reads every fast seconds and backs off (x backoff) up to slow. Each read is one block read
+of regs 102-112, so it also records the scanned profile (frequency, reflected and transmitted
+power) while the scan runs. The status word is decoded into named flags (kms200.decode_status).
+
+Once the scan complete bit is set, scan data mode is asked (reg 17 = SCAN_DATA) and regs 109-115
+are read with the same backoff until reg 109 is 0. The outcome is given by a Future (result() /
+add_done_callback()), or by a callback.
+"""
+
+import time
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+
+from kms200 import *
+
+# ESTIMATED TIME PER SCAN FREQUENCY (s)
+POINT_TIME = 0.05
+
+# FIRST REGISTER AND SIZE OF THE TELEMETRY BLOCK (102 TRANSMITTED ... 112 FREQUENCY READBACK)
+TELEMETRY_START = REG_FORWARD
+TELEMETRY_COUNT = REG_FREQUENCY_READ - REG_FORWARD + 1
+
+# SCAN DATA BLOCK (109 PENDING ... 115 TRANSMITTED POWER AT THE MINIMUM)
+SCAN_DATA_START = REG_SCAN_PENDING
+SCAN_DATA_COUNT = REG_SCAN_MIN_FORWARD - REG_SCAN_PENDING + 1
+
+
+class ScanError(IOError):
+    pass
+
+
+class ScanOutcome(collections.namedtuple('ScanOutcome', 'min_frequency min_reflected min_forward profile duration '
+                                                       'polls flags')):
+    """
+    min_frequency: MHz / min_reflected, min_forward: W (regs 113-115) /
+    profile: (samples, 3) array of [frequency (MHz), reflected (W), transmitted (W)] read during the scan /
+    duration: s from the start of the monitoring to the scan data / polls: number of reads / flags: last status flags
+    """
+    __slots__ = ()
+
+
+def _registers(response):
+    if response is None or (hasattr(response, 'isError') and response.isError()):
+        raise ScanError("Modbus read failed: " + str(response))
+    return response.registers
+
+
+class ScanMonitor:
+    def __init__(self, client, unit=UNIT, point_time=POINT_TIME, fast=0.02, slow=1.0, backoff=1.5, timeout=600.0):
+        """
+        @param client: Modbus client of the generator (pymodbus or sim_kms200.SimulatedModbusClient)
+        @param point_time: estimated time per scan frequency (s)
+        @param fast, slow: shortest and longest time between two reads (s)
+        @param backoff: growth of the time between reads past the expected end
+        @param timeout: longest time to wait for the scan and its data (s)
+        """
+        self.client = client
+        self.unit = unit
+        self.point_time = point_time
+        self.fast = fast
+        self.slow = slow
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def expected_duration(self, start, stop, step):
+        """
+        @param start, stop, step: scan registers 11, 12, 16 (100 kHz)
+        @return: estimated duration of the scan (s)
+        """
+        points = int((stop - start) // max(step, 1)) + 1
+        return min(points, SCAN_RECORD_MAX) * self.point_time
+
+    def _delay(self, remaining, delay):
+        # Before the expected end: half of the remaining time. After: backoff from fast.
+        if remaining > 0:
+            return min(self.slow, max(self.fast, remaining / 2.0)), self.fast
+        return delay, min(delay * self.backoff, self.slow)
+
+    def wait(self, expected=0.0):
+        """
+        Blocks until the scan data is ready.
+
+        @param expected: estimated duration of the scan (s), see expected_duration()
+        @return: ScanOutcome (ScanError on a fault, a watchdog trip or a timeout)
+        """
+        t0 = time.monotonic()
+        deadline = t0 + self.timeout
+        profile = []
+        polls = 0
+        delay = self.fast
+
+        # 1. SCAN: TELEMETRY BLOCK UNTIL THE SCAN COMPLETE BIT
+        while True:
+            block = _registers(self.client.read_holding_registers(TELEMETRY_START, TELEMETRY_COUNT, unit=self.unit))
+            polls += 1
+            status = block[REG_STATUS - TELEMETRY_START]
+            flags = decode_status(status)
+            profile.append((block[REG_FREQUENCY_READ - TELEMETRY_START] / 10.0,
+                            block[REG_REFLECTED - TELEMETRY_START], block[REG_FORWARD - TELEMETRY_START]))
+
+            if 'fault' in flags or 'watchdog' in flags:
+                raise ScanError("Generator stopped during the scan (status " + str(status) + ": " +
+                                ", ".join(sorted(flags)) + ")")
+            if 'scan_complete' in flags:
+                break
+
+            now = time.monotonic()
+            if now > deadline:
+                raise ScanError("No end of scan after " + str(self.timeout) + " s")
+            sleep, delay = self._delay(expected - (now - t0), delay)
+            time.sleep(sleep)
+
+        # 2. SCAN DATA MODE: REGS 109-115 UNTIL REG 109 IS 0
+        self.client.write_register(REG_SCAN_CONTROL, SCAN_DATA, unit=self.unit)
+        delay = self.fast
+        while True:
+            data = _registers(self.client.read_holding_registers(SCAN_DATA_START, SCAN_DATA_COUNT, unit=self.unit))
+            polls += 1
+            if data[0] == 0:
+                break
+            if time.monotonic() > deadline:
+                raise ScanError("Scan data still pending after " + str(self.timeout) + " s")
+            time.sleep(delay)
+            delay = min(delay * self.backoff, self.slow)
+
+        return ScanOutcome(data[REG_SCAN_MIN_FREQ - SCAN_DATA_START] / 10.0,
+                           data[REG_SCAN_MIN_REFLECTED - SCAN_DATA_START],
+                           data[REG_SCAN_MIN_FORWARD - SCAN_DATA_START],
+                           np.array(profile, dtype=np.float64).reshape(-1, 3),
+                           time.monotonic() - t0, polls, flags)
+
+    def watch(self, expected=0.0, callback=None):
+        """
+        Same as wait() on a background thread.
+
+        @param callback: called with the Future once the scan is over
+        @return: concurrent.futures.Future of the ScanOutcome
+        """
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        def run():
+            try:
+                future.set_result(self.wait(expected))
+            except Exception as error:
+                future.set_exception(error)
+
+        threading.Thread(target=run, name="ScanMonitor", daemon=True).start()
+        return future
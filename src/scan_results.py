@@ -0,0 +1,165 @@
+"""
+
+KMS200 SCAN RESULTS - SCAN RECORD AND RESONANCE ANALYSIS
+
+Atlantic Cancer Research Institute - ACRI
+
+After an automatic frequency scan in scan data mode (see scan_monitor.py), the generator holds
+more than the minimum of regs 113-115: reg 110 gives the number of scanned points and the record
+from reg 200 holds one (frequency, reflected power) pair per point. The record is read with block
+reads of at most MAX_READ registers (one Modbus request per block instead of one per register).
+
+Resonance search, on the whole record at once (NumPy):
+
+    ratio = reflected / transmitted power (|reflection coefficient|^2)
+    minima: points lower than the previous point and not higher than the next one, refined with a
+            parabola through the 3 points around each minimum
+    bandwidth: width of the dip at half of its depth (between the minimum and the highest ratio of
+            the record), edges linearly interpolated
+    Q = resonance frequency / bandwidth (nan when the dip is not complete inside the record)
+
+The deepest resonance can then be written to reg 9 as the working frequency of the next ablation.
+"""
+
+import collections
+import numpy as np
+
+from kms200 import *
+
+# LARGEST BLOCK READ (MODBUS LIMIT: 125 REGISTERS, EVEN TO KEEP THE PAIRS TOGETHER)
+MAX_READ = 124
+
+
+class Resonance(collections.namedtuple('Resonance', 'frequency reflected ratio bandwidth q index')):
+    """
+    frequency, bandwidth: MHz / reflected: W / ratio: reflected / transmitted power / index: point of the record
+    """
+    __slots__ = ()
+
+
+def _registers(client, address, count, unit):
+    response = client.read_holding_registers(address, count, unit=unit)
+    if response is None or (hasattr(response, 'isError') and response.isError()):
+        raise IOError("Modbus read of " + str(count) + " registers at " + str(address) + " failed: " + str(response))
+    return response.registers
+
+
+class ScanRecord:
+    def __init__(self, frequency, reflected, forward):
+        """
+        @param frequency: MHz (array)
+        @param reflected: W (array)
+        @param forward: transmitted power of the scan (W, scalar or array)
+        """
+        self.frequency = np.asarray(frequency, dtype=np.float64)
+        self.reflected = np.asarray(reflected, dtype=np.float64)
+        self.forward = np.broadcast_to(np.asarray(forward, dtype=np.float64), self.frequency.shape)
+
+    def __len__(self):
+        return len(self.frequency)
+
+    def ratio(self):
+        return np.where(self.forward > 0, self.reflected / np.maximum(self.forward, 1e-12), np.nan)
+
+    def resonances(self, min_depth=0.0):
+        """
+        @param min_depth: smallest dip (highest ratio of the record - ratio at the minimum) kept
+        @return: list of Resonance, deepest first
+        """
+        return find_resonances(self.frequency, self.ratio(), self.reflected, min_depth)
+
+    def save(self, path):
+        """
+        CSV file: frequency (MHz), reflected power (W), transmitted power (W), ratio
+        """
+        np.savetxt(path, np.column_stack((self.frequency, self.reflected, self.forward, self.ratio())), delimiter=",",
+                   header="Frequency (MHz),Reflected power (W),Transmitted power (W),Reflected/transmitted",
+                   comments="")
+
+
+def read_scan_record(client, forward, unit=UNIT):
+    """
+    Reads the scan record (scan data must be ready: reg 109 = 0).
+
+    @param forward: transmitted power setpoint of the scan (W)
+    @return: ScanRecord
+    """
+    count = min(_registers(client, REG_SCAN_COUNT, 1, unit)[0], SCAN_RECORD_MAX)
+    values = []
+    for offset in range(0, 2 * count, MAX_READ):
+        values.extend(_registers(client, REG_SCAN_RECORD + offset, min(MAX_READ, 2 * count - offset), unit))
+    pairs = np.asarray(values, dtype=np.float64).reshape(-1, 2)
+    return ScanRecord(pairs[:, 0] / 10.0, pairs[:, 1], forward)
+
+
+def find_resonances(frequency, ratio, reflected=None, min_depth=0.0):
+    """
+    @param frequency: MHz (increasing)
+    @param ratio: reflected / transmitted power of each point
+    @param reflected: reflected power of each point (W), ratio if None
+    @return: list of Resonance, deepest first
+    """
+    frequency = np.asarray(frequency, dtype=np.float64)
+    ratio = np.asarray(ratio, dtype=np.float64)
+    if reflected is None:
+        reflected = ratio
+    reflected = np.asarray(reflected, dtype=np.float64)
+    n = len(ratio)
+    if n < 3:
+        return []
+
+    # LOCAL MINIMA (INTERIOR POINTS)
+    inner = np.arange(1, n - 1)
+    minima = inner[(ratio[1:-1] < ratio[:-2]) & (ratio[1:-1] <= ratio[2:])]
+    baseline = np.nanmax(ratio)
+    minima = minima[baseline - ratio[minima] > min_depth]
+    if len(minima) == 0:
+        return []
+
+    # PARABOLIC REFINEMENT OF THE FREQUENCY (EVEN STEP AROUND EACH MINIMUM)
+    left, centre, right = ratio[minima - 1], ratio[minima], ratio[minima + 1]
+    curvature = left - 2 * centre + right
+    shift = np.where(curvature > 0, 0.5 * (left - right) / np.where(curvature > 0, curvature, 1.0), 0.0)
+    step = 0.5 * (frequency[minima + 1] - frequency[minima - 1])
+    f0 = frequency[minima] + np.clip(shift, -0.5, 0.5) * step
+
+    # HALF DEPTH BANDWIDTH: NEAREST POINTS ABOVE THE LEVEL ON EACH SIDE, (minima, points) AT ONCE
+    level = 0.5 * (ratio[minima] + baseline)
+    index = np.arange(n)
+    above = ratio[np.newaxis, :] >= level[:, np.newaxis]
+    lower = np.max(np.where(above & (index < minima[:, np.newaxis]), index, -1), axis=1)
+    upper = np.min(np.where(above & (index > minima[:, np.newaxis]), index, n), axis=1)
+    complete = (lower >= 0) & (upper < n)
+
+    lo = np.clip(lower, 0, n - 2)
+    hi = np.clip(upper, 1, n - 1)
+    # Crossing between lower and lower + 1, and between upper - 1 and upper
+    f_low = _crossing(frequency[lo], ratio[lo], frequency[lo + 1], ratio[lo + 1], level)
+    f_high = _crossing(frequency[hi - 1], ratio[hi - 1], frequency[hi], ratio[hi], level)
+    bandwidth = np.where(complete, f_high - f_low, np.nan)
+    q = np.where(complete & (bandwidth > 0), f0 / np.where(bandwidth > 0, bandwidth, 1.0), np.nan)
+
+    order = np.argsort(ratio[minima], kind='stable')
+    return [Resonance(float(f0[k]), float(reflected[minima[k]]), float(ratio[minima[k]]), float(bandwidth[k]),
+                      float(q[k]), int(minima[k])) for k in order]
+
+
+def _crossing(f1, r1, f2, r2, level):
+    dr = r2 - r1
+    t = np.where(dr != 0, (level - r1) / np.where(dr != 0, dr, 1.0), 0.0)
+    return f1 + np.clip(t, 0.0, 1.0) * (f2 - f1)
+
+
+def apply_frequency(client, frequency, unit=UNIT):
+    """
+    Writes a working frequency to reg 9 and checks it.
+
+    @param frequency: MHz
+    @return: frequency written (MHz, 100 kHz resolution)
+    """
+    value = int(round(frequency * 10))
+    client.write_register(REG_FREQUENCY, value, unit=unit)
+    readback = _registers(client, REG_FREQUENCY, 1, unit)[0]
+    if readback != value:
+        raise IOError("Generator frequency is " + str(readback) + " instead of " + str(value) + " (100 kHz)")
+    return value / 10.0
@@ -0,0 +1,500 @@
+"""
+
+SIMULATED NETWORK ANALYZER E5080A
+
+Atlantic Cancer Research Institute - ACRI
+
+In-process stand-in for the pyvisa resource of the ENA, so the procedures can run (and be timed)
+on a laptop without the analyzer at USB0::0x2A8D::0x0001::MY55201231::0::INSTR.
+
+It understands the SCPI subset used by this software:
+    *IDN? *OPC? *RST *CLS
+    SENS<ch>:FREQ:STAR/STOP, SWE:POIN, SWE:TIME(:AUTO), SWE:MODE, SWE:TYPE, BAND, SEGM..., X?
+    CALC<ch>:PAR:COUN, CALC<ch>:MEAS<m>:PAR/FORM, CALC<ch>:MEAS<m>:DATA:SDATA?/FDATA?, CALC:DATA:MSD?
+    CALC:MEAS:DATA:SNP:PORTs:Save, MMEM:MDIR, MMEM:STOR:TRAC:FORM:SNP
+    TRIG:SCOP, INIT<ch>:IMM, FORM:DATA, FORM:BORD, DISP:SPL
+Long and short SCPI forms are both accepted. Commands outside this subset are logged in
+unknown_commands and otherwise ignored.
+
+Synthetic S11: the probe is a resonant load whose resonance drifts upward in frequency and
+gets shallower while "tissue" is ablated (i.e. with time since the simulator was opened). Complex
+gaussian noise is added with an rms value that scales with sqrt(IFBW). SDATA? returns the complex
+data; FDATA? and MSD? return the data in the format of the measurement (MLOG by default, as on the
+instrument: (dB, 0) pairs), POL and SMIT give real/imaginary pairs.
+
+Sweep time follows SENS:SWE:TIME, or 1/IFBW per point when the time is AUTO. time_scale
+stretches every delay: 1.0 = real time, 0.0 = instantaneous (regression tests).
+
+Usage (see CircuitAutomatisation_V5_2021.py, ABLATION_ANALYZER=SIM):
+    rm = SimulatedResourceManager(disk_root="ENA_Disk")
+    analyzer = rm.open_resource('USB0::0x2A8D::0x0001::MY55201231::0::INSTR')
+"""
+
+import os
+import re
+import time
+import struct
+import numpy as np
+
+from s11_store import write_s1p
+
+RESOURCE_NAME = 'USB0::0x2A8D::0x0001::MY55201231::0::INSTR'
+IDN = "Keysight Technologies,E5080A,MY55201231,A.13.95.06 (simulated)"
+
+VOWELS = "AEIOU"
+
+
+class SimulatedTimeout(IOError):
+    """
+    Raised by read() when no response is waiting (same situation as VI_ERROR_TMO).
+    """
+    pass
+
+
+def short_form(node):
+    """
+    SCPI short form of a header node: first 4 letters, or 3 if the 4th is a vowel.
+    """
+    node = node.upper()
+    if len(node) > 4:
+        return node[:3] if node[3] in VOWELS else node[:4]
+    return node
+
+
+class _Channel:
+    def __init__(self):
+        self.points = 201
+        self.start = 10e6
+        self.stop = 9e9
+        self.ifbw = 100e3
+        self.sweep_time = 0.0
+        self.sweep_time_auto = True
+        self.mode = 'CONT'
+        self.sweep_type = 'LIN'
+        self.segments = {}
+        self.segment_ifbw = False
+        self.sweep_end = 0.0
+
+    def frequencies(self):
+        if self.sweep_type == 'SEGM' and self.segments:
+            freqs = []
+            for n in sorted(self.segments):
+                seg = self.segments[n]
+                if seg['state']:
+                    freqs.append(np.linspace(seg['start'], seg['stop'], seg['points']))
+            return np.concatenate(freqs)
+
+        if self.sweep_type == 'LOG':
+            return np.logspace(np.log10(self.start), np.log10(self.stop), self.points)
+        return np.linspace(self.start, self.stop, self.points)
+
+    def ifbw_per_point(self):
+        if self.sweep_type == 'SEGM' and self.segments and self.segment_ifbw:
+            ifbw = []
+            for n in sorted(self.segments):
+                seg = self.segments[n]
+                if seg['state']:
+                    ifbw.append(np.full(seg['points'], seg['ifbw']))
+            return np.concatenate(ifbw)
+        return np.full(len(self.frequencies()), self.ifbw)
+
+    def duration(self):
+        if self.sweep_time_auto or self.sweep_time <= 0:
+            return float(np.sum(1.0 / self.ifbw_per_point())) + 5e-3
+        return self.sweep_time
+
+
+class SimulatedE5080A:
+    def __init__(self, resource_name=RESOURCE_NAME, disk_root="ENA_Disk", time_scale=1.0, noise=2e-3,
+                 drift_time=600.0, seed=None):
+        """
+        @param disk_root: local folder standing for the D: drive of the ENA
+        @param time_scale: 1.0 = sweeps take their real time, 0.0 = instantaneous
+        @param noise: rms noise of S11 at 1 kHz IFBW
+        @param drift_time: seconds for the simulated tissue to go from fresh to fully ablated
+        @param seed: random seed of the noise
+        """
+        self.resource_name = resource_name
+        self.disk_root = disk_root
+        self.time_scale = time_scale
+        self.noise = noise
+        self.drift_time = drift_time
+        self.rng = np.random.default_rng(seed)
+        self.timeout = 2000
+
+        self.t_open = time.monotonic()
+        self.virtual = 0.0
+
+        self.channels = {1: _Channel(), 2: _Channel()}
+        self.measurements = {1: (1, 'S11')}
+        self.formats = {}
+        self.data = {}
+        self.trigger_scope = 'ALL'
+        self.data_format = 'ASC'
+        self.byte_order = 'NORM'
+        self.snp_format = 'RI'
+        self.output = []
+
+        self.command_log = []
+        self.unknown_commands = []
+
+    """
+    CLOCK (scaled or virtual)
+    """
+    def now(self):
+        return (time.monotonic() - self.t_open) * (1.0 if self.time_scale > 0 else 0.0) + self.virtual
+
+    def _wait_until(self, t_end):
+        remaining = t_end - self.now()
+        if remaining <= 0:
+            return
+        if self.time_scale > 0:
+            time.sleep(remaining * self.time_scale)
+            # Sweeps last remaining * time_scale of wall clock but remaining of simulated time
+            self.virtual += remaining * (1.0 - self.time_scale)
+        else:
+            self.virtual += remaining
+
+    def _wait_all(self):
+        self._wait_until(max(ch.sweep_end for ch in self.channels.values()))
+
+    """
+    SYNTHETIC S11
+    """
+    def _s11(self, channel, ablation):
+        freqs = channel.frequencies()
+
+        # Resonant probe: the resonance moves up and gets shallower as the tissue dries out
+        f_res = 2.40e9 + 0.12e9 * ablation
+        q = 12.0 - 4.0 * ablation
+        depth = 0.85 - 0.35 * ablation
+        detune = q * (freqs / f_res - f_res / freqs)
+        gamma = 1.0 - depth / (1.0 + 1j * detune)
+
+        # Cable / fixture phase delay
+        gamma = gamma * np.exp(-2j * np.pi * freqs * 1.2e-9)
+
+        sigma = self.noise * np.sqrt(channel.ifbw_per_point() / 1e3) / np.sqrt(2)
+        gamma = gamma + sigma * (self.rng.standard_normal(len(freqs)) + 1j * self.rng.standard_normal(len(freqs)))
+        return gamma.astype(np.complex64)
+
+    def _sweep(self, channel_numbers):
+        start = max([self.now()] + [self.channels[c].sweep_end for c in self.channels])
+        for c in channel_numbers:
+            channel = self.channels[c]
+            channel.sweep_end = start + channel.duration()
+            start = channel.sweep_end
+            ablation = min(channel.sweep_end / self.drift_time, 1.0)
+            for m, (mc, param) in self.measurements.items():
+                if mc == c:
+                    self.data[m] = self._s11(channel, ablation)
+
+    """
+    BLOCK TRANSFERS
+    """
+    def _encode(self, values):
+        values = np.asarray(values)
+        if self.data_format.startswith('REAL'):
+            bits = 64 if self.data_format.endswith('64') else 32
+            dtype = ('<' if self.byte_order == 'SWAP' else '>') + ('f8' if bits == 64 else 'f4')
+            payload = values.astype(dtype).tobytes()
+            length = str(len(payload))
+            return b"#" + str(len(length)).encode() + length.encode() + payload + b"\n"
+        return (",".join("%.9e" % v for v in values) + "\n").encode()
+
+    def _measurement_data(self, m):
+        if m not in self.data:
+            channel = self.channels[self.measurements.get(m, (1, 'S11'))[0]]
+            self.data[m] = self._s11(channel, 0.0)
+        trace = self.data[m]
+        return np.column_stack((trace.real, trace.imag)).ravel()
+
+    def _formatted_data(self, m):
+        # Two values per point like the instrument, the second one is 0 for scalar formats
+        data = self._measurement_data(m).reshape(-1, 2)
+        trace = data[:, 0] + 1j * data[:, 1]
+        form = self.formats.get(m, 'MLOG')
+        if form in ('POL', 'SMIT'):
+            return data.ravel()
+        if form == 'MLIN':
+            first = np.abs(trace)
+        elif form == 'PHAS':
+            first = np.degrees(np.angle(trace))
+        elif form == 'REAL':
+            first = trace.real
+        elif form == 'IMAG':
+            first = trace.imag
+        else:
+            first = 20 * np.log10(np.maximum(np.abs(trace), 1e-12))
+        return np.column_stack((first, np.zeros(len(first)))).ravel()
+
+    """
+    PARSER
+    """
+    def _parse(self, command):
+        command = command.strip()
+        header, _, args = command.partition(' ')
+        query = header.endswith('?')
+        header = header.rstrip('?').lstrip(':')
+
+        nodes = []
+        for node in header.split(':'):
+            match = re.match(r"([A-Za-z*]+)(\d*)$", node)
+            if match is None:
+                nodes.append((node.upper(), None))
+            else:
+                nodes.append((short_form(match.group(1)), int(match.group(2)) if match.group(2) else None))
+
+        # Arguments: split on commas outside quotes, strip quotes
+        args = [a.strip().strip("'\"") for a in re.findall(r"'[^']*'|\"[^\"]*\"|[^,]+", args)]
+        return nodes, args, query
+
+    def write(self, command):
+        self.command_log.append(command)
+        nodes, args, query = self._parse(command)
+        names = ":".join(n for n, _ in nodes)
+
+        # A new command discards unread responses (IEEE 488.2 query interrupted)
+        if query:
+            self.output = []
+
+        response = self._execute(nodes, names, args, query)
+        if query and response is not None:
+            self.output.append(response if isinstance(response, bytes) else (str(response) + "\n").encode())
+        return len(command)
+
+    def _execute(self, nodes, names, args, query):
+        n0 = nodes[0][1] if nodes[0][1] is not None else 1
+
+        # COMMON COMMANDS
+        if names == '*IDN':
+            return IDN
+        if names == '*OPC':
+            self._wait_all()
+            return 1
+        if names in ('*RST', '*CLS', '*WAI'):
+            if names == '*WAI':
+                self._wait_all()
+            return None
+
+        # SENSE
+        if nodes[0][0] == 'SENS':
+            channel = self.channels.setdefault(n0, _Channel())
+            return self._sense(channel, nodes, names, args, query)
+
+        # CALCULATE
+        if names in ('CALC:PAR:COUN', 'CALC:PAR:SEL', 'CALC:MEAS:SEL'):
+            return None
+        if names == 'CALC:MEAS:FORM':
+            m = nodes[1][1] or 1
+            if query:
+                return self.formats.get(m, 'MLOG')
+            self.formats[m] = short_form(args[0])
+            return None
+        if names == 'CALC:MEAS:PAR':
+            self.measurements[nodes[1][1] or 1] = (n0, args[0].upper())
+            return None
+        if names in ('CALC:MEAS:DATA:SDAT', 'CALC:DATA:SDAT'):
+            m = nodes[1][1] or 1 if names.startswith('CALC:MEAS') else 1
+            return self._encode(self._measurement_data(m))
+        if names in ('CALC:MEAS:DATA:FDAT', 'CALC:DATA:FDAT'):
+            m = nodes[1][1] or 1 if names.startswith('CALC:MEAS') else 1
+            return self._encode(self._formatted_data(m))
+        if names == 'CALC:DATA:MSD':
+            wanted = [int(m) for m in ",".join(args).split(',') if m.strip() != '']
+            return self._encode(np.concatenate([self._formatted_data(m) for m in wanted]))
+        if names == 'CALC:MEAS:DATA:SNP:PORT:SAVE':
+            self._save_snp(args)
+            return None
+
+        # TRIGGER / INITIATE
+        if names == 'TRIG:SCOP':
+            if query:
+                return self.trigger_scope
+            self.trigger_scope = 'ALL' if args[0].upper().startswith('ALL') else 'CURR'
+            return None
+        if names in ('INIT:IMM', 'INIT'):
+            if self.trigger_scope == 'ALL':
+                self._sweep([c for c in sorted(self.channels) if self.channels[c].mode != 'HOLD'])
+            else:
+                self._sweep([n0])
+            return None
+
+        # MASS MEMORY / FORMAT / DISPLAY
+        if names == 'MMEM:MDIR':
+            os.makedirs(self._local_path(args[0]), exist_ok=True)
+            return None
+        if names == 'MMEM:STOR:TRAC:FORM:SNP':
+            self.snp_format = args[0].upper()
+            return None
+        if names == 'FORM:DATA' or names == 'FORM':
+            if query:
+                return self.data_format
+            self.data_format = args[0].upper() + ("," + args[1] if len(args) > 1 else "")
+            if self.data_format.startswith('REAL') and ',' not in self.data_format:
+                self.data_format += ',64'
+            return None
+        if names == 'FORM:BORD':
+            self.byte_order = short_form(args[0])
+            return None
+        if names.startswith('DISP'):
+            return None
+
+        self.unknown_commands.append(names)
+        return 0 if query else None
+
+    def _sense(self, channel, nodes, names, args, query):
+        if names in ('SENS:FREQ:STAR', 'SENS:FREQ:STOP'):
+            attr = 'start' if names.endswith('STAR') else 'stop'
+            if query:
+                return "%+.11E" % getattr(channel, attr)
+            setattr(channel, attr, float(args[0]))
+            return None
+        if names == 'SENS:SWE:POIN':
+            if query:
+                return "%+d" % channel.points
+            channel.points = int(float(args[0]))
+            return None
+        if names in ('SENS:BAND', 'SENS:BWID', 'SENS:BAND:RES', 'SENS:BWID:RES'):
+            if query:
+                return "%+.11E" % channel.ifbw
+            channel.ifbw = float(args[0])
+            return None
+        if names == 'SENS:SWE:TIME':
+            if query:
+                return "%+.11E" % channel.duration()
+            channel.sweep_time = float(args[0])
+            channel.sweep_time_auto = False
+            return None
+        if names == 'SENS:SWE:TIME:AUTO':
+            channel.sweep_time_auto = args[0].upper() in ('ON', '1')
+            return None
+        if names == 'SENS:SWE:MODE':
+            if query:
+                return channel.mode
+            channel.mode = short_form(args[0])
+            if channel.mode in ('SING', 'CONT', 'GRO'):
+                # SINGLE/CONT arm the channel; the sweep itself starts with INIT
+                pass
+            return None
+        if names == 'SENS:SWE:TYPE':
+            if query:
+                return channel.sweep_type
+            channel.sweep_type = short_form(args[0])
+            return None
+        if names == 'SENS:X':
+            return self._encode(channel.frequencies())
+
+        # SEGMENT TABLE
+        if names == 'SENS:SEGM:DEL:ALL':
+            channel.segments = {}
+            return None
+        if names == 'SENS:SEGM:BWID:CONT':
+            channel.segment_ifbw = args[0].upper() in ('ON', '1')
+            return None
+        if nodes[1][0] == 'SEGM' and nodes[1][1] is not None:
+            seg = channel.segments.setdefault(nodes[1][1], {'start': channel.start, 'stop': channel.stop,
+                                                            'points': 21, 'ifbw': channel.ifbw, 'state': True})
+            key = {'SENS:SEGM:FREQ:STAR': 'start', 'SENS:SEGM:FREQ:STOP': 'stop', 'SENS:SEGM:SWE:POIN': 'points',
+                   'SENS:SEGM:BWID': 'ifbw', 'SENS:SEGM:STAT': 'state'}.get(names)
+            if key == 'points':
+                seg[key] = int(float(args[0]))
+            elif key == 'state':
+                seg[key] = args[0].upper() in ('ON', '1')
+            elif key is not None:
+                seg[key] = float(args[0])
+            return None
+
+        if names.startswith('SENS:FOM'):
+            return 0 if query else None
+
+        self.unknown_commands.append(names)
+        return 0 if query else None
+
+    """
+    DISK
+    """
+    def _local_path(self, path):
+        # 'D:/folder' or 'folder' (relative to D:/, the default folder of the ENA)
+        path = path.replace('\\', '/')
+        if re.match(r"^[A-Za-z]:/", path):
+            path = path[3:]
+        return os.path.join(self.disk_root, path)
+
+    def _save_snp(self, args):
+        # CALC:MEAS:DATA:SNP:PORTs:Save '<ports>', '<file>' - saves the selected (first) measurement
+        ports, filename = args[0], args[-1]
+        port = int(ports.split(',')[0] or 1)
+        measurement = sorted(m for m, (c, p) in self.measurements.items() if p == 'S' + str(port) * 2)
+        measurement = measurement[0] if measurement else 1
+        channel = self.channels[self.measurements.get(measurement, (1, 'S11'))[0]]
+
+        # The file holds the data of the sweep in progress once it is done
+        self._wait_until(channel.sweep_end)
+        if measurement not in self.data:
+            self.data[measurement] = self._s11(channel, 0.0)
+
+        local = self._local_path(filename)
+        os.makedirs(os.path.dirname(local) or '.', exist_ok=True)
+        write_s1p(local, channel.frequencies(), self.data[measurement], port)
+
+    """
+    PYVISA RESOURCE INTERFACE
+    """
+    def read(self):
+        if not self.output:
+            raise SimulatedTimeout("VI_ERROR_TMO (-1073807339): Timeout expired before operation completed.")
+        return self.output.pop(0).decode()
+
+    def read_raw(self):
+        if not self.output:
+            raise SimulatedTimeout("VI_ERROR_TMO (-1073807339): Timeout expired before operation completed.")
+        return self.output.pop(0)
+
+    def query(self, command):
+        self.write(command)
+        return self.read()
+
+    def query_ascii_values(self, command, converter='f', separator=',', container=list):
+        self.write(command)
+        text = self.read().strip()
+        return container([float(v) for v in text.split(separator) if v != ''])
+
+    def query_binary_values(self, command, datatype='f', is_big_endian=False, container=list, **kwargs):
+        self.write(command)
+        block = self.read_raw()
+        if not block.startswith(b"#"):
+            raise IOError("Binary block expected, got ASCII data (check FORM:DATA)")
+        digits = int(block[1:2])
+        length = int(block[2:2 + digits])
+        payload = block[2 + digits:2 + digits + length]
+        fmt = ('>' if is_big_endian else '<') + str(length // struct.calcsize(datatype)) + datatype
+        return container(struct.unpack(fmt, payload))
+
+    def assert_trigger(self):
+        self._execute([('INIT', None), ('IMM', None)], 'INIT:IMM', [], False)
+
+    def clear(self):
+        self.output = []
+
+    def close(self):
+        pass
+
+
+class SimulatedResourceManager:
+    def __init__(self, **kwargs):
+        """
+        @param kwargs: passed to every SimulatedE5080A opened (disk_root, time_scale, noise, ...)
+        """
+        self.kwargs = kwargs
+
+    def list_resources(self, query='?*::INSTR'):
+        return (RESOURCE_NAME,)
+
+    def open_resource(self, resource_name, **kwargs):
+        options = dict(self.kwargs)
+        options.update(kwargs)
+        return SimulatedE5080A(resource_name, **options)
+
+    def close(self):
+        pass
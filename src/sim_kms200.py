@@ -0,0 +1,389 @@
+"""
+
+SIMULATED SAIREM KMS200 MICROWAVE GENERATOR
+
+Atlantic Cancer Research Institute - ACRI
+
+Register level model of the generator (see kms200.py for the register map), so that the tests,
+the timing benchmarks and the safety interlock can run end-to-end without the generator on COM7.
+
+Modelled behaviour:
+    - Power ramp: the transmitted power (reg 102) follows the setpoint (reg 0) at RAMP_RATE W/s
+      while microwaves are ON (reg 2 bit 6) and falls linearly to 0 within OFF_TIME of the OFF
+      write, inside the 1 ms the five iteration test waits before checking reg 102 == 0.
+    - Slow OFF fault (off_time=SLOW_OFF_TIME or set_off_time()): the power is still above 0 after
+      the settle time of the forward_off interlock limit, to test that limit.
+    - Reflected power (reg 103): transmitted power * |reflection coefficient|^2 of a resonant load.
+      In reflected power limitation mode (reg 2 bit 4) the transmitted power is reduced so that the
+      reflected power stays below reg 1. Outside of that mode, a reflected power above reg 1 trips
+      a fault.
+    - Fault (reg 105 bit 0): microwaves are forced OFF until the fault is reset (reg 2 = 0x80).
+    - Watchdog (reg 98, 0.1 s units): without any Modbus transaction for that long, microwaves go
+      OFF and the watchdog and fault bits are set.
+    - Scan: with reg 17 bit 0 set and microwaves ON, the frequency steps from reg 11 to reg 12 by
+      reg 16 every SCAN_DWELL seconds and the status gets the scan complete bit (reg 105 = 160
+      while ON, 32 once OFF). Writing reg 17 = 0x04 prepares the scan data: reg 109 counts down to 0,
+      then regs 113-115 hold the minimum and the record (regs 110, 200...) holds every point.
+
+Two ways to reach it:
+    - SimulatedModbusClient: in-process object with the pymodbus 2.x client methods used here
+      (connect, write_register, write_registers, read_holding_registers, close).
+    - serve_tcp() / serve_rtu(): a real pymodbus slave (TCP, or RTU framer on a serial port such as
+      one end of a pty pair made with "socat -d -d pty,raw,echo=0 pty,raw,echo=0" or of a com0com
+      pair), for tests going through the whole Modbus stack.
+"""
+
+import math
+import time
+import threading
+
+from kms200 import *
+
+# GENERATOR DYNAMICS
+RAMP_RATE = 400.0           # W/s
+OFF_TIME = 0.0005           # s, transmitted power back to 0 after OFF
+SLOW_OFF_TIME = 0.2         # s, fault mode: longer than the forward_off settle (interlock.py)
+MAX_POWER = 200             # W
+SCAN_DWELL = 0.05           # s per scan frequency
+SCAN_DATA_DELAY = 0.1       # s per count of reg 109
+
+# DEFAULT LOAD: resonant probe in liver
+LOAD_FREQUENCY = 2450.0     # MHz
+LOAD_Q = 15.0
+LOAD_MATCH = 0.15           # |reflection coefficient| at resonance
+
+
+class SimulatedKMS200:
+    def __init__(self, load_frequency=LOAD_FREQUENCY, load_q=LOAD_Q, load_match=LOAD_MATCH, clock=time.monotonic,
+                 off_time=OFF_TIME):
+        """
+        @param load_frequency: resonance of the load (MHz)
+        @param load_q: quality factor of the load
+        @param load_match: |reflection coefficient| at resonance
+        @param clock: time source in seconds (replace to run faster than real time)
+        @param off_time: fall time of the transmitted power after OFF (s), SLOW_OFF_TIME for the fault mode
+        """
+        self.load_frequency = load_frequency
+        self.load_q = load_q
+        self.load_match = load_match
+        self.off_time = off_time
+        self.clock = clock
+        self.lock = threading.RLock()
+
+        self.registers = [0] * (REG_SCAN_RECORD + 2 * SCAN_RECORD_MAX)
+        self.registers[REG_TIMEOUT] = 3000
+        self.registers[REG_FREQUENCY] = 24500
+        self.registers[REG_FREQUENCY_READ] = 24500
+
+        self.forward = 0.0
+        # Transmitted power and time of the last OFF write (linear fall from there)
+        self.off_forward = 0.0
+        self.t_off = None
+        self.status = 0
+        self.t_last = self.clock()
+        self.t_comm = self.t_last
+
+        # Reflection override for tests (None = resonant load model)
+        self.forced_reflection = None
+
+        self.scanning = False
+        self.scan_frequency = 0
+        self.scan_next = 0.0
+        self.scan_points = []
+        self.scan_data_end = None
+
+        self.transactions = 0
+
+    """
+    LOAD
+    """
+    def reflection(self, frequency):
+        """
+        @param frequency: MHz
+        @return: |reflection coefficient| of the load
+        """
+        if self.forced_reflection is not None:
+            return self.forced_reflection
+        detune = self.load_q * (frequency / self.load_frequency - self.load_frequency / frequency)
+        return math.sqrt(self.load_match ** 2 + (1 - self.load_match ** 2) * detune ** 2 / (1 + detune ** 2))
+
+    def set_load(self, frequency=None, q=None, match=None, reflection=None):
+        """
+        Changes the load while running (e.g. tissue drying out, probe pulled out: reflection=1.0).
+        """
+        with self.lock:
+            self._advance()
+            if frequency is not None:
+                self.load_frequency = frequency
+            if q is not None:
+                self.load_q = q
+            if match is not None:
+                self.load_match = match
+            self.forced_reflection = reflection
+
+    def set_off_time(self, off_time):
+        """
+        Changes the fall time of the transmitted power after OFF (e.g. SLOW_OFF_TIME, OFF_TIME).
+        """
+        with self.lock:
+            self._advance()
+            self.off_time = off_time
+
+    """
+    MODEL
+    """
+    def _microwave_on(self):
+        return bool(self.registers[REG_CONTROL] & CTRL_MICROWAVE_ON) and not self.status & STATUS_FAULT
+
+    def _trip(self, flags):
+        self.status |= STATUS_FAULT | flags
+        self.forward = 0.0
+
+    def _advance(self):
+        # Brings the model up to the current time
+        now = self.clock()
+        dt = max(now - self.t_last, 0.0)
+        self.t_last = now
+
+        # WATCHDOG
+        timeout = self.registers[REG_TIMEOUT] * TIMEOUT_UNIT
+        if timeout > 0 and now - self.t_comm > timeout and self._microwave_on():
+            self._trip(STATUS_WATCHDOG)
+
+        # SCAN PROGRESSION
+        if self.scanning and self._microwave_on():
+            while self.scanning and now >= self.scan_next:
+                self._scan_point()
+
+        frequency = (self.scan_frequency if self.scanning else self.registers[REG_FREQUENCY]) / 10.0
+        self.registers[REG_FREQUENCY_READ] = int(frequency * 10)
+        gamma2 = self.reflection(frequency) ** 2
+
+        # POWER RAMP
+        if self._microwave_on():
+            target = min(self.registers[REG_POWER], MAX_POWER)
+            limited = False
+            if self.registers[REG_CONTROL] & CTRL_RPOWER_LIMIT and gamma2 > 0:
+                limit = self.registers[REG_RPOWER_LIMIT] / gamma2
+                if limit < target:
+                    target = limit
+                    limited = True
+            if self.forward < target:
+                self.forward = min(self.forward + RAMP_RATE * dt, target)
+            else:
+                self.forward = target
+
+            if limited:
+                self.status |= STATUS_RPOWER_LIMITED
+            else:
+                self.status &= ~STATUS_RPOWER_LIMITED
+
+            if not self.registers[REG_CONTROL] & CTRL_RPOWER_LIMIT and self.registers[REG_RPOWER_LIMIT] > 0 \
+                    and self.forward * gamma2 > self.registers[REG_RPOWER_LIMIT]:
+                self._trip(0)
+        else:
+            if self.t_off is None or self.off_time <= 0:
+                self.forward = 0.0
+            else:
+                self.forward = self.off_forward * max(1.0 - (now - self.t_off) / self.off_time, 0.0)
+            self.status &= ~STATUS_RPOWER_LIMITED
+
+        self.registers[REG_FORWARD] = int(round(self.forward))
+        self.registers[REG_REFLECTED] = int(round(self.forward * gamma2))
+
+        # SCAN DATA COUNTDOWN
+        if self.scan_data_end is not None:
+            remaining = self.scan_data_end - now
+            self.registers[REG_SCAN_PENDING] = max(int(math.ceil(remaining / SCAN_DATA_DELAY)), 0)
+            if remaining <= 0:
+                self._publish_scan()
+                self.scan_data_end = None
+
+        # STATUS WORD
+        status = self.status & (STATUS_FAULT | STATUS_WATCHDOG | STATUS_RPOWER_LIMITED | STATUS_SCAN_COMPLETE)
+        if self.registers[REG_CONTROL] & CTRL_RPOWER_LIMIT and self._microwave_on():
+            status |= STATUS_RPOWER_LIMIT_MODE
+        if self._microwave_on():
+            status |= STATUS_MICROWAVE_ON
+        self.registers[REG_STATUS] = status
+
+    def _scan_point(self):
+        # Each point is measured once the power has settled at the setpoint
+        frequency = self.scan_frequency / 10.0
+        gamma2 = self.reflection(frequency) ** 2
+        forward = min(self.registers[REG_POWER], MAX_POWER)
+        if self.registers[REG_CONTROL] & CTRL_RPOWER_LIMIT and forward * gamma2 > self.registers[REG_RPOWER_LIMIT]:
+            forward = self.registers[REG_RPOWER_LIMIT] / gamma2
+        self.scan_points.append((self.scan_frequency, int(round(forward * gamma2)), int(round(forward))))
+
+        step = max(self.registers[REG_SCAN_STEP], 1)
+        self.scan_frequency += step
+        self.scan_next += SCAN_DWELL
+        if self.scan_frequency > self.registers[REG_SCAN_STOP] or len(self.scan_points) >= SCAN_RECORD_MAX:
+            self.scanning = False
+            self.status |= STATUS_SCAN_COMPLETE
+
+    def _publish_scan(self):
+        if len(self.scan_points) == 0:
+            return
+        minimum = min(self.scan_points, key=lambda p: p[1])
+        self.registers[REG_SCAN_MIN_FREQ] = minimum[0]
+        self.registers[REG_SCAN_MIN_REFLECTED] = minimum[1]
+        self.registers[REG_SCAN_MIN_FORWARD] = minimum[2]
+        self.registers[REG_SCAN_COUNT] = len(self.scan_points)
+        for n, (frequency, reflected, forward) in enumerate(self.scan_points):
+            self.registers[REG_SCAN_RECORD + 2 * n] = frequency
+            self.registers[REG_SCAN_RECORD + 2 * n + 1] = reflected
+
+    def _write(self, address, value):
+        value = int(value) & 0xFFFF
+        previous = self.registers[address]
+        self.registers[address] = value
+
+        if address == REG_CONTROL:
+            if value & CTRL_FAULT_RESET:
+                self.status &= ~(STATUS_FAULT | STATUS_WATCHDOG)
+            if previous & CTRL_MICROWAVE_ON and not value & CTRL_MICROWAVE_ON:
+                self.off_forward = self.forward
+                self.t_off = self.clock()
+            if value & CTRL_MICROWAVE_ON and not previous & CTRL_MICROWAVE_ON:
+                self.t_off = None
+                # A new ON clears the previous scan result
+                self.status &= ~STATUS_SCAN_COMPLETE
+                if self.registers[REG_SCAN_CONTROL] & SCAN_MODE:
+                    self._start_scan()
+
+        elif address == REG_SCAN_CONTROL:
+            if value & SCAN_MODE and not previous & SCAN_MODE and self._microwave_on():
+                self._start_scan()
+            if value & SCAN_DATA:
+                self.scan_data_end = self.clock() + SCAN_DATA_DELAY * max(len(self.scan_points) // 10, 1)
+                self.registers[REG_SCAN_PENDING] = max(len(self.scan_points) // 10, 1)
+            if not value & SCAN_MODE:
+                self.scanning = False
+
+    def _start_scan(self):
+        self.scanning = True
+        self.scan_points = []
+        self.scan_frequency = self.registers[REG_SCAN_START]
+        self.scan_next = self.clock() + SCAN_DWELL
+
+    """
+    REGISTER ACCESS (one call = one Modbus transaction)
+    """
+    def write_registers(self, address, values):
+        with self.lock:
+            self._advance()
+            self.transactions += 1
+            self.t_comm = self.clock()
+            for n, value in enumerate(values):
+                self._write(address + n, value)
+            self._advance()
+
+    def read_registers(self, address, count):
+        with self.lock:
+            self._advance()
+            self.transactions += 1
+            self.t_comm = self.clock()
+            return list(self.registers[address:address + count])
+
+
+"""
+IN-PROCESS CLIENT (pymodbus 2.x interface)
+"""
+class SimulatedResponse:
+    def __init__(self, registers=None, address=0, count=0):
+        self.registers = registers if registers is not None else []
+        self.address = address
+        self.count = count
+
+    def isError(self):
+        return False
+
+
+class SimulatedModbusClient:
+    def __init__(self, generator=None, latency=0.0):
+        """
+        @param generator: SimulatedKMS200 (a new one when None)
+        @param latency: seconds added to every transaction (RTU at 115200 baud is ~5 ms)
+        """
+        self.generator = generator if generator is not None else SimulatedKMS200()
+        self.latency = latency
+        self.connected = False
+
+    def _wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def connect(self):
+        self.connected = True
+        return True
+
+    def close(self):
+        self.connected = False
+
+    def write_register(self, address, value, unit=UNIT, **kwargs):
+        self._wait()
+        self.generator.write_registers(address, [value])
+        return SimulatedResponse(address=address, count=1)
+
+    def write_registers(self, address, values, unit=UNIT, **kwargs):
+        self._wait()
+        self.generator.write_registers(address, list(values))
+        return SimulatedResponse(address=address, count=len(values))
+
+    def read_holding_registers(self, address, count=1, unit=UNIT, **kwargs):
+        self._wait()
+        return SimulatedResponse(self.generator.read_registers(address, count), address, count)
+
+
+"""
+PYMODBUS SLAVES (pymodbus 2.x server)
+"""
+def _context(generator):
+    from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
+
+    class GeneratorBlock(ModbusSequentialDataBlock):
+        # Every access goes to the generator model instead of a static list
+        def __init__(self):
+            super().__init__(0, [0] * len(generator.registers))
+
+        def validate(self, address, count=1):
+            return 0 <= address and address + count <= len(generator.registers)
+
+        def getValues(self, address, count=1):
+            return generator.read_registers(address, count)
+
+        def setValues(self, address, values):
+            if not isinstance(values, list):
+                values = [values]
+            generator.write_registers(address, values)
+
+    block = GeneratorBlock()
+    # zero_mode: the register number on the wire is the list index (same as the KMS200 documentation)
+    slave = ModbusSlaveContext(hr=block, ir=block, zero_mode=True)
+    return ModbusServerContext(slaves={UNIT: slave}, single=False)
+
+
+def serve_tcp(generator=None, address=("localhost", 5020)):
+    """
+    Blocking Modbus TCP slave. Reach it with ModbusTcpClient(host, port).
+    """
+    from pymodbus.server.sync import StartTcpServer
+    StartTcpServer(_context(generator if generator is not None else SimulatedKMS200()), address=address)
+
+
+def serve_rtu(port, generator=None, baudrate=115200):
+    """
+    Blocking Modbus RTU slave on a serial port (e.g. one end of a pty pair or of a com0com pair),
+    reached with the same ModbusSerialClient(method='rtu', ...) as the real generator.
+    """
+    from pymodbus.server.sync import StartSerialServer
+    from pymodbus.transaction import ModbusRtuFramer
+    StartSerialServer(_context(generator if generator is not None else SimulatedKMS200()), framer=ModbusRtuFramer,
+                      port=port, baudrate=baudrate, timeout=0.005)
+
+
+if __name__ == "__main__":
+    print("Simulated KMS200 listening on localhost:5020 (Modbus TCP, unit " + str(UNIT) + ")")
+    serve_tcp()
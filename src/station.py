@@ -0,0 +1,446 @@
+"""
+
+ABLATION STATION - DEVICES AND HEADLESS TEST RUNNER OF ONE BENCH
+
+Atlantic Cancer Research Institute - ACRI
+
+CircuitAutomatisation_V5_2021.py drives one bench through module globals (analyzer, client, UNIT,
+COM7, Phidget 589734...). A Station bundles the devices of one bench with its own configuration,
+so that several benches can be driven from one workstation (see orchestrator.py):
+
+    analyzer        E5080A (VISA resource name, or SIM)
+    generator       KMS200 on its serial port (or SIM, TCP:host[:port]) behind a ModbusScheduler,
+                    with its setpoint driver, safety interlock and watchdog keep-alive
+    pump            isocratic pump controller (isocratic_pump.open_backend() name, None = no pump)
+    peristaltic     Phidget VoltageOutput serial number (None = no peristaltic pump)
+    relay           FT245R relay board serial number (None = no switch)
+    probe           probe ID in the calibration cache folder calibrations (calibration_cache.py),
+                    None = no permittivity
+
+Stations are described in a JSON file:
+
+    {
+      "stations": [
+        {"name": "Bench A", "generator": "COM7", "pump": "COM6", "peristaltic": 589734, "root": "D:/BenchA"},
+        {"name": "Bench B", "analyzer": "USB0::0x2A8D::0x0001::MY55201299::0::INSTR", "generator": "COM9"},
+        {"name": "Sim", "analyzer": "SIM", "generator": "SIM", "pump": "MOCK", "root": "Sim"}
+      ]
+    }
+
+Two stations can not share a generator port, an analyzer, a pump port or a Phidget/relay board.
+
+run_protocol() runs a compiled protocol (protocol.Timeline) on a station without the GUI. Each
+cycle is ablation_cycle.run_cycle(), the cycle of Five_Iteration_Test: interlock check, reflected
+power check (when a step gives no reflected power limit), microwaves OFF and transmitted power
+checked at 0, sweep, dielectric stop, microwaves ON. Around it, as in Five_Iteration_Test: dumped
+first sweep, reflected power limitation mode, reflected power limit of rpower_ratio x power when a
+step gives none, one trace at the end of each step and one at the end of the test. Every trace is
+in an S11 run store and saved as .s1p on the ENA disk, and a telemetry record (transmitted and
+reflected power, pump flow, interlock state) after each trace is given to a callback and saved in
+the run folder (TELEMETRY_FILE).
+
+Options of Five_Iteration_Test that run_protocol() does not have: measurement pipeline, second
+probe (dual_port.py), segmented sweep (sweep_planner.py), adaptive ON delay and dielectric trend
+(interval_scheduler.py, trend.py) and live plot. With a calibration of the probe, each trace is
+converted to permittivity: its mean eps' and eps'' are in the telemetry record and the
+calibration is saved in the run folder (calibration_cache.RUN_CALIBRATION_FILE).
+"""
+
+import os
+import json
+import time
+import collections
+
+from kms200 import KMS200
+from modbus_scheduler import ModbusScheduler
+from interlock import Interlock
+from keepalive import WatchdogKeepAlive
+from isocratic_pump import PumpController, open_backend, COMMAND_TIMEOUT
+from s11_store import S11Store, fetch_trace, fetch_frequencies
+from ablation_cycle import Measurement, run_cycle, measure_off, CYCLE_DONE
+from permittivity import RunPermittivity
+from calibration_cache import CalibrationCache, write_calibration, RUN_CALIBRATION_FILE
+
+# DEFAULT CONFIGURATION OF A STATION (same values as the globals of CircuitAutomatisation_V5_2021.py)
+STATION_DEFAULTS = {
+    'analyzer': 'USB0::0x2A8D::0x0001::MY55201231::0::INSTR',
+    'generator': 'COM7',
+    'unit': 0x01,
+    'pump': None,
+    'peristaltic': None,
+    'rpm': 0,
+    'relay': None,
+    'root': 'D:/Ablation_Automatisation/Programmation/Automatisation_Andre/DonneesBrutes',
+    'disk_root': 'ENA_Disk',
+    'startfreq': 2000,
+    'stopfreq': 3000,
+    'datapoints': 201,
+    'bw': 1000,
+    'sweep_type': 'LIN',
+    'frequency': 2450,
+    'watchdog': 30.0,
+    'interlock_period': 0.02,
+    'limits': None,
+    'rpower_ratio': 0.5,
+    'probe': None,
+    'calibrations': None,
+    'calibration_temperature': 25.0,
+}
+
+# TELEMETRY RECORDS OF A RUN, IN ITS RUN FOLDER (one per cycle, 'trace' = index of the trace before it)
+TELEMETRY_FILE = "telemetry.json"
+
+# STATION RESOURCES THAT CAN ONLY BELONG TO ONE STATION
+EXCLUSIVE = ('analyzer', 'generator', 'pump', 'peristaltic', 'relay')
+SHAREABLE = ('SIM', 'MOCK', None)
+
+
+class StationError(ValueError):
+    pass
+
+
+class StationConfig(collections.namedtuple('StationConfig', ('name',) + tuple(STATION_DEFAULTS))):
+    """
+    Configuration of one bench (see STATION_DEFAULTS), picklable to start its runner process.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, data):
+        unknown = set(data) - set(cls._fields)
+        if unknown:
+            raise StationError("Unknown station field(s): " + ", ".join(sorted(unknown)))
+        if not data.get('name'):
+            raise StationError("Every station needs a name")
+        values = dict(STATION_DEFAULTS)
+        values.update(data)
+        return cls(**values)
+
+
+def load_stations(path):
+    """
+    @param path: JSON file {"stations": [...]}
+    @return: list of StationConfig (StationError when two stations share a device)
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+    configs = [StationConfig.from_dict(station) for station in data.get('stations', [])]
+    if not configs:
+        raise StationError("No station in " + str(path))
+
+    owners = {}
+    for config in configs:
+        if config.name in [other.name for other in configs if other is not config]:
+            raise StationError("Two stations are named " + config.name)
+        for field in EXCLUSIVE:
+            value = getattr(config, field)
+            if value in SHAREABLE:
+                continue
+            if (field, value) in owners:
+                raise StationError(config.name + " and " + owners[(field, value)] + " both use " + field + " " +
+                                   str(value))
+            owners[(field, value)] = config.name
+    return configs
+
+
+class Station:
+    def __init__(self, config):
+        """
+        @param config: StationConfig, devices are opened by open()
+        """
+        self.config = config
+        self.name = config.name
+        self.analyzer = None
+        self.client = None
+        self.generator = None
+        self.interlock = None
+        self.keepalive = None
+        self.pump = None
+        self.peristaltic = None
+        self.relay = None
+        self.calibrations = None
+
+    """
+    DEVICES
+    """
+    def open(self):
+        config = self.config
+
+        # ANALYZER
+        if config.analyzer == 'SIM':
+            from sim_e5080a import SimulatedResourceManager
+            rm = SimulatedResourceManager(disk_root=os.path.join(config.disk_root, config.name))
+            self.analyzer = rm.open_resource(STATION_DEFAULTS['analyzer'])
+        else:
+            import pyvisa
+            self.analyzer = pyvisa.ResourceManager().open_resource(config.analyzer)
+
+        # GENERATOR
+        if config.generator == 'SIM':
+            from sim_kms200 import SimulatedKMS200, SimulatedModbusClient
+            client = SimulatedModbusClient(SimulatedKMS200())
+        elif config.generator.startswith('TCP'):
+            from pymodbus.client.sync import ModbusTcpClient
+            address = config.generator.split(':')
+            client = ModbusTcpClient(address[1] if len(address) > 1 else 'localhost',
+                                     port=int(address[2]) if len(address) > 2 else 5020, timeout=4)
+        else:
+            from pymodbus.client.sync import ModbusSerialClient
+            client = ModbusSerialClient(method='rtu', port=config.generator, timeout=4, baudrate=115200, strict=False)
+        self.client = ModbusScheduler(client, name="ModbusScheduler " + config.name)
+        self.client.connect()
+        self.generator = KMS200(self.client, config.unit)
+
+        # PUMPS
+        if config.pump is not None:
+            self.pump = PumpController(open_backend(config.pump), name="IsocraticPump " + config.name)
+        if config.peristaltic is not None:
+            from Phidget22.Devices.VoltageOutput import VoltageOutput
+            self.peristaltic = (VoltageOutput(), VoltageOutput())
+            for channel, output in enumerate(self.peristaltic):
+                output.setDeviceSerialNumber(int(config.peristaltic))
+                output.setChannel(channel)
+                output.openWaitForAttachment(1000)
+
+        # SWITCH
+        if config.relay is not None:
+            from relay_ft245r import FT245R
+            self.relay = FT245R()
+            boards = [board for board in self.relay.list_dev() if str(board.serial_number) == str(config.relay)]
+            if not boards:
+                raise IOError(self.name + ": no FT245R board " + str(config.relay))
+            self.relay.connect(boards[0])
+
+        self.interlock = Interlock(self.client, config.limits, config.interlock_period, config.unit, pump=self.pump)
+        self.keepalive = WatchdogKeepAlive(self.client, config.watchdog, unit=config.unit)
+        return self
+
+    def close(self):
+        """
+        Microwaves OFF, pumps in their end state, devices closed.
+        """
+        if self.client is not None:
+            self.interlock.stop()
+            self.keepalive.stop()
+            self.client.write_register(2, 0x00, unit=self.config.unit)
+            self.client.close()
+            self.client.shutdown()
+        if self.pump is not None:
+            self.pump.end().result()
+            self.pump.close()
+        if self.peristaltic is not None:
+            self.peristaltic_off()
+            for output in self.peristaltic:
+                output.close()
+        if self.relay is not None:
+            self.relay.disconnect()
+        if self.analyzer is not None:
+            self.analyzer.close()
+
+    def peristaltic_on(self):
+        # CH1 = SPEED CONTROL, CH0 = PUMP ON (0 V)
+        self.peristaltic[0].setVoltage(0)
+        self.peristaltic[1].setVoltage(self.config.rpm / 40)
+
+    def peristaltic_off(self):
+        self.peristaltic[0].setVoltage(5)
+        self.peristaltic[1].setVoltage(0)
+
+    def setup_analyzer(self, off_delay, folder):
+        """
+        Same configuration as the initialisation of Five_Iteration_Test.
+
+        @param folder: folder of the .s1p files on the ENA disk
+        """
+        config = self.config
+        if config.sweep_type not in ('LIN', 'LOG'):
+            raise StationError(self.name + ": sweep type must be LIN or LOG")
+        self.analyzer.write("SENS1:SWE:POIN " + str(config.datapoints))
+        self.analyzer.write("SENS1:FREQ:START " + str(config.startfreq * 1000000))
+        self.analyzer.write("SENS1:FREQ:STOP " + str(config.stopfreq * 1000000))
+        self.analyzer.write("SENS1:BAND " + str(config.bw))
+        self.analyzer.write("SENS1:SWE:TIME " + str(off_delay))
+        self.analyzer.write("SENS1:SWE:MODE HOLD")
+        self.analyzer.write("MMEMory:STOR:TRAC:FORM:SNP RI")
+        self.analyzer.write("SENS1:SWEep:TYPE " + config.sweep_type)
+        self.analyzer.write("mmemory:mdirectory 'D:/" + folder + "'")
+
+    def sweep(self):
+        """
+        One single sweep of channel 1 (microwaves must be OFF).
+
+        @return: S11 trace (complex64)
+        """
+        self.analyzer.write("SENS1:SWE:MODE SINGLE")
+        self.analyzer.write("TRIGger:SCOPe CURRent")
+        self.analyzer.write("INITiate1:IMMediate")
+        self.analyzer.query("*OPC?")
+        return fetch_trace(self.analyzer)
+
+    def calibration(self, frequencies):
+        """
+        @return: permittivity.ProbeCalibration of the probe on frequencies, None when the cache has none
+        """
+        config = self.config
+        if config.probe is None or config.calibrations is None:
+            return None
+        if self.calibrations is None:
+            self.calibrations = CalibrationCache(config.calibrations)
+        return self.calibrations.lookup(config.probe, frequencies, config.calibration_temperature, config.bw)
+
+    """
+    TELEMETRY
+    """
+    def telemetry(self):
+        """
+        @return: dict of the last interlock sample, pump status and interlock state
+        """
+        record = {'station': self.name, 'time': time.time(), 'forward': None, 'reflected': None, 'flow': None,
+                  'pressure': None, 'tripped': self.interlock.tripped if self.interlock is not None else False}
+        if self.interlock is not None and self.interlock.samples:
+            sample = self.interlock.samples[-1]
+            record['forward'] = sample.forward
+            record['reflected'] = sample.reflected
+        if self.pump is not None:
+            status = self.pump.status()
+            record['flow'] = status.flow
+            record['pressure'] = status.pressure
+        return record
+
+
+def run_protocol(station, timeline, directory, publish=None):
+    """
+    Runs every step of a compiled protocol on a station (Five_Iteration_Test without the GUI).
+
+    @param timeline: protocol.Timeline (compiled with the pump of the station)
+    @param directory: name of the run folder under the root of the station
+    @param publish: called with (kind, dict) for 'step', 'cycle' (telemetry) and 'trip' events
+    @return: dict summary of the run (traces, steps done, trip message or None)
+    """
+    if publish is None:
+        publish = lambda kind, data: None
+    config = station.config
+    client = station.client
+    unit = config.unit
+    path = os.path.join(config.root, directory + " " + time.strftime("%Y-%m-%d %H-%M-%S"))
+    folder = os.path.basename(path)
+
+    store = S11Store(path, config.datapoints, timeline.trace_count() + 2)
+    records = []
+    steps_done = 0
+    trip = None
+
+    def record(eps):
+        telemetry = station.telemetry()
+        telemetry['trace'] = len(store) - 1
+        telemetry['eps_prime'], telemetry['eps_second'] = eps
+        records.append(telemetry)
+        publish('cycle', telemetry)
+
+    try:
+        station.setup_analyzer(timeline.steps[0].off_delay, folder)
+        store.set_frequencies(fetch_frequencies(station.analyzer))
+        permittivity = RunPermittivity(station.calibration(store.frequencies))
+        if permittivity.calibration is not None:
+            write_calibration(os.path.join(path, RUN_CALIBRATION_FILE), permittivity.calibration)
+        measurement = Measurement(station.analyzer, folder, store, permittivity=permittivity)
+
+        def eps():
+            # Permittivity of the last trace (converted by the measurement)
+            if permittivity.calibration is None:
+                return None, None
+            return permittivity.eps_prime[-1], permittivity.eps_second[-1]
+
+        station.generator.refresh()
+        station.generator.setpoints(frequency=int(config.frequency * 10))
+        # Reflected power limitation mode, then microwaves OFF
+        client.write_register(2, 0x10, unit=unit)
+        client.write_register(2, 0x00, unit=unit)
+
+        # The first sweep always gives an invalid trace: dumped
+        station.sweep()
+
+        station.interlock.reset()
+        station.interlock.start()
+        station.keepalive.start()
+        if station.peristaltic is not None:
+            station.peristaltic_on()
+
+        for step in timeline:
+            publish('step', {'index': step.index, 'power': step.power, 'duration': step.duration, 'flow': step.flow})
+            # No microwaves until the pump runs at the flow of the step
+            if station.pump is not None and step.flow is not None:
+                try:
+                    station.pump.run(step.flow).result(COMMAND_TIMEOUT)
+                except Exception as error:
+                    trip = "Isocratic pump did not start at " + str(step.flow) + " ml/min (" + repr(error) + ")"
+                    publish('trip', {'message': trip, 'step': step.index})
+                    break
+
+            # rpower None (value of the generator window) or 0: rpower_ratio x power like Five_Iteration_Test,
+            # with the reflected power check of the OFF phase
+            max_rpower = None if step.rpower else config.rpower_ratio * step.power
+            rpower = step.rpower if step.rpower else max_rpower
+            station.generator.setpoints(rpower=int(rpower), power=int(step.power))
+            station.analyzer.write("SENS1:SWE:TIME " + str(step.off_delay))
+
+            cycle = None
+            t_end = time.monotonic() + step.duration
+            while time.monotonic() + step.on_delay + step.off_delay <= t_end:
+                cycle = run_cycle(client, measurement, len(store) + 1, step.off_delay, step.on_delay, unit,
+                                  station.interlock, max_rpower, step.dielectric)
+                if cycle.trace is not None:
+                    record(eps())
+                if cycle.status != CYCLE_DONE:
+                    break
+
+            # End of step trace (microwaves OFF, transmitted power checked), then the rest of the step.
+            # Dielectric target reached: next step at once
+            if cycle is None or cycle.status == CYCLE_DONE:
+                cycle = measure_off(client, measurement, len(store) + 1, step.off_delay, unit)
+                if cycle.trace is not None:
+                    record(eps())
+                remaining = t_end - time.monotonic()
+                if not cycle.stopped and remaining > 0:
+                    time.sleep(remaining)
+
+            client.write_register(2, 0x00, unit=unit)
+            if cycle.stopped:
+                trip = cycle.message
+            elif station.interlock.tripped:
+                trip = station.interlock.last_trip().message
+            if trip is not None:
+                publish('trip', {'message': trip, 'step': step.index})
+                break
+            steps_done += 1
+
+        # End of test trace
+        if trip is None:
+            cycle = measure_off(client, measurement, len(store) + 1, timeline.steps[-1].off_delay, unit)
+            if cycle.stopped:
+                trip = cycle.message
+                publish('trip', {'message': trip, 'step': None})
+            else:
+                record(eps())
+    finally:
+        client.write_register(2, 0x00, unit=unit)
+        station.interlock.stop()
+        station.keepalive.stop()
+        if station.peristaltic is not None:
+            station.peristaltic_off()
+        if station.pump is not None:
+            try:
+                station.pump.standby().result(COMMAND_TIMEOUT)
+            except Exception as error:
+                message = "Isocratic pump standby failed (" + repr(error) + ")"
+                publish('trip', {'message': message, 'step': None})
+                if trip is None:
+                    trip = message
+        if station.interlock.tripped:
+            station.interlock.save(os.path.join(path, "interlock.json"))
+        with open(os.path.join(path, TELEMETRY_FILE), "w") as f:
+            json.dump(records, f)
+        traces = len(store)
+        store.close()
+
+    return {'path': path, 'traces': traces, 'steps': steps_done, 'trip': trip}
@@ -0,0 +1,224 @@
+"""
+
+SEGMENTED SWEEP PLANNER - NETWORK ANALYZER E5080A
+
+Atlantic Cancer Research Institute - ACRI
+
+Instead of one linear/log sweep from startFreq to stopFreq with a single IF bandwidth, the
+measurement is described as a list of frequency bands of interest. Each band has its own number
+of points and its own IF bandwidth, and the list becomes the segment table of the ENA
+(SENS:SEGM, sweep type SEGMent).
+
+For every band the planner picks the widest IF bandwidth that still meets the target trace noise.
+When even the narrowest one does not, the band keeps it and is flagged (Band.noise_met, summary()).
+The OFF window (delaimesure) is then the estimated sweep time plus the trace transfer, rather
+than a window sized for the full span. Microwaves stay ON for a larger share of each cycle.
+
+Noise model: the rms noise of S11 scales with sqrt(IFBW). The reference value (noise measured
+at a given IFBW) should come from repeated traces of the probe, see noise_from_traces().
+
+Sweep time model: 1/IFBW per point plus a fixed per point and per segment overhead. The real
+value can be read back with SENS:SWE:TIME? once the table is loaded (see measured_sweep_time()).
+"""
+
+import math
+import numpy as np
+
+# IF BANDWIDTHS AVAILABLE ON THE E5080A (Hz)
+IFBW_VALUES = [1, 2, 3, 5, 7, 10, 15, 20, 30, 50, 70, 100, 150, 200, 300, 500, 700,
+               1e3, 1.5e3, 2e3, 3e3, 5e3, 7e3, 10e3, 15e3, 20e3, 30e3, 50e3, 70e3,
+               100e3, 150e3, 200e3, 300e3, 500e3, 700e3, 1e6]
+
+# SWEEP TIME MODEL (s)
+POINT_OVERHEAD = 15e-6
+SEGMENT_OVERHEAD = 1e-3
+RETRACE_TIME = 5e-3
+
+# TRANSFER OF ONE TRACE (REAL,32 -> 8 bytes per point) AND SAFETY MARGIN
+TRANSFER_RATE = 2e6     # bytes/s
+TRANSFER_LATENCY = 5e-3
+OFF_WINDOW_MARGIN = 0.02
+
+
+class Band:
+    def __init__(self, startFreq, stopFreq, points, max_ifbw=None):
+        """
+        @param startFreq, stopFreq: band limits (MHz, same unit as the GUI)
+        @param points: number of points in the band
+        @param max_ifbw: widest IF bandwidth allowed for this band (Hz), None = no limit
+        """
+        if stopFreq < startFreq:
+            raise ValueError("Band stop frequency is below its start frequency")
+        if int(points) < 1:
+            raise ValueError("A band needs at least one point")
+        self.startFreq = startFreq
+        self.stopFreq = stopFreq
+        self.points = int(points)
+        self.max_ifbw = max_ifbw
+        self.ifbw = None
+        self.noise_met = None
+
+    def __repr__(self):
+        return "Band(%g-%g MHz, %d pts, IFBW %s Hz)" % (self.startFreq, self.stopFreq, self.points, self.ifbw)
+
+
+def parse_bands(text):
+    """
+    Reads the band list typed in the GUI: "start:stop:points[:maxIFBW]" separated by ';'.
+    Example: "2400:2440:21:1000; 2440:2460:101; 2460:2500:21:1000"
+
+    @return: list of Band
+    """
+    bands = []
+    for item in text.split(';'):
+        item = item.strip()
+        if item == '':
+            continue
+        fields = [float(f) for f in item.split(':')]
+        if len(fields) not in (3, 4):
+            raise ValueError("Band '" + item + "' must be start:stop:points[:maxIFBW]")
+        bands.append(Band(fields[0], fields[1], int(fields[2]), fields[3] if len(fields) == 4 else None))
+    return bands
+
+
+def noise_from_traces(traces, ifbw):
+    """
+    Reference noise from repeated traces of a stable load (e.g. rows of an S11Store).
+
+    @param traces: (repetitions, datapoints) complex array
+    @param ifbw: IF bandwidth used for these traces (Hz)
+    @return: (noise_ref, ifbw) to give to SweepPlan
+    """
+    traces = np.asarray(traces)
+    return float(np.median(np.std(np.abs(traces), axis=0))), ifbw
+
+
+class SweepPlan:
+    def __init__(self, bands, target_noise, noise_ref=1e-4, noise_ref_ifbw=1e3):
+        """
+        @param bands: list of Band
+        @param target_noise: highest rms |S11| noise accepted on each point
+        @param noise_ref: rms |S11| noise measured at noise_ref_ifbw
+        @param noise_ref_ifbw: IF bandwidth of the reference noise (Hz)
+        """
+        if len(bands) == 0:
+            raise ValueError("The sweep plan needs at least one band")
+
+        # Segments must not overlap: sort them by start frequency
+        self.bands = sorted(bands, key=lambda b: b.startFreq)
+        for previous, band in zip(self.bands, self.bands[1:]):
+            if band.startFreq < previous.stopFreq:
+                raise ValueError("Bands " + repr(previous) + " and " + repr(band) + " overlap")
+
+        self.target_noise = target_noise
+        self.noise_ref = noise_ref
+        self.noise_ref_ifbw = noise_ref_ifbw
+
+        for band in self.bands:
+            band.ifbw = self.pick_ifbw(band.max_ifbw)
+            band.noise_met = self.noise(band.ifbw) <= self.target_noise
+
+    """
+    ESTIMATES
+    """
+    def noise(self, ifbw):
+        return self.noise_ref * math.sqrt(ifbw / self.noise_ref_ifbw)
+
+    def pick_ifbw(self, max_ifbw=None):
+        """
+        @return: widest E5080A IF bandwidth meeting the target noise (and below max_ifbw), the narrowest
+                 one when none does (see noise_met)
+        """
+        best = IFBW_VALUES[0]
+        for ifbw in IFBW_VALUES:
+            if max_ifbw is not None and ifbw > max_ifbw:
+                break
+            if self.noise(ifbw) <= self.target_noise:
+                best = ifbw
+        return best
+
+    @property
+    def noise_met(self):
+        """
+        @return: False when a band does not reach the target noise, even at the narrowest IF bandwidth
+        """
+        return all(band.noise_met for band in self.bands)
+
+    @property
+    def points(self):
+        return sum(band.points for band in self.bands)
+
+    def sweep_time(self):
+        """
+        @return: estimated sweep time of the whole segment table (s)
+        """
+        total = RETRACE_TIME
+        for band in self.bands:
+            total += SEGMENT_OVERHEAD + band.points * (1.0 / band.ifbw + POINT_OVERHEAD)
+        return total
+
+    def transfer_time(self):
+        return TRANSFER_LATENCY + self.points * 8 / TRANSFER_RATE
+
+    def off_window(self, sweep_time=None):
+        """
+        Minimum OFF window: sweep + one trace transfer + margin, rounded up to the ms.
+
+        @param sweep_time: measured sweep time (s), the estimate is used when None
+        """
+        if sweep_time is None:
+            sweep_time = self.sweep_time()
+        return math.ceil((sweep_time + self.transfer_time() + OFF_WINDOW_MARGIN) * 1000) / 1000
+
+    def fits(self, delaimesure, sweep_time=None):
+        """
+        @param delaimesure: OFF window of a step (s)
+        @param sweep_time: measured sweep time (s), the estimate is used when None
+        @return: True when the sweep of the plan ends inside that OFF window
+        """
+        if sweep_time is None:
+            sweep_time = self.sweep_time()
+        return sweep_time <= delaimesure
+
+    def summary(self):
+        lines = []
+        for band in self.bands:
+            line = "%g-%g MHz: %d points, IFBW %g Hz, noise %.2e" % (band.startFreq, band.stopFreq, band.points,
+                                                                     band.ifbw, self.noise(band.ifbw))
+            if not band.noise_met:
+                line += " (TARGET NOISE %.2e NOT MET)" % self.target_noise
+            lines.append(line)
+        lines.append("Estimated sweep time: %.3f s / OFF window: %.3f s" % (self.sweep_time(), self.off_window()))
+        return "\n".join(lines)
+
+    """
+    ANALYZER
+    """
+    def apply(self, analyzer, channel=1):
+        """
+        Loads the segment table and switches the channel to a segment sweep.
+        """
+        sens = "SENS" + str(channel)
+        analyzer.write(sens + ":SEGM:DEL:ALL")
+
+        # IF bandwidth set per segment instead of SENS:BAND
+        analyzer.write(sens + ":SEGM:BWID:CONT ON")
+
+        for n, band in enumerate(self.bands, start=1):
+            segm = sens + ":SEGM" + str(n)
+            analyzer.write(segm + ":ADD")
+            analyzer.write(segm + ":FREQ:STAR " + str(band.startFreq * 1000000))
+            analyzer.write(segm + ":FREQ:STOP " + str(band.stopFreq * 1000000))
+            analyzer.write(segm + ":SWE:POIN " + str(band.points))
+            analyzer.write(segm + ":BWID " + str(band.ifbw))
+            analyzer.write(segm + ":STAT ON")
+
+        # Fastest sweep the table allows
+        analyzer.write(sens + ":SWE:TIME:AUTO ON")
+        analyzer.write(sens + ":SWEep:TYPE SEGMent")
+
+    def measured_sweep_time(self, analyzer, channel=1):
+        """
+        @return: sweep time computed by the ENA for the loaded table (s)
+        """
+        return float(analyzer.query("SENS" + str(channel) + ":SWE:TIME?"))
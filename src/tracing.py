@@ -0,0 +1,244 @@
+"""
+
+PHASE TRACING OF THE INSTRUMENT CALLS
+
+Atlantic Cancer Research Institute - ACRI
+
+Every instrument call can be recorded with its device, command, duration and number of bytes
+moved:
+    - network analyzer: write, read, query, query_binary_values
+    - generator (Modbus): write_register, write_registers, read_holding_registers
+    - LucidControl (lucidIo): every Cmd transaction, with the TxCmd.transmit / RxCmd.receive frames
+    - Phidget VoltageOutput: setVoltage
+
+Calls are attached to the current test phase (e.g. "Step 2/Cycle 14/OFF"), opened with
+TRACER.begin(name) and closed with TRACER.end(). The trace can be exported as Chrome trace-event
+JSON (chrome://tracing or https://ui.perfetto.dev): phases and calls appear as nested bars.
+
+Cost: when tracing is off, no wrapper is installed on the instruments (the original methods are
+called) and begin()/end() return after one test. When on, a call costs two perf_counter_ns()
+and one append. The events are kept in a deque of max_events entries (MAX_EVENTS by default):
+on a long session the oldest are dropped (the interlock alone adds ~50 Modbus events per second).
+
+Usage:
+    TRACER.enable()                 # or TRACER.enable(max_events=100000)
+    TRACER.instrument_analyzer(analyzer)
+    TRACER.instrument_modbus(client)
+    ...
+    TRACER.export_chrome("trace.json")
+    TRACER.disable()       # original methods back
+"""
+
+import os
+import json
+import struct
+import threading
+from collections import deque
+from time import perf_counter_ns
+
+# MODBUS RTU FRAME SIZES (bytes): address + function + CRC
+RTU_WRITE_REGISTER = 8 + 8
+RTU_READ_REQUEST = 8
+RTU_READ_RESPONSE = 5
+
+# EVENTS KEPT (the oldest are dropped), ~100 bytes each
+MAX_EVENTS = 1000000
+
+
+def _analyzer_label(args):
+    # SCPI header only, the complete command goes in the event arguments
+    return str(args[0]).split(' ', 1)[0] if args else ''
+
+
+class Tracer:
+    def __init__(self, max_events=MAX_EVENTS):
+        self.enabled = False
+        self.events = deque(maxlen=max_events)
+        self.local = threading.local()
+        self.t_origin = perf_counter_ns()
+        # (owner, attribute name, original) of every installed wrapper
+        self.patches = []
+
+    """
+    ON / OFF
+    """
+    def enable(self, max_events=None):
+        """
+        @param max_events: new size limit of the event list, None = unchanged
+        """
+        if max_events is not None and max_events != self.events.maxlen:
+            self.events = deque(self.events, maxlen=max_events)
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stops recording and puts back every original method.
+        """
+        self.enabled = False
+        for owner, name, original in reversed(self.patches):
+            if original is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+        self.patches = []
+
+    def clear(self):
+        self.events.clear()
+        self.t_origin = perf_counter_ns()
+
+    """
+    PHASES
+    """
+    def _phases(self):
+        try:
+            return self.local.phases
+        except AttributeError:
+            self.local.phases = []
+            self.local.path = ''
+            return self.local.phases
+
+    def begin(self, name):
+        if not self.enabled:
+            return
+        phases = self._phases()
+        phases.append((name, perf_counter_ns()))
+        self.local.path = "/".join(p[0] for p in phases)
+
+    def end(self):
+        if not self.enabled:
+            return
+        phases = self._phases()
+        if len(phases) == 0:
+            return
+        path = self.local.path
+        name, t0 = phases.pop()
+        self.events.append(('phase', name, t0, perf_counter_ns(), threading.get_ident(), path, None, None))
+        self.local.path = "/".join(p[0] for p in phases)
+
+    def end_all(self):
+        while self.enabled and len(self._phases()):
+            self.end()
+
+    def current_phase(self):
+        return getattr(self.local, 'path', '')
+
+    """
+    INSTRUMENT WRAPPERS
+    """
+    def _wrap(self, owner, name, device, label, size, bound):
+        original = getattr(owner, name)
+        tracer = self
+
+        if bound:
+            # Instance attribute: original is already bound
+            def traced(*args, **kwargs):
+                t0 = perf_counter_ns()
+                result = original(*args, **kwargs)
+                t1 = perf_counter_ns()
+                tracer.events.append((device, label(args), t0, t1, threading.get_ident(), getattr(tracer.local, 'path', ''),
+                               args, size(args, kwargs, result)))
+                return result
+        else:
+            # Class attribute: args[0] is the instance
+            def traced(*args, **kwargs):
+                t0 = perf_counter_ns()
+                result = original(*args, **kwargs)
+                t1 = perf_counter_ns()
+                tracer.events.append((device, label(args[1:]), t0, t1, threading.get_ident(),
+                               getattr(tracer.local, 'path', ''), args[1:], size(args, kwargs, result)))
+                return result
+
+        traced.__wrapped__ = original
+        # Instance attributes are removed on disable(), class attributes are restored
+        self.patches.append((owner, name, None if bound else original))
+        setattr(owner, name, traced)
+
+    def instrument_analyzer(self, analyzer, device='E5080A'):
+        if not self.enabled:
+            return
+
+        def binary_size(args, kwargs, result):
+            itemsize = struct.calcsize(kwargs.get('datatype', args[1] if len(args) > 1 else 'f'))
+            return len(args[0]) + len(result) * itemsize
+
+        self._wrap(analyzer, 'write', device, _analyzer_label, lambda a, k, r: len(a[0]), True)
+        self._wrap(analyzer, 'read', device, lambda a: 'read', lambda a, k, r: len(r), True)
+        self._wrap(analyzer, 'query', device, _analyzer_label, lambda a, k, r: len(a[0]) + len(r), True)
+        self._wrap(analyzer, 'query_binary_values', device, _analyzer_label, binary_size, True)
+
+    def instrument_modbus(self, client, device='KMS200'):
+        if not self.enabled:
+            return
+
+        self._wrap(client, 'write_register', device, lambda a: 'write_register ' + str(a[0]),
+                   lambda a, k, r: RTU_WRITE_REGISTER, True)
+        self._wrap(client, 'write_registers', device, lambda a: 'write_registers ' + str(a[0]),
+                   lambda a, k, r: 9 + 2 * len(a[1]) + 8, True)
+        self._wrap(client, 'read_holding_registers', device, lambda a: 'read_holding_registers ' + str(a[0]),
+                   lambda a, k, r: RTU_READ_REQUEST + RTU_READ_RESPONSE + 2 * (a[1] if len(a) > 1 else 1), True)
+
+    def instrument_lucidio(self, device='LucidControl'):
+        if not self.enabled:
+            return
+        from lucidIo import Cmd
+
+        for name in [n for n in vars(Cmd.Cmd) if not n.startswith('_') and callable(getattr(Cmd.Cmd, n))]:
+            self._wrap(Cmd.Cmd, name, device, lambda a, name=name: name + " " + str(a[0] if a else ''),
+                       lambda a, k, r: None, False)
+        self._wrap(Cmd.TxCmd, 'transmit', device, lambda a: 'transmit', lambda a, k, r: len(a[0].getTxData()), False)
+        self._wrap(Cmd.RxCmd, 'receive', device, lambda a: 'receive', lambda a, k, r: max(r, 0), False)
+
+    def instrument_phidget(self, device='Phidget'):
+        if not self.enabled:
+            return
+        from Phidget22.Devices.VoltageOutput import VoltageOutput
+
+        self._wrap(VoltageOutput, 'setVoltage', device, lambda a: 'setVoltage ' + str(a[0]), lambda a, k, r: None,
+                   False)
+
+    """
+    RESULTS
+    """
+    def summary(self):
+        """
+        @return: {(device, command): [count, total ns, total bytes]} of the instrument calls
+        """
+        totals = {}
+        # Snapshot: the deque cannot be iterated while a wrapped call appends to it
+        for device, name, t0, t1, tid, path, args, size in list(self.events):
+            if device == 'phase':
+                continue
+            total = totals.setdefault((device, name), [0, 0, 0])
+            total[0] += 1
+            total[1] += t1 - t0
+            total[2] += size or 0
+        return totals
+
+    def summary_text(self):
+        lines = ["%-12s %-40s %8s %12s %12s" % ('device', 'command', 'count', 'total (ms)', 'bytes')]
+        for (device, name), (count, ns, size) in sorted(self.summary().items(), key=lambda t: -t[1][1]):
+            lines.append("%-12s %-40s %8d %12.3f %12d" % (device, name, count, ns / 1e6, size))
+        return "\n".join(lines)
+
+    def export_chrome(self, filename):
+        """
+        Writes the trace as Chrome trace-event JSON (complete "X" events, microseconds).
+        """
+        pid = os.getpid()
+        trace = []
+        # Snapshot: the deque cannot be iterated while a wrapped call appends to it
+        for device, name, t0, t1, tid, path, args, size in list(self.events):
+            event = {'name': name, 'cat': device, 'ph': 'X', 'ts': (t0 - self.t_origin) / 1000.0,
+                     'dur': (t1 - t0) / 1000.0, 'pid': pid, 'tid': tid, 'args': {'phase': path}}
+            if args is not None:
+                event['args']['command'] = " ".join(str(a) for a in args)
+            if size is not None:
+                event['args']['bytes'] = size
+            trace.append(event)
+
+        with open(filename, "w") as TraceFile:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, TraceFile)
+
+
+# TRACER SHARED BY THE WHOLE PROGRAM
+TRACER = Tracer()
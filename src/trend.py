@@ -0,0 +1,134 @@
+"""
+
+PERMITTIVITY / S11 TREND ESTIMATOR - PREDICTIVE EARLY STOP
+
+Atlantic Cancer Research Institute - ACRI
+
+Exponentially weighted linear regression of a value measured at each cycle (e.g. the stop margin
+of dielectric_check.py, or eps' at a frequency) against the test time. Older cycles weigh less
+(half of the weight every halflife seconds), so the fit follows the current slope of the ablation.
+
+The fit forecasts when the value will reach its target. Five_Iteration_Test uses it to shorten the
+next ON delay, so the next measurement lands when the target is expected instead of one full
+delaimicro later (less over-ablation, no extra cycles).
+"""
+
+import math
+
+
+class TrendEstimator:
+    def __init__(self, halflife=10.0, min_samples=3):
+        """
+        @param halflife: time (s) after which a sample has half of its weight
+        @param min_samples: samples needed before any forecast
+        """
+        self.halflife = halflife
+        self.min_samples = min_samples
+        self.target = None
+        self.reset()
+
+    def reset(self):
+        self.t0 = None
+        self.t_last = None
+        self.samples = 0
+        # Weighted sums: weights, t, y, t^2, t*y (t relative to the first sample)
+        self.sw = 0.0
+        self.st = 0.0
+        self.sy = 0.0
+        self.stt = 0.0
+        self.sty = 0.0
+
+    def start(self, target):
+        """
+        Start of a step stopping at target: the samples measured for another target are dropped.
+
+        @return: True when the fit was reset
+        """
+        if target == self.target:
+            return False
+        self.reset()
+        self.target = target
+        return True
+
+    def update(self, t, y):
+        """
+        @param t: time of the sample (s, any origin, increasing)
+        @param y: value measured
+        """
+        if self.t0 is None:
+            self.t0 = t
+            self.t_last = t
+
+        decay = 0.5 ** (max(t - self.t_last, 0.0) / self.halflife)
+        self.sw *= decay
+        self.st *= decay
+        self.sy *= decay
+        self.stt *= decay
+        self.sty *= decay
+
+        x = t - self.t0
+        self.sw += 1.0
+        self.st += x
+        self.sy += y
+        self.stt += x * x
+        self.sty += x * y
+
+        self.t_last = t
+        self.samples += 1
+
+    """
+    FIT
+    """
+    def slope(self):
+        """
+        @return: slope of the fit (unit of y per s), None while it cannot be computed
+        """
+        if self.samples < max(self.min_samples, 2):
+            return None
+        det = self.sw * self.stt - self.st * self.st
+        if det <= 1e-12 * max(self.sw * self.stt, 1e-300):
+            return None
+        return (self.sw * self.sty - self.st * self.sy) / det
+
+    def value_at(self, t):
+        slope = self.slope()
+        if slope is None:
+            return None
+        intercept = (self.sy - slope * self.st) / self.sw
+        return intercept + slope * (t - self.t0)
+
+    def time_to(self, target, rising=True, now=None):
+        """
+        Forecast of the time left before the fit reaches target.
+
+        @param rising: True when the value goes up towards target, False when it goes down
+        @param now: time (same clock as update()) the forecast is counted from, last sample if None
+        @return: seconds (0 if already reached), None if the fit does not move towards the target
+        """
+        slope = self.slope()
+        if slope is None:
+            return None
+
+        current = self.value_at(self.t_last)
+        if (rising and current >= target) or (not rising and current <= target):
+            return 0.0
+        if (rising and slope <= 0) or (not rising and slope >= 0):
+            return None
+        eta = (target - current) / slope
+        if now is not None:
+            eta = max(eta - (now - self.t_last), 0.0)
+        return eta
+
+
+def next_on_delay(eta, delaimicro, min_on):
+    """
+    ON delay of the next cycle.
+
+    @param eta: forecast from TrendEstimator.time_to() (None = no forecast)
+    @param delaimicro: ON delay chosen in the GUI (s)
+    @param min_on: shortest ON delay accepted (s)
+    @return: delaimicro, or the forecast when the target is expected before the end of the ON delay
+    """
+    if eta is None or math.isnan(eta):
+        return delaimicro
+    return min(delaimicro, max(min_on, eta))